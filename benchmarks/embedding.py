@@ -0,0 +1,103 @@
+"""Benchmark embedding latency and throughput per batch size"""
+from argparse import ArgumentParser
+import statistics
+import time
+from typing import Dict, List, Sequence
+
+from PIL import Image
+
+from image_search.app.arguments import add_embedding_args
+from image_search.core.embedding import CLIPEmbedder, Embedder
+
+_VARIANTS = {
+    # name: (inference mode, compile mode)
+    "baseline": (False, "none"),
+    "inference": (True, "none"),
+    "trace": (True, "trace"),
+    "compile": (True, "compile"),
+}
+
+
+def measure(embed: Embedder,
+            inputs: Sequence,
+            repeats: int,
+            ) -> Dict[str, float]:
+    """
+    Measure latency and throughput of embedding a batch
+    :param embed: embedding function
+    :param inputs: batch of inputs
+    :param repeats: number of measured repetitions
+    :return: median latency in ms and throughput in items per second
+    """
+    embed(inputs)  # exclude one-off costs such as lazy compilation
+    latencies = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        embed(inputs)
+        latencies.append(time.perf_counter() - start)
+    latency = statistics.median(latencies)
+    return {
+        "latency_ms": latency * 1000,
+        "throughput": len(inputs) / latency,
+    }
+
+
+def run(args) -> List[Dict]:
+    results = []
+    image = Image.new("RGB", (640, 480), "gray")
+    for variant in args.variants:
+        inference_mode, compile_mode = _VARIANTS[variant]
+        embed = CLIPEmbedder(model_path=args.model,
+                             device=args.device,
+                             num_threads=args.num_threads,
+                             num_interop_threads=args.num_interop_threads,
+                             compile_mode=compile_mode,
+                             inference_mode=inference_mode,
+                             )
+        for batch_size in args.batch_sizes:
+            batches = {
+                "text": ["a photo of a dog on a skateboard"] * batch_size,
+                "image": [image] * batch_size,
+            }
+            for modality, inputs in batches.items():
+                result = measure(embed, inputs, args.repeats)
+                results.append({"variant": variant,
+                                "modality": modality,
+                                "batch_size": batch_size,
+                                **result})
+                print(f"{variant:>10} {modality:>6} {batch_size:>5} "
+                      f"{result['latency_ms']:>10.2f} ms "
+                      f"{result['throughput']:>10.2f} items/s")
+    return results
+
+
+def main():
+    parser = ArgumentParser(description=__doc__)
+    add_embedding_args(parser)
+    parser.add_argument("--batch-sizes",
+                        type=int,
+                        nargs="+",
+                        default=[1, 2, 4, 8, 16, 32],
+                        help="Batch sizes to measure")
+    parser.add_argument("--repeats",
+                        type=int,
+                        default=10,
+                        help="Number of measured repetitions per batch")
+    parser.add_argument("--variants",
+                        choices=list(_VARIANTS),
+                        nargs="+",
+                        default=["baseline", "inference", "trace"],
+                        help="Execution paths to compare")
+    parser.add_argument("--num-threads",
+                        type=int,
+                        default=None,
+                        help="Number of intra-op threads")
+    parser.add_argument("--num-interop-threads",
+                        type=int,
+                        default=None,
+                        help="Number of inter-op threads")
+    run(parser.parse_args())
+
+
+if __name__ == "__main__":
+    main()
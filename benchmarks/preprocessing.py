@@ -0,0 +1,133 @@
+"""Benchmark image preprocessing throughput"""
+from argparse import ArgumentParser
+import io
+import statistics
+import time
+from typing import Callable, Dict, List, Sequence
+
+from PIL import Image
+from transformers import CLIPImageProcessor
+
+from image_search.app.arguments import add_embedding_args
+from image_search.core.preprocessing import FastImageProcessor
+
+
+def measure(preprocess: Callable[[Sequence[bytes]], object],
+            images: Sequence[bytes],
+            repeats: int,
+            ) -> Dict[str, float]:
+    """
+    Measure the time to decode and preprocess a batch of encoded images
+    :param preprocess: function decoding and preprocessing the images
+    :param images: encoded images
+    :param repeats: number of measured repetitions
+    :return: median latency in ms and throughput in images per second
+    """
+    preprocess(images)
+    latencies = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        preprocess(images)
+        latencies.append(time.perf_counter() - start)
+    latency = statistics.median(latencies)
+    return {
+        "latency_ms": latency * 1000,
+        "throughput": len(images) / latency,
+    }
+
+
+def create_variants(processor: CLIPImageProcessor,
+                    ) -> Dict[str, Callable[[Sequence[bytes]], object]]:
+    """
+    :param processor: image processor of the model
+    :return: preprocessing functions by name
+    """
+    fast_processor = FastImageProcessor(processor)
+    edge = min(processor.crop_size["height"], processor.crop_size["width"])
+
+    def decode(data: bytes,
+               draft: bool = False,
+               ) -> Image.Image:
+        image = Image.open(io.BytesIO(data))
+        if draft:
+            image.draft(None, (edge, edge))
+        image.load()
+        return image
+
+    return {
+        "processor": lambda images: processor(
+            images=[decode(data) for data in images],
+            return_tensors="pt",
+        ),
+        "fast": lambda images: fast_processor.normalize(
+            [fast_processor(decode(data)) for data in images]
+        ),
+        "fast-draft": lambda images: fast_processor.normalize(
+            [fast_processor(decode(data, draft=True)) for data in images]
+        ),
+    }
+
+
+def load_images(paths: Sequence[str],
+                ) -> List[bytes]:
+    """
+    Read encoded images, or create a JPEG photo-sized image if none given
+    :param paths: image files
+    :return: encoded images
+    """
+    if paths:
+        images = []
+        for path in paths:
+            with open(path, "rb") as fh:
+                images.append(fh.read())
+        return images
+    buffer = io.BytesIO()
+    Image.effect_noise((1600, 1200), 64).convert("RGB").save(buffer, "jpeg")
+    return [buffer.getvalue()]
+
+
+def run(args) -> List[Dict]:
+    processor = CLIPImageProcessor.from_pretrained(args.model)
+    variants = create_variants(processor)
+    images = load_images(args.images)
+    results = []
+    for batch_size in args.batch_sizes:
+        batch = (images * batch_size)[:batch_size]
+        for variant in args.variants:
+            result = measure(variants[variant], batch, args.repeats)
+            results.append({"variant": variant,
+                            "batch_size": batch_size,
+                            **result})
+            print(f"{variant:>10} {batch_size:>5} "
+                  f"{result['latency_ms']:>10.2f} ms "
+                  f"{result['throughput']:>10.2f} images/s")
+    return results
+
+
+def main():
+    parser = ArgumentParser(description=__doc__)
+    add_embedding_args(parser)
+    parser.add_argument("--images",
+                        nargs="+",
+                        default=[],
+                        help="Images to preprocess (a generated 1600x1200 "
+                             "JPEG if none are given)")
+    parser.add_argument("--batch-sizes",
+                        type=int,
+                        nargs="+",
+                        default=[1, 8, 32],
+                        help="Batch sizes to measure")
+    parser.add_argument("--repeats",
+                        type=int,
+                        default=10,
+                        help="Number of measured repetitions per batch")
+    parser.add_argument("--variants",
+                        choices=["processor", "fast", "fast-draft"],
+                        nargs="+",
+                        default=["processor", "fast", "fast-draft"],
+                        help="Preprocessing paths to compare")
+    run(parser.parse_args())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,150 @@
+"""Compare search quality of embedding precision modes against fp32"""
+from argparse import ArgumentParser
+import os
+import time
+from typing import Dict, List, Sequence
+
+from PIL import Image
+import torch
+
+from image_search.app.arguments import add_embedding_args
+from image_search.core.embedding import CLIPEmbedder
+from image_search.core.utils import create_batches, topk_similarity
+
+_VARIANTS = {
+    # name: embedder options
+    "fp32": {},
+    "int8": {"precision": "int8"},
+    "bf16": {"precision": "bf16"},
+    "onnx": {"backend": "onnx"},
+}
+_IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".webp", ".bmp", ".gif")
+
+
+def recall_at_k(expected_ids: torch.Tensor,
+                ids: torch.Tensor,
+                k: int,
+                ) -> float:
+    """
+    Compute the mean share of the expected top-k results that were found
+    :param expected_ids: reference result indices per query (sorted)
+    :param ids: result indices per query (sorted)
+    :param k: number of results to compare
+    :return: recall@k
+    """
+    k = min(k, expected_ids.shape[1])
+    recalls = [
+        len(set(expected[:k].tolist()) & set(found[:k].tolist())) / k
+        for expected, found in zip(expected_ids, ids)
+    ]
+    return sum(recalls) / len(recalls)
+
+
+def embed_all(embed: CLIPEmbedder,
+              objs: Sequence,
+              batch_size: int,
+              ) -> torch.Tensor:
+    """
+    Embed objects in batches
+    :param embed: embedding function
+    :param objs: texts or images
+    :param batch_size: number of objects per call
+    :return: embeddings
+    """
+    embeddings = [embedding
+                  for batch in create_batches(objs, batch_size)
+                  for embedding in embed(batch)]
+    return torch.stack(embeddings)
+
+
+def load_data(image_dir: str,
+              queries_path: str,
+              ) -> tuple[List[Image.Image], List[str]]:
+    """
+    Load corpus and queries
+    :param image_dir: directory of images to search
+    :param queries_path: text file with one query per line
+    :return: images and queries
+    """
+    images = []
+    for name in sorted(os.listdir(image_dir)):
+        if name.lower().endswith(_IMAGE_EXTENSIONS):
+            image = Image.open(os.path.join(image_dir, name))
+            image.load()
+            images.append(image)
+    with open(queries_path) as fh:
+        queries = [line.strip() for line in fh if line.strip()]
+    return images, queries
+
+
+def run(args) -> List[Dict]:
+    images, queries = load_data(args.images, args.queries)
+    max_k = max(args.k)
+    results = []
+    reference = None
+    for variant in ["fp32", *args.variants]:
+        embed = CLIPEmbedder(model_path=args.model,
+                             device=args.device,
+                             num_threads=args.num_threads,
+                             warmup=True,
+                             normalize=True,
+                             **_VARIANTS[variant],
+                             )
+        start = time.perf_counter()
+        image_embeddings = embed_all(embed, images, args.batch_size)
+        seconds = time.perf_counter() - start
+        query_embeddings = embed_all(embed, queries, args.batch_size)
+        _, ids = topk_similarity(query_embeddings, image_embeddings, max_k)
+        if reference is None:
+            reference = image_embeddings, ids
+
+        reference_embeddings, reference_ids = reference
+        result = {
+            "variant": variant,
+            "images_per_second": len(images) / seconds,
+            "image_cosine": torch.sum(image_embeddings * reference_embeddings,
+                                      dim=-1).mean().item(),
+            **{f"recall@{k}": recall_at_k(reference_ids, ids, k)
+               for k in args.k},
+        }
+        results.append(result)
+        recalls = " ".join(f"R@{k}={result[f'recall@{k}']:.3f}"
+                           for k in args.k)
+        print(f"{variant:>6} {result['images_per_second']:>10.2f} images/s "
+              f"cos={result['image_cosine']:.4f} {recalls}")
+    return results
+
+
+def main():
+    parser = ArgumentParser(description=__doc__)
+    add_embedding_args(parser)
+    parser.add_argument("--images",
+                        required=True,
+                        help="Directory with images to search")
+    parser.add_argument("--queries",
+                        required=True,
+                        help="Text file with one search query per line")
+    parser.add_argument("-k",
+                        type=int,
+                        nargs="+",
+                        default=[1, 5, 10],
+                        help="Numbers of results to compare")
+    parser.add_argument("--variants",
+                        choices=[variant for variant in _VARIANTS
+                                 if variant != "fp32"],
+                        nargs="+",
+                        default=["int8", "bf16"],
+                        help="Precision modes to compare with fp32")
+    parser.add_argument("--batch-size",
+                        type=int,
+                        default=32,
+                        help="Number of images or queries per call")
+    parser.add_argument("--num-threads",
+                        type=int,
+                        default=None,
+                        help="Number of intra-op threads")
+    run(parser.parse_args())
+
+
+if __name__ == "__main__":
+    main()
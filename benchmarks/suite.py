@@ -0,0 +1,520 @@
+"""
+Benchmark the embedder, the databases and the API, and write the results to
+JSON. By default, everything runs offline and in-process: a tiny random
+CLIP model, an in-memory Qdrant client, the local index, the API server and
+a task queue worker with in-memory broker.
+"""
+from argparse import ArgumentParser
+import asyncio
+import base64
+import contextlib
+import datetime
+import io
+import json
+import os
+import platform
+import socket
+import statistics
+import tempfile
+import threading
+import time
+from typing import Any, Dict, Iterator, List, Sequence
+import uuid
+
+import httpx
+import numpy as np
+from PIL import Image
+from qdrant_client import QdrantClient
+import torch
+
+from benchmarks.embedding import measure
+from benchmarks.tiny_model import create_tiny_model
+from image_search.core.database import QdrantVectorDatabase
+from image_search.core.embedding import CLIPEmbedder, Embedder
+from image_search.core.local_database import LocalVectorDatabase
+from image_search.core.utils import create_batches
+
+_WORDS = ["dog", "cat", "house", "beach", "mountain", "car", "tree",
+          "flower", "city", "river", "bird", "boat", "snow", "night"]
+
+
+def random_images(n_images: int,
+                  size: Sequence[int],
+                  seed: int = 0,
+                  ) -> List[Image.Image]:
+    """
+    Create distinct images of random noise
+    :param n_images: number of images
+    :param size: width and height
+    :param seed: random seed
+    :return: images
+    """
+    rng = np.random.default_rng(seed)
+    width, height = size
+    return [Image.fromarray(rng.integers(0, 256, (height, width, 3),
+                                         dtype=np.uint8))
+            for _ in range(n_images)]
+
+
+def random_queries(n_queries: int,
+                   seed: int = 0,
+                   ) -> List[str]:
+    """
+    Create distinct search queries, so that no result is cached
+    :param n_queries: number of queries
+    :param seed: random seed
+    :return: queries
+    """
+    rng = np.random.default_rng(seed)
+    return [f"a photo of a {' '.join(rng.choice(_WORDS, 3))} {query_id}"
+            for query_id in range(n_queries)]
+
+
+def percentiles(latencies: Sequence[float],
+                ) -> Dict[str, float]:
+    """
+    :param latencies: latencies in seconds
+    :return: median, 95th and 99th percentile in milliseconds
+    """
+    quantiles = statistics.quantiles(latencies, n=100, method="inclusive")
+    return {
+        "p50_ms": quantiles[49] * 1000,
+        "p95_ms": quantiles[94] * 1000,
+        "p99_ms": quantiles[98] * 1000,
+    }
+
+
+def bench_embedder(embed: Embedder,
+                   batch_sizes: Sequence[int],
+                   repeats: int,
+                   image_size: Sequence[int],
+                   ) -> List[Dict]:
+    """
+    Measure embedding latency and throughput per batch size
+    :param embed: embedding function
+    :param batch_sizes: batch sizes
+    :param repeats: number of measured repetitions per batch
+    :param image_size: width and height of images
+    :return: results per modality and batch size
+    """
+    image = random_images(1, image_size)[0]
+    results = []
+    for batch_size in batch_sizes:
+        batches = {
+            "text": ["a photo of a dog on a skateboard"] * batch_size,
+            "image": [image] * batch_size,
+        }
+        for modality, inputs in batches.items():
+            results.append({"modality": modality,
+                            "batch_size": batch_size,
+                            **measure(embed, inputs, repeats)})
+    return results
+
+
+def bench_database(name: str,
+                   database: Any,
+                   images: Sequence[Image.Image],
+                   queries: Sequence[str],
+                   batch_size: int,
+                   n_similar: int,
+                   ) -> Dict[str, Any]:
+    """
+    Measure the throughput of `put` and `query_similar`, both including
+    embedding
+    :param name: name of database
+    :param database: database
+    :param images: images to put
+    :param queries: queries to search
+    :param batch_size: number of images or queries per call
+    :param n_similar: number of results per query
+    :return: images put and queries searched per second
+    """
+    start = time.perf_counter()
+    for batch in create_batches(images, batch_size):
+        database.put(batch)
+    put_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for batch in create_batches(queries, batch_size):
+        database.query_similar(batch, n_similar=n_similar)
+    query_seconds = time.perf_counter() - start
+    return {
+        "database": name,
+        "put_per_second": len(images) / put_seconds,
+        "queries_per_second": len(queries) / query_seconds,
+    }
+
+
+async def bench_search(url: str,
+                       queries: Sequence[str],
+                       concurrency: int,
+                       n_similar: int,
+                       ) -> Dict[str, Any]:
+    """
+    Measure `/search` latency with concurrent clients, one query per request
+    :param url: base URL of API
+    :param queries: one query per request
+    :param concurrency: number of concurrent clients
+    :param n_similar: number of results per query
+    :return: latency percentiles and requests per second
+    """
+    latencies = []
+    limits = httpx.Limits(max_connections=concurrency)
+    async with httpx.AsyncClient(base_url=url,
+                                 limits=limits,
+                                 timeout=300,
+                                 ) as client:
+        async def search(client_id: int) -> None:
+            for query in queries[client_id::concurrency]:
+                start = time.perf_counter()
+                response = await client.post("/search", json={
+                    "queries": [query],
+                    "n_similar": n_similar,
+                })
+                response.raise_for_status()
+                latencies.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(search(client_id)
+                               for client_id in range(concurrency)))
+        seconds = time.perf_counter() - start
+    return {
+        "concurrency": concurrency,
+        "requests": len(latencies),
+        **percentiles(latencies),
+        "requests_per_second": len(latencies) / seconds,
+    }
+
+
+def bench_index(url: str,
+                jobs: Sequence[Sequence[Image.Image]],
+                poll_interval: float = 0.02,
+                ) -> Dict[str, Any]:
+    """
+    Measure the end-to-end latency of `/index` jobs, from the request until
+    the job succeeded, one job at a time
+    :param url: base URL of API
+    :param jobs: images of each job
+    :param poll_interval: seconds between status requests
+    :return: latency percentiles and indexed images per second
+    """
+    latencies = []
+    with httpx.Client(base_url=url, timeout=300) as client:
+        for images in jobs:
+            encoded_images = [base64.b64encode(_to_png(image)).decode()
+                              for image in images]
+            start = time.perf_counter()
+            response = client.post("/index", json={"images": encoded_images})
+            response.raise_for_status()
+            job_id = response.json()["job_id"]
+            while True:
+                response = client.get(f"/index/{job_id}")
+                response.raise_for_status()
+                status = response.json()["status"]
+                if status in ("SUCCESS", "FAILURE"):
+                    break
+                time.sleep(poll_interval)
+            if status == "FAILURE":
+                raise RuntimeError(f"Indexing job '{job_id}' failed")
+            latencies.append(time.perf_counter() - start)
+    n_images = sum(len(images) for images in jobs)
+    return {
+        "jobs": len(latencies),
+        "images_per_job": len(jobs[0]),
+        **percentiles(latencies),
+        "images_per_second": n_images / sum(latencies),
+    }
+
+
+def compare(results: Dict[str, Any],
+            baseline: Dict[str, Any],
+            ) -> List[str]:
+    """
+    Compare the measurements of two runs
+    :param results: results of this run
+    :param baseline: results of a previous run
+    :return: one line per measurement, with the relative change
+    """
+    lines = []
+    for section, records in results["results"].items():
+        baseline_records = {_record_key(record): record
+                            for record in baseline["results"].get(section,
+                                                                   [])}
+        for record in records:
+            baseline_record = baseline_records.get(_record_key(record))
+            if baseline_record is None:
+                continue
+            for metric, value in record.items():
+                reference = baseline_record.get(metric)
+                if not isinstance(value, float) or not reference:
+                    continue
+                change = (value - reference) / reference * 100
+                lines.append(f"{section} {_record_key(record)} {metric}: "
+                             f"{reference:.2f} -> {value:.2f} "
+                             f"({change:+.1f}%)")
+    return lines
+
+
+def run(args) -> Dict[str, Any]:
+    with contextlib.ExitStack() as stack:
+        if args.model is None:
+            model_dir = stack.enter_context(tempfile.TemporaryDirectory())
+            args.model = create_tiny_model(os.path.join(model_dir, "model"))
+        embed = CLIPEmbedder(model_path=args.model,
+                             device=args.device,
+                             num_threads=args.num_threads,
+                             fast_preprocessing=True,
+                             normalize=True,
+                             warmup=True,
+                             )
+        image_size = tuple(args.image_size)
+        results = {"embedder": bench_embedder(embed,
+                                              args.batch_sizes,
+                                              args.repeats,
+                                              image_size,
+                                              )}
+        _print_records("embedder", results["embedder"])
+
+        images = random_images(args.num_images, image_size, seed=1)
+        queries = random_queries(args.num_queries, seed=1)
+        databases = {
+            "qdrant": QdrantVectorDatabase(embed=embed,
+                                           client=QdrantClient(
+                                               location=args.qdrant_url,
+                                           ),
+                                           collection=f"benchmark-"
+                                                      f"{uuid.uuid4()}",
+                                           ),
+            "local": LocalVectorDatabase(
+                embed=embed,
+                path=stack.enter_context(tempfile.TemporaryDirectory()),
+            ),
+        }
+        results["database"] = [
+            bench_database(name, database, images, queries,
+                           args.database_batch_size, args.n_similar)
+            for name, database in databases.items()
+        ]
+        _print_records("database", results["database"])
+
+        api_url = args.api_url or stack.enter_context(
+            _serve_api(args.model, stack.enter_context(
+                tempfile.TemporaryDirectory()
+            ))
+        )
+        _wait_until_ready(api_url)
+        index_jobs = [random_images(args.images_per_job, image_size,
+                                    seed=100 + job_id)
+                      for job_id in range(args.index_jobs)]
+        results["index"] = [bench_index(api_url, index_jobs)]
+        _print_records("index", results["index"])
+        search_queries = random_queries(args.search_requests, seed=2)
+        results["search"] = [
+            asyncio.run(bench_search(api_url, search_queries, concurrency,
+                                     args.n_similar))
+            for concurrency in args.concurrency
+        ]
+        _print_records("search", results["search"])
+
+    output = {
+        "metadata": {
+            "time": datetime.datetime.now().isoformat(),
+            "platform": platform.platform(),
+            "python": platform.python_version(),
+            "torch": torch.__version__,
+            "num_threads": torch.get_num_threads(),
+            "model": args.model if args.api_url is None else None,
+        },
+        "results": results,
+    }
+    with open(args.output, "w") as fh:
+        json.dump(output, fh, indent=2)
+    if args.baseline:
+        with open(args.baseline) as fh:
+            baseline = json.load(fh)
+        print("\n".join(compare(output, baseline)))
+    return output
+
+
+@contextlib.contextmanager
+def _serve_api(model_path: str,
+               data_path: str,
+               ) -> Iterator[str]:
+    """
+    Run the API server and a task queue worker in background threads of
+    this process, with the local index, no caches and in-memory broker
+    :param model_path: path to model
+    :param data_path: directory of index and staged images
+    :return: base URL of API
+    """
+    overrides = {
+        "T2I_SEARCH_EMBEDDING__MODEL_PATH": model_path,
+        "T2I_SEARCH_EMBEDDING__SERVER_URL": "",
+        "T2I_SEARCH_EMBEDDING__SNAPSHOT_PATH": "",
+        "T2I_SEARCH_DATABASE__BACKEND": "local",
+        "T2I_SEARCH_DATABASE__LOCAL_PATH": os.path.join(data_path, "index"),
+        "T2I_SEARCH_STAGING__PATH": os.path.join(data_path, "staging"),
+        "T2I_SEARCH_THUMBNAILS__PATH": os.path.join(data_path, "thumbnails"),
+        "T2I_SEARCH_CACHE__EMBEDDING_MAX_SIZE": "0",
+        "T2I_SEARCH_CACHE__RESULT_MAX_SIZE": "0",
+        "T2I_SEARCH_CACHE__REDIS_URL": "",
+        "T2I_SEARCH_WORKER__BROKER_URL": "memory://",
+        "T2I_SEARCH_WORKER__BACKEND_URL": "cache+memory://",
+    }
+    os.environ.update(overrides)
+
+    # settings are read on import
+    from celery.contrib.testing.worker import start_worker
+    import uvicorn
+
+    from image_search.app.api import app
+    from image_search.app.tasks import app as celery_app
+
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    server = uvicorn.Server(uvicorn.Config(app,
+                                           host="127.0.0.1",
+                                           port=port,
+                                           log_level="warning",
+                                           ))
+    thread = threading.Thread(target=server.run, daemon=True)
+    with start_worker(celery_app,
+                      pool="threads",
+                      concurrency=1,
+                      perform_ping_check=False,
+                      ):
+        thread.start()
+        try:
+            while not server.started:
+                time.sleep(0.01)
+            yield f"http://127.0.0.1:{port}"
+        finally:
+            server.should_exit = True
+            thread.join()
+
+
+def _wait_until_ready(url: str,
+                      timeout: float = 600,
+                      ) -> None:
+    """
+    Wait until the API has loaded its model
+    :param url: base URL of API
+    :param timeout: maximum waiting time in seconds
+    """
+    deadline = time.monotonic() + timeout
+    with httpx.Client(base_url=url) as client:
+        while client.get("/ready").status_code != 200:
+            if time.monotonic() > deadline:
+                raise TimeoutError("API did not become ready")
+            time.sleep(0.1)
+
+
+def _to_png(image: Image.Image,
+            ) -> bytes:
+    buffer = io.BytesIO()
+    image.save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+def _record_key(record: Dict[str, Any],
+                ) -> str:
+    """
+    :param record: result record
+    :return: the record's non-measurement fields, e.g., the batch size
+    """
+    return " ".join(f"{key}={value}" for key, value in record.items()
+                    if not isinstance(value, float))
+
+
+def _print_records(section: str,
+                   records: Sequence[Dict[str, Any]],
+                   ) -> None:
+    for record in records:
+        measurements = " ".join(f"{key}={value:.2f}"
+                                for key, value in record.items()
+                                if isinstance(value, float))
+        print(f"{section:>8} {_record_key(record)} {measurements}")
+
+
+def main():
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument("--model",
+                        default=None,
+                        help="Model name or path (tiny random model if not "
+                             "set)")
+    parser.add_argument("--device",
+                        type=torch.device,
+                        default=torch.device("cpu"),
+                        help="Device to use for inference")
+    parser.add_argument("--num-threads",
+                        type=int,
+                        default=None,
+                        help="Number of intra-op threads")
+    parser.add_argument("--output",
+                        default="benchmark-results.json",
+                        help="JSON file to write results to")
+    parser.add_argument("--baseline",
+                        default=None,
+                        help="JSON results of a previous run to compare with")
+    parser.add_argument("--batch-sizes",
+                        type=int,
+                        nargs="+",
+                        default=[1, 8, 32],
+                        help="Embedding batch sizes to measure")
+    parser.add_argument("--repeats",
+                        type=int,
+                        default=5,
+                        help="Number of measured repetitions per batch")
+    parser.add_argument("--image-size",
+                        type=int,
+                        nargs=2,
+                        default=[640, 480],
+                        help="Width and height of random images")
+    parser.add_argument("--qdrant-url",
+                        default=":memory:",
+                        help="Qdrant server URL for the database benchmark "
+                             "(in-memory client by default)")
+    parser.add_argument("--num-images",
+                        type=int,
+                        default=256,
+                        help="Number of images to put into each database")
+    parser.add_argument("--num-queries",
+                        type=int,
+                        default=256,
+                        help="Number of queries to search in each database")
+    parser.add_argument("--database-batch-size",
+                        type=int,
+                        default=32,
+                        help="Number of images or queries per database call")
+    parser.add_argument("--n-similar",
+                        type=int,
+                        default=10,
+                        help="Number of results per query")
+    parser.add_argument("--api-url",
+                        default=None,
+                        help="Base URL of a running API to benchmark instead "
+                             "of an in-process one")
+    parser.add_argument("--index-jobs",
+                        type=int,
+                        default=10,
+                        help="Number of /index jobs")
+    parser.add_argument("--images-per-job",
+                        type=int,
+                        default=16,
+                        help="Number of images per /index job")
+    parser.add_argument("--search-requests",
+                        type=int,
+                        default=200,
+                        help="Number of /search requests per concurrency "
+                             "level")
+    parser.add_argument("--concurrency",
+                        type=int,
+                        nargs="+",
+                        default=[1, 8, 32],
+                        help="Numbers of concurrent /search clients")
+    run(parser.parse_args())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+"""Create a tiny, randomly initialized CLIP model to benchmark offline"""
+from argparse import ArgumentParser
+import json
+import os
+import string
+import tempfile
+
+import torch
+from transformers import (CLIPConfig, CLIPImageProcessor, CLIPModel,
+                          CLIPTokenizer)
+
+_CHARACTERS = string.ascii_lowercase + string.digits + ".,!?"
+_SPECIAL_TOKENS = ["<|startoftext|>", "<|endoftext|>"]
+
+
+def create_tiny_model(path: str,
+                      image_size: int = 224,
+                      hidden_size: int = 32,
+                      num_layers: int = 2,
+                      projection_dim: int = 16,
+                      seed: int = 0,
+                      ) -> str:
+    """
+    Save a CLIP model with random weights, a character-level tokenizer and
+    an image processor. Its embeddings are meaningless, but preprocessing,
+    batching and data flow behave as for a real model, and no download is
+    needed.
+    :param path: model directory
+    :param image_size: input image size
+    :param hidden_size: hidden size of both encoders
+    :param num_layers: number of layers of both encoders
+    :param projection_dim: embedding dimension
+    :param seed: seed of random weights
+    :return: model directory
+    """
+    os.makedirs(path, exist_ok=True)
+    tokens = [token
+              for character in _CHARACTERS
+              for token in (character, f"{character}</w>")]
+    vocab = {token: token_id
+             for token_id, token in enumerate(tokens + _SPECIAL_TOKENS)}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        vocab_path = os.path.join(tmp_dir, "vocab.json")
+        merges_path = os.path.join(tmp_dir, "merges.txt")
+        with open(vocab_path, "w") as fh:
+            json.dump(vocab, fh)
+        with open(merges_path, "w") as fh:
+            fh.write("#version: 0.2\n")
+        tokenizer = CLIPTokenizer(vocab_path, merges_path)
+        tokenizer.save_pretrained(path)
+
+    CLIPImageProcessor(size={"shortest_edge": image_size},
+                       crop_size={"height": image_size,
+                                  "width": image_size},
+                       ).save_pretrained(path)
+    encoder_config = {
+        "hidden_size": hidden_size,
+        "intermediate_size": 2 * hidden_size,
+        "num_attention_heads": 2,
+        "num_hidden_layers": num_layers,
+        "projection_dim": projection_dim,
+    }
+    config = CLIPConfig(
+        text_config={**encoder_config, "vocab_size": len(vocab)},
+        vision_config={**encoder_config,
+                       "image_size": image_size,
+                       "patch_size": 32,
+                       },
+        projection_dim=projection_dim,
+    )
+    torch.manual_seed(seed)
+    CLIPModel(config).save_pretrained(path)
+    return path
+
+
+def main():
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument("path",
+                        help="Directory to save the model to")
+    parser.add_argument("--image-size",
+                        type=int,
+                        default=224,
+                        help="Input image size")
+    parser.add_argument("--hidden-size",
+                        type=int,
+                        default=32,
+                        help="Hidden size of both encoders")
+    parser.add_argument("--num-layers",
+                        type=int,
+                        default=2,
+                        help="Number of layers of both encoders")
+    args = parser.parse_args()
+    create_tiny_model(args.path,
+                      image_size=args.image_size,
+                      hidden_size=args.hidden_size,
+                      num_layers=args.num_layers,
+                      )
+
+
+if __name__ == "__main__":
+    main()
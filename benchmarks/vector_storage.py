@@ -0,0 +1,186 @@
+"""Benchmark memory and recall of quantized vector storage in Qdrant"""
+from argparse import ArgumentParser
+import math
+import statistics
+import time
+from typing import Dict, List
+import uuid
+
+import numpy as np
+from qdrant_client import QdrantClient
+from qdrant_client.models import Distance, SearchRequest, VectorParams
+import torch
+
+from benchmarks.recall import recall_at_k
+from image_search.core.database import VectorStorage
+from image_search.core.utils import topk_similarity
+
+_BYTES_PER_DIMENSION = {
+    # quantization: bytes of a quantized vector component
+    "none": 0,
+    "scalar": 1,
+    "binary": 1 / 8,
+}
+
+
+def memory_per_million(dim: int,
+                       storage: VectorStorage,
+                       ) -> Dict[str, float]:
+    """
+    Estimate the memory needed for the vectors of one million points,
+    excluding the HNSW graph and payloads
+    :param dim: vector dimension
+    :param storage: vector storage
+    :return: MiB in RAM and on disk
+    """
+    original = dim * 4
+    quantized = math.ceil(dim * _BYTES_PER_DIMENSION[storage.quantization])
+    ram = (0 if storage.on_disk else original) + (
+        quantized if storage.always_ram else 0)
+    disk = original + quantized
+    return {
+        "ram_mib": ram * 1_000_000 / 2 ** 20,
+        "disk_mib": disk * 1_000_000 / 2 ** 20,
+    }
+
+
+def load_vectors(args) -> np.ndarray:
+    """
+    Load embeddings, e.g., of real images, or create random ones
+    :return: normalized float32 vectors
+    """
+    if args.vectors:
+        vectors = np.load(args.vectors).astype(np.float32)
+    else:
+        rng = np.random.default_rng(args.seed)
+        vectors = rng.standard_normal((args.num_vectors + args.num_queries,
+                                       args.dim), dtype=np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def run(args) -> List[Dict]:
+    client = QdrantClient(location=args.url, prefer_grpc=args.prefer_grpc)
+    vectors = load_vectors(args)
+    queries, corpus = vectors[:args.num_queries], vectors[args.num_queries:]
+    max_k = max(args.k)
+    _, expected_ids = topk_similarity(torch.from_numpy(queries),
+                                      torch.from_numpy(corpus),
+                                      max_k)
+
+    results = []
+    for quantization in args.modes:
+        storage = VectorStorage(quantization=quantization,
+                                always_ram=True,
+                                on_disk=quantization != "none",
+                                oversampling=args.oversampling,
+                                rescore=not args.no_rescore,
+                                )
+        collection = f"benchmark-{uuid.uuid4()}"
+        client.recreate_collection(
+            collection_name=collection,
+            vectors_config=VectorParams(
+                size=corpus.shape[1],
+                distance=Distance.DOT,
+                on_disk=storage.on_disk,
+                quantization_config=storage.quantization_config(),
+            ),
+        )
+        try:
+            client.upload_collection(collection_name=collection,
+                                     vectors=corpus,
+                                     ids=range(len(corpus)),
+                                     batch_size=1024,
+                                     wait=True,
+                                     )
+            requests = [
+                SearchRequest(vector=query,
+                              limit=max_k,
+                              params=storage.search_params(),
+                              )
+                for query in queries.tolist()
+            ]
+            latencies, hits = [], []
+            for start in range(0, len(requests), args.batch_size):
+                batch = requests[start:start + args.batch_size]
+                begin = time.perf_counter()
+                hits += client.search_batch(collection_name=collection,
+                                            requests=batch,
+                                            )
+                latencies.append((time.perf_counter() - begin) / len(batch))
+        finally:
+            client.delete_collection(collection)
+
+        ids = torch.tensor([[point.id for point in points]
+                            for points in hits])
+        result = {
+            "quantization": quantization,
+            **memory_per_million(corpus.shape[1], storage),
+            "latency_ms": statistics.median(latencies) * 1000,
+            **{f"recall@{k}": recall_at_k(expected_ids, ids, k)
+               for k in args.k},
+        }
+        results.append(result)
+        recalls = " ".join(f"R@{k}={result[f'recall@{k}']:.3f}"
+                           for k in args.k)
+        print(f"{quantization:>7} {result['ram_mib']:>9.1f} MiB RAM/1M "
+              f"{result['disk_mib']:>9.1f} MiB disk/1M "
+              f"{result['latency_ms']:>8.2f} ms/query {recalls}")
+    return results
+
+
+def main():
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument("--url",
+                        default="localhost:6333",
+                        help="URL of Qdrant server (quantization is ignored "
+                             "by the in-memory client)")
+    parser.add_argument("--prefer-grpc",
+                        action="store_true",
+                        help="Send vectors via gRPC")
+    parser.add_argument("--vectors",
+                        default=None,
+                        help=".npy file with embeddings; the first "
+                             "--num-queries are used as queries (random "
+                             "vectors if not set)")
+    parser.add_argument("--num-vectors",
+                        type=int,
+                        default=100_000,
+                        help="Number of random vectors to index")
+    parser.add_argument("--dim",
+                        type=int,
+                        default=512,
+                        help="Dimension of random vectors")
+    parser.add_argument("--num-queries",
+                        type=int,
+                        default=100,
+                        help="Number of queries")
+    parser.add_argument("--seed",
+                        type=int,
+                        default=0,
+                        help="Seed of random vectors")
+    parser.add_argument("-k",
+                        type=int,
+                        nargs="+",
+                        default=[1, 10, 100],
+                        help="Numbers of results to compare")
+    parser.add_argument("--modes",
+                        choices=list(_BYTES_PER_DIMENSION),
+                        nargs="+",
+                        default=list(_BYTES_PER_DIMENSION),
+                        help="Quantization modes to compare")
+    parser.add_argument("--oversampling",
+                        type=float,
+                        default=2.0,
+                        help="Candidates per result to rescore")
+    parser.add_argument("--no-rescore",
+                        action="store_true",
+                        help="Do not rescore with original vectors")
+    parser.add_argument("--batch-size",
+                        type=int,
+                        default=16,
+                        help="Number of queries per request")
+    run(parser.parse_args())
+
+
+if __name__ == "__main__":
+    main()
@@ -6,6 +6,13 @@ set -euo pipefail
 #
 
 RUN_MODE="${RUN_MODE:-"${1:-}"}"
+
+# Metrics files of the processes of a previous run must not be aggregated
+if [ -n "${PROMETHEUS_MULTIPROC_DIR:-}" ]; then
+  rm -rf "${PROMETHEUS_MULTIPROC_DIR}"
+  mkdir -p "${PROMETHEUS_MULTIPROC_DIR}"
+fi
+
 if [ "${RUN_MODE}" == "server" ]; then
   function get_default_ip {
     ifname="$(ip route show default | grep -Eom 1 'dev \w+' | awk '{print $2}')"
@@ -14,8 +21,22 @@ if [ "${RUN_MODE}" == "server" ]; then
 
   HOST_IP="${HOST_IP:-"$(get_default_ip)"}"
   PORT="${PORT:-8080}"
+  WORKERS="${WORKERS:-1}"
 
-  uvicorn "image_search.app.api:app" --host "${HOST_IP}" --port "${PORT}"
+  uvicorn "image_search.app.api:app" --host "${HOST_IP}" --port "${PORT}" --workers "${WORKERS}"
+elif [ "${RUN_MODE}" == "embedding-server" ]; then
+  EMBEDDING_SOCKET="${EMBEDDING_SOCKET:-}"
+  if [ -n "${EMBEDDING_SOCKET}" ]; then
+    uvicorn "image_search.app.embedding_server:app" --uds "${EMBEDDING_SOCKET}"
+  else
+    EMBEDDING_HOST="${EMBEDDING_HOST:-127.0.0.1}"
+    EMBEDDING_PORT="${EMBEDDING_PORT:-8081}"
+    uvicorn "image_search.app.embedding_server:app" --host "${EMBEDDING_HOST}" --port "${EMBEDDING_PORT}"
+  fi
+elif [ "${RUN_MODE}" == "bulk-index" ]; then
+  python -m image_search.app.bulk_index "${@:2}"
+elif [ "${RUN_MODE}" == "rebuild-index" ]; then
+  python -m image_search.app.rebuild_index "${@:2}"
 elif [ "${RUN_MODE}" == "task-queue" ]; then
   celery_cmd="${2:-"worker"}"
   celery -A "image_search.app.tasks:app" "$celery_cmd"
@@ -1,48 +1,562 @@
 """API"""
+import asyncio
 import base64
-from typing import Optional
+import binascii
+from contextlib import asynccontextmanager
+import functools
+import io
+import time
+from typing import Any, Dict, List, Optional
+import uuid
 
-from celery.result import AsyncResult
-from fastapi import FastAPI
+from celery import states
+from celery.result import AsyncResult, GroupResult
+from fastapi import (FastAPI, File, Form, HTTPException, Request, Response,
+                     UploadFile)
+from fastapi.concurrency import run_in_threadpool
+from PIL import Image
+from pydantic import TypeAdapter
+from qdrant_client.models import (FieldCondition, Filter, MatchAny,
+                                  MatchValue, Range)
 
-from image_search.app.data import (IndexingJob, IndexRequest, SearchRequest,
+from image_search.app.config import settings
+from image_search.app.data import (CacheStatistics, FieldFilter,
+                                   IndexingJob, IndexRequest, Readiness,
+                                   ResultMode, SearchHit, SearchRequest,
                                    SearchResult, Trackable)
-from image_search.app.initialize import database
-from image_search.app.tasks import app as celery_app, index as index_task
+from image_search.app.ingestion import (ChunkDispatcher, ingest_multipart,
+                                        ingest_ndjson)
+from image_search.app.tasks import (app as celery_app, blob_store,
+                                    index as index_task)
+from image_search.core import telemetry
 
-app = FastAPI()
+_THUMBNAIL_URL = "/images/{id}"
+_FIELD_FILTERS = TypeAdapter(List[FieldFilter])
+
+_initialization: Optional[asyncio.Future] = None
+
+
+@asynccontextmanager
+async def lifespan(_: FastAPI):
+    if settings.api.preload:
+        _initialize()
+    yield
+    if _initialization is not None and _initialization.done() \
+            and not _failed(_initialization):
+        await _initialization.result().async_database.close()
+
+
+app = FastAPI(lifespan=lifespan)
+
+if settings.metrics.enabled:
+    telemetry.enable(tracing=settings.metrics.tracing)
+
+    @app.middleware("http")
+    async def measure_request(request: Request, call_next):
+        start = time.perf_counter()
+        response = await call_next(request)
+        route = request.scope.get("route")
+        telemetry.observe_stage("api",
+                                route.path if route else "unknown",
+                                time.perf_counter() - start)
+        return response
 
 
 @app.post("/index")
 def index(request: IndexRequest,
           ) -> IndexingJob:
-    image_bytes = [base64.b64decode(image)
-                   for image in request.images]
-    task_result = index_task.delay(image_bytes)
+    if request.metadata is not None \
+            and len(request.metadata) != len(request.images):
+        raise HTTPException(status_code=400,
+                            detail="metadata must have one entry per image")
+    job_id = str(uuid.uuid4())
+    image_hashes = [blob_store.put(base64.b64decode(image), owner=job_id)
+                    for image in request.images]
+    task_result = index_task.apply_async(
+        (image_hashes,),
+        {"tracking_id": request.tracking_id, "metadata": request.metadata},
+        task_id=job_id,
+    )
     return IndexingJob(job_id=task_result.id,
                        status=task_result.status,
                        tracking_id=request.tracking_id)
 
 
+@app.post("/index/stream")
+async def index_stream(request: Request,
+                       tracking_id: Optional[str] = None,
+                       ) -> IndexingJob:
+    """
+    Index images from a multipart/form-data body (one file per image) or
+    from newline-delimited JSON (one {"image": <base64>} object per line).
+    Images are staged as they arrive and dispatched in chunks of tasks,
+    which are tracked together under the returned job ID. If the body turns
+    out to be malformed after chunks were dispatched, the job of these
+    chunks is returned with the error; the images of the last chunk are
+    dropped.
+    """
+    job_id = str(uuid.uuid4())
+    dispatcher = ChunkDispatcher(job_id,
+                                 chunk_size=settings.api.stream_chunk_size,
+                                 blob_store=blob_store,
+                                 dispatch=functools.partial(
+                                     _dispatch_index_task,
+                                     tracking_id=tracking_id,
+                                 ),
+                                 )
+    content_type = request.headers.get("content-type", "")
+    error = None
+    try:
+        if content_type.startswith("multipart/form-data"):
+            await ingest_multipart(request.stream(), content_type, dispatcher)
+        elif content_type.startswith(("application/x-ndjson",
+                                      "application/jsonl")):
+            await ingest_ndjson(request.stream(), dispatcher)
+        else:
+            raise HTTPException(status_code=415,
+                                detail=f"Unsupported media type: "
+                                       f"'{content_type}'")
+        await run_in_threadpool(dispatcher.finish)
+    except (ValueError, KeyError, binascii.Error) as exc:
+        error = f"Malformed request body: {exc}"
+    finally:
+        # also track the dispatched tasks of a failed or aborted request
+        await run_in_threadpool(dispatcher.abort)
+        group_result = await run_in_threadpool(_save_group,
+                                               job_id,
+                                               dispatcher.task_ids)
+
+    if group_result is None:
+        raise HTTPException(status_code=400,
+                            detail=error or "No images in request body")
+    return _group_to_job(group_result, tracking_id=tracking_id, error=error)
+
+
 @app.get("/index/{job_id}")
 def query_indexing_job_status(job_id: str,
                               request: Optional[Trackable] = None,
                               ) -> IndexingJob:
-    task_result = AsyncResult(job_id, app=celery_app)
     kwargs = {}
     if request:
         kwargs["tracking_id"] = request.tracking_id
+    group_result = GroupResult.restore(job_id, app=celery_app)
+    if group_result is not None:
+        return _group_to_job(group_result, **kwargs)
+
+    task_result = AsyncResult(job_id, app=celery_app)
     return IndexingJob(job_id=task_result.id,
                        status=task_result.status,
+                       **_count_images([task_result]),
                        **kwargs)
 
 
+@app.get("/ready")
+async def query_readiness() -> Readiness:
+    """
+    Report whether the model is loaded and the database connected; starts
+    loading them if that has not happened yet, or retries if it failed
+    """
+    initialization = _initialization
+    if initialization is None or not initialization.done():
+        _initialize()
+        raise HTTPException(status_code=503, detail="Loading model")
+    if _failed(initialization):
+        _initialize()
+        reason = ("cancelled" if initialization.cancelled()
+                  else initialization.exception())
+        raise HTTPException(status_code=503,
+                            detail=f"Initialization failed: {reason}")
+    return Readiness(status="ready")
+
+
 @app.post("/search")
-def search_images(request: SearchRequest,
-                  ) -> SearchResult:
-    candidates = database.query_similar(request.queries,
-                                        n_similar=request.n_similar,
-                                        )
-    return SearchResult(queries=request.queries,
-                        images=candidates,
-                        tracking_id=request.tracking_id)
+async def search_images(request: SearchRequest,
+                        ) -> SearchResult:
+    """
+    Search the candidates of each query. In lean mode, only IDs, scores and
+    texts are loaded, and images link to their thumbnails; in inline mode,
+    thumbnails are included. Further candidates are paged with `offset`.
+    """
+    _check_page(request.n_similar, request.offset)
+    inline = (request.mode or settings.api.result_mode) == "inline"
+    query_filter = _to_filter(request.filters)
+    shard_options = _shard_options(request.shards)
+    async_database = (await _services()).async_database
+    with telemetry.tracking(request.tracking_id, "search"):
+        candidates = await async_database.search(
+            request.queries,
+            n_similar=request.n_similar,
+            offset=request.offset,
+            score_threshold=request.score_threshold,
+            with_thumbnails=inline,
+            query_filter=query_filter,
+            **shard_options,
+        )
+    return _to_search_result(request.queries, candidates,
+                             n_similar=request.n_similar,
+                             offset=request.offset,
+                             inline=inline,
+                             tracking_id=request.tracking_id,
+                             )
+
+
+@app.post("/search/image")
+async def search_similar_images(
+        images: List[UploadFile] = File(default=[]),
+        ids: List[str] = Form(default=[]),
+        n_similar: int = Form(default=5),
+        offset: int = Form(default=0),
+        score_threshold: Optional[float] = Form(default=None),
+        mode: Optional[ResultMode] = Form(default=None),
+        filters: str = Form(default="[]"),
+        shards: List[str] = Form(default=[]),
+        tracking_id: Optional[str] = Form(default=None),
+) -> SearchResult:
+    """
+    Search the candidates of uploaded images and of images in the database,
+    given by their IDs, from a multipart/form-data body. Uploaded images are
+    embedded in one batch and searched with one request; images in the
+    database are searched by their stored vectors, without embedding them
+    again, and are no candidates of their own query. The queries of the
+    result are the file names of the uploads, followed by the IDs. `filters`
+    is a JSON list of the filters of /search, and `shards` selects the
+    shards to search like in /search.
+    """
+    _check_page(n_similar, offset)
+    if not images and not ids:
+        raise HTTPException(status_code=400,
+                            detail="No images or IDs to search")
+    try:
+        field_filters = _FIELD_FILTERS.validate_json(filters)
+        for point_id in ids:
+            uuid.UUID(point_id)
+    except ValueError as exc:
+        raise HTTPException(status_code=400,
+                            detail=f"Malformed request: {exc}")
+    query_filter = _to_filter(field_filters)
+    inline = (mode or settings.api.result_mode) == "inline"
+    kwargs = {
+        "n_similar": n_similar,
+        "offset": offset,
+        "score_threshold": score_threshold,
+        "with_thumbnails": inline,
+        "query_filter": query_filter,
+        **_shard_options(shards),
+    }
+    decoded_images = await run_in_threadpool(
+        _decode_images, [await image.read() for image in images],
+    )
+    async_database = (await _services()).async_database
+    missing_ids = set(ids) - await async_database.existing_ids(ids)
+    if missing_ids:
+        raise HTTPException(status_code=404,
+                            detail=f"Unknown images: {sorted(missing_ids)}")
+
+    searches = []
+    if decoded_images:
+        searches.append(async_database.search(decoded_images, **kwargs))
+    if ids:
+        searches.append(async_database.search_by_ids(ids, **kwargs))
+    with telemetry.tracking(tracking_id, "search_image"):
+        results = await asyncio.gather(*searches)
+    return _to_search_result(
+        [image.filename or "" for image in images] + ids,
+        [hits for candidates in results for hits in candidates],
+        n_similar=n_similar,
+        offset=offset,
+        inline=inline,
+        tracking_id=tracking_id,
+    )
+
+
+@app.get("/images/{image_id}")
+async def get_image(image_id: str,
+                    ) -> Response:
+    try:
+        uuid.UUID(image_id)
+    except ValueError:
+        raise HTTPException(status_code=404,
+                            detail=f"No image '{image_id}'")
+    async_database = (await _services()).async_database
+    thumbnail = await async_database.get_thumbnail(image_id)
+    if thumbnail is None:
+        raise HTTPException(status_code=404,
+                            detail=f"No thumbnail for image '{image_id}'")
+    return Response(content=thumbnail.data,
+                    media_type=thumbnail.media_type)
+
+
+@app.get("/cache/stats")
+async def query_cache_statistics() -> CacheStatistics:
+    services = await _services()
+    kwargs = {}
+    if services.embedding_cache is not None:
+        kwargs["embeddings"] = services.embedding_cache.stats()
+    if services.result_cache is not None:
+        kwargs["results"] = services.result_cache.stats()
+    return CacheStatistics(**kwargs)
+
+
+@app.get("/metrics")
+def query_metrics() -> Response:
+    """Export Prometheus metrics, if enabled"""
+    if not telemetry.is_enabled():
+        raise HTTPException(status_code=404, detail="Metrics are disabled")
+    content, media_type = telemetry.export()
+    return Response(content=content, media_type=media_type)
+
+
+def _initialize() -> asyncio.Future:
+    """
+    Start loading the model and connecting to the database in a worker
+    thread, unless that is in progress or done already; a failed
+    initialization is retried
+    :return: future of the initialized components
+    """
+    global _initialization
+    if _initialization is None or _failed(_initialization):
+        _initialization = asyncio.ensure_future(
+            asyncio.to_thread(_load_services),
+        )
+    return _initialization
+
+
+def _failed(future: asyncio.Future,
+            ) -> bool:
+    """
+    Check whether a future is done without a result
+    :param future: future
+    :return: True if the future raised an exception or was cancelled
+    """
+    return future.done() and (future.cancelled()
+                              or future.exception() is not None)
+
+
+async def _services() -> Any:
+    """
+    Wait for the initialization of the components
+    :return: initialization module, whose components are created
+    """
+    return await asyncio.shield(_initialize())
+
+
+def _load_services() -> Any:
+    """
+    Import and create the components of the search endpoints. Importing
+    them is deferred, since it imports torch and transformers.
+    :return: initialization module, whose components are created
+    """
+    from image_search.app import initialize
+
+    initialize.async_database  # creates the embedder and database, too
+    return initialize
+
+
+def _shard_options(shards: Optional[List[str]],
+                   ) -> Dict[str, Any]:
+    """
+    Validate the shards selected by a search request
+    :param shards: names of the shards to search (all if not set)
+    :return: keyword arguments of the search selecting the shards
+    """
+    if not shards:
+        return {}
+    unknown_shards = set(shards) - set(settings.database.shards)
+    if unknown_shards:
+        raise HTTPException(status_code=400,
+                            detail=f"Unknown shards: "
+                                   f"{sorted(unknown_shards)}")
+    return {"shards": shards}
+
+
+def _check_page(n_similar: int,
+                offset: int,
+                ) -> None:
+    """
+    Validate the page of candidates of a search request
+    :param n_similar: number of candidates per query
+    :param offset: number of best candidates to skip
+    """
+    if not 0 < n_similar <= settings.api.max_results:
+        raise HTTPException(status_code=400,
+                            detail=f"n_similar must be between 1 and "
+                                   f"{settings.api.max_results}")
+    if offset < 0:
+        raise HTTPException(status_code=400,
+                            detail="offset must not be negative")
+
+
+def _decode_images(data: List[bytes],
+                   ) -> List[Image.Image]:
+    """
+    Decode uploaded query images; JPEGs are decoded at a reduced scale that
+    keeps them larger than the model's input, like indexed images
+    :param data: encoded images
+    :return: RGB images
+    """
+    images = []
+    for image_data in data:
+        try:
+            image = Image.open(io.BytesIO(image_data))
+            if settings.worker.draft_size:
+                image.draft("RGB", (settings.worker.draft_size,
+                                    settings.worker.draft_size))
+            images.append(image.convert("RGB"))
+        except (OSError, Image.DecompressionBombError) as exc:
+            raise HTTPException(status_code=400,
+                                detail=f"Cannot decode image: {exc}")
+    return images
+
+
+def _to_search_result(queries: List[str],
+                      candidates: List[List[Any]],
+                      n_similar: int,
+                      offset: int,
+                      inline: bool,
+                      tracking_id: Optional[str] = None,
+                      ) -> SearchResult:
+    """
+    Convert the hits of the database to a response
+    :param queries: queries of the request
+    :param candidates: hits per query
+    :param n_similar: requested number of candidates per query
+    :param offset: number of skipped candidates
+    :param inline: keep the thumbnails of images, or link to them otherwise
+    :param tracking_id: tracking ID of the request (optional)
+    :return: response
+    """
+    return SearchResult(
+        queries=queries,
+        results=[[_to_search_hit(hit, inline) for hit in hits]
+                 for hits in candidates],
+        next_offsets=[offset + len(hits) if len(hits) == n_similar else None
+                      for hits in candidates],
+        tracking_id=tracking_id,
+    )
+
+
+def _to_search_hit(hit: Any,
+                   inline: bool,
+                   ) -> SearchHit:
+    """
+    Convert a hit of the database to a response item
+    :param hit: hit of the database
+    :param inline: keep the thumbnail of images, or link to them otherwise
+    :return: response item
+    """
+    thumbnail = hit.thumbnail
+    if hit.text is None and not inline:
+        thumbnail = _THUMBNAIL_URL.format(id=hit.id)
+    return SearchHit(id=hit.id,
+                     score=hit.score,
+                     text=hit.text,
+                     thumbnail=thumbnail,
+                     )
+
+
+def _to_filter(filters: List[FieldFilter],
+               ) -> Optional[Filter]:
+    """
+    Convert the filters of a search request into a filter on the metadata
+    in the payloads, which the database applies during the search
+    :param filters: conditions that all candidates meet
+    :return: filter or None if there are no conditions
+    """
+    from image_search.core.database import METADATA_KEY
+
+    conditions = []
+    for field_filter in filters:
+        key = f"{METADATA_KEY}.{field_filter.field}"
+        bounds = {name: getattr(field_filter, name)
+                  for name in ("gt", "gte", "lt", "lte")
+                  if getattr(field_filter, name) is not None}
+        if field_filter.value is not None:
+            conditions.append(FieldCondition(
+                key=key, match=MatchValue(value=field_filter.value),
+            ))
+        if field_filter.values is not None:
+            conditions.append(FieldCondition(
+                key=key, match=MatchAny(any=field_filter.values),
+            ))
+        if bounds:
+            conditions.append(FieldCondition(key=key, range=Range(**bounds)))
+        if field_filter.value is None and field_filter.values is None \
+                and not bounds:
+            raise HTTPException(status_code=400,
+                                detail=f"Filter of field "
+                                       f"'{field_filter.field}' has no "
+                                       f"condition")
+    return Filter(must=conditions) if conditions else None
+
+
+def _dispatch_index_task(image_hashes: List[str],
+                         task_id: str,
+                         tracking_id: Optional[str] = None,
+                         ) -> None:
+    index_task.apply_async((image_hashes,),
+                           {"tracking_id": tracking_id},
+                           task_id=task_id,
+                           )
+
+
+def _save_group(job_id: str,
+                task_ids: List[str],
+                ) -> Optional[GroupResult]:
+    """
+    Save the tasks of a streamed job, so that they can be tracked together
+    :param job_id: ID of the job
+    :param task_ids: IDs of the job's tasks
+    :return: results of the job's tasks or None if there are no tasks
+    """
+    if not task_ids:
+        return None
+    task_results = [AsyncResult(task_id, app=celery_app)
+                    for task_id in task_ids]
+    group_result = GroupResult(job_id, task_results, app=celery_app)
+    group_result.save()
+    return group_result
+
+
+def _group_to_job(group_result: GroupResult,
+                  **kwargs,
+                  ) -> IndexingJob:
+    """
+    Summarize the tasks of a streamed job
+    :param group_result: results of the job's tasks
+    :param kwargs: further job information, e.g., the tracking ID
+    :return: job information with aggregate status and progress
+    """
+    if group_result.failed():
+        status = states.FAILURE
+    elif group_result.successful():
+        status = states.SUCCESS
+    elif group_result.completed_count() > 0:
+        status = states.STARTED
+    else:
+        status = states.PENDING
+    return IndexingJob(job_id=group_result.id,
+                       status=status,
+                       completed_tasks=group_result.completed_count(),
+                       total_tasks=len(group_result.results),
+                       **_count_images(group_result.results),
+                       **kwargs)
+
+
+def _count_images(task_results: List[AsyncResult],
+                  ) -> Dict[str, int]:
+    """
+    Sum up the image counts reported by finished indexing tasks
+    :param task_results: results of the job's tasks
+    :return: numbers of new, skipped and failed images, if any task
+             finished
+    """
+    counts = [task_result.result for task_result in task_results
+              if task_result.successful()
+              and isinstance(task_result.result, dict)]
+    if not counts:
+        return {}
+    return {
+        "new_images": sum(count.get("new", 0) for count in counts),
+        "skipped_images": sum(count.get("skipped", 0) for count in counts),
+        "failed_images": sum(count.get("failed", 0) for count in counts),
+    }
@@ -15,6 +15,10 @@ def add_commands(parser: ArgumentParser,
 def add_database_args(parser: ArgumentParser,
                       ) -> ArgumentParser:
     group = parser.add_argument_group("Vector database options")
+    group.add_argument("--backend",
+                       choices=["qdrant", "local"],
+                       default="qdrant",
+                       help="Qdrant server or in-process local index")
     group.add_argument("--database-url",
                        type=str,
                        default="localhost:6333",
@@ -23,6 +27,10 @@ def add_database_args(parser: ArgumentParser,
                        type=str,
                        default="default",
                        help="Qdrant collection name")
+    group.add_argument("--local-path",
+                       type=str,
+                       default="/tmp/image-search/index",
+                       help="Directory of local index")
     return parser
 
 
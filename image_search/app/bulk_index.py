@@ -0,0 +1,494 @@
+"""
+Index images from a directory or a manifest file offline, i.e., without the
+API and the task queue. The images are split into one shard per process;
+each process runs an indexing pipeline and checkpoints its progress, so
+that an interrupted run resumes where it stopped.
+"""
+from argparse import ArgumentParser
+import contextlib
+import functools
+import hashlib
+import io
+import json
+import logging
+import multiprocessing
+import os
+import tempfile
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+from PIL import Image
+
+from image_search.app.arguments import add_database_args, add_embedding_args
+from image_search.app.config import settings
+from image_search.core.hashing import content_id
+
+IMAGE_EXTENSIONS = (".bmp", ".gif", ".jpeg", ".jpg", ".png", ".tif", ".tiff",
+                    ".webp")
+
+logger = logging.getLogger(__name__)
+
+Progress = Callable[[int, int, int], None]
+
+
+class Checkpoint:
+    """
+    Number of finished images of a shard, saved in a JSON file. The
+    checkpoint only applies to the same images in the same order; it is
+    ignored if the images of the shard changed.
+    """
+
+    def __init__(self,
+                 path: str,
+                 sources: Sequence[str],
+                 ):
+        """
+        :param path: checkpoint file
+        :param sources: images of the shard
+        """
+        self._path = path
+        self._fingerprint = hashlib.sha256(
+            "\n".join(sources).encode("utf-8"),
+        ).hexdigest()
+
+    def load(self) -> int:
+        """
+        :return: number of finished images, 0 if there is no checkpoint
+        """
+        if not os.path.exists(self._path):
+            return 0
+        with open(self._path) as fh:
+            checkpoint = json.load(fh)
+        if checkpoint["fingerprint"] != self._fingerprint:
+            logger.warning("Ignoring checkpoint '%s' of other images",
+                           self._path)
+            return 0
+        return checkpoint["done"]
+
+    def save(self,
+             n_done: int,
+             ) -> None:
+        """
+        Atomically replace the checkpoint
+        :param n_done: number of finished images
+        """
+        directory = os.path.dirname(self._path) or "."
+        with tempfile.NamedTemporaryFile("w",
+                                         dir=directory,
+                                         suffix=".tmp",
+                                         delete=False,
+                                         ) as fh:
+            json.dump({"fingerprint": self._fingerprint, "done": n_done}, fh)
+        os.replace(fh.name, self._path)
+
+
+def list_images(directory: Optional[str] = None,
+                manifest: Optional[str] = None,
+                ) -> List[str]:
+    """
+    List the images to index in a stable order, so that shards and
+    checkpoints stay valid across runs
+    :param directory: directory to crawl recursively for image files
+    :param manifest: file with one image path per line, used instead of
+                     the directory if set
+    :return: image paths
+    """
+    if manifest:
+        with open(manifest) as fh:
+            return [line.strip() for line in fh if line.strip()]
+    paths = []
+    for root, dirs, files in os.walk(directory):
+        dirs.sort()
+        paths += [os.path.join(root, name)
+                  for name in sorted(files)
+                  if name.lower().endswith(IMAGE_EXTENSIONS)]
+    return paths
+
+
+def load_image(path: str,
+               draft_size: int = 0,
+               ) -> Tuple[str, Image.Image]:
+    """
+    Decode an image and derive its point ID like the index task does, so
+    that images indexed either way are not stored twice
+    :param path: image file
+    :param draft_size: decode JPEGs at a reduced scale, as long as width
+                       and height stay at least this large (0 for full size)
+    :return: point ID and decoded image
+    """
+    with open(path, "rb") as fh:
+        data = fh.read()
+    image = Image.open(io.BytesIO(data))
+    if draft_size:
+        image.draft(None, (draft_size, draft_size))
+    image.load()
+    return content_id(data), image
+
+
+def parse_metadata(fields: Optional[Sequence[str]],
+                   ) -> Dict[str, Any]:
+    """
+    :param fields: metadata fields as "FIELD=VALUE", whose values are
+                   parsed as JSON if possible, e.g., numbers
+    :return: metadata
+    """
+    metadata = {}
+    for field in fields or []:
+        name, separator, value = field.partition("=")
+        if not name or not separator:
+            raise ValueError(f"Expected FIELD=VALUE, got '{field}'")
+        try:
+            metadata[name] = json.loads(value)
+        except json.JSONDecodeError:
+            metadata[name] = value
+    return metadata
+
+
+def index_shard(pipeline: Any,
+                sources: Sequence[str],
+                checkpoint: Checkpoint,
+                load: Callable[[str], Tuple[str, Image.Image]],
+                chunk_size: int = 1024,
+                progress: Optional[Progress] = None,
+                metadata: Optional[Dict[str, Any]] = None,
+                ) -> Dict[str, int]:
+    """
+    Index the images of a shard in chunks, saving a checkpoint after each
+    chunk; images before the checkpoint are skipped
+    :param pipeline: indexing pipeline
+    :param sources: image paths of the shard
+    :param checkpoint: checkpoint of the shard
+    :param load: function loading an image and its point ID
+    :param chunk_size: number of images per checkpoint
+    :param progress: function called with the numbers of processed, new
+                     and failed images after each chunk (optional)
+    :param metadata: metadata fields of all images, e.g., the partition
+                     field of sharded databases (optional)
+    :return: numbers of resumed, processed, new and failed images
+    """
+    counts = {"resumed": checkpoint.load(), "images": 0, "new": 0,
+              "failed": 0}
+    for start in range(counts["resumed"], len(sources), chunk_size):
+        chunk = sources[start:start + chunk_size]
+        report = pipeline.run(chunk, load,
+                              dict.fromkeys(chunk, metadata)
+                              if metadata else None)
+        checkpoint.save(start + len(chunk))
+        counts["images"] += len(chunk)
+        counts["new"] += report.n_new
+        counts["failed"] += report.n_failed
+        if progress is not None:
+            progress(len(chunk), report.n_new, report.n_failed)
+    return counts
+
+
+def create_components(args) -> Tuple[Any, Any]:
+    """
+    Create the embedder and the database of a process, which is
+    partitioned into the configured shards, if any; options that are not
+    command line arguments are taken from the settings
+    :return: embedder and database
+    """
+    from image_search.app import initialize
+
+    embed = initialize.create_embedder(
+        args.model,
+        str(args.device),
+        num_threads=args.num_threads or None,
+        fast_preprocessing=settings.embedding.fast_preprocessing,
+        precision=settings.embedding.precision,
+        backend=settings.embedding.backend,
+        onnx_path=settings.embedding.onnx_path,
+        normalize=settings.embedding.normalize,
+        snapshot_path=settings.embedding.snapshot_path,
+    )
+    # invalidates shared cached search results of the API, if any
+    result_cache = initialize.result_cache
+    embedding_store = initialize.create_embedding_store(
+        settings.embedding.store_path,
+        args.model,
+        embed,
+        settings.embedding.precision,
+        settings.embedding.normalize,
+    )
+
+    def create_backend(collection_name: str,
+                       url: str,
+                       local_path: str,
+                       result_cache: Any,
+                       ) -> Any:
+        if args.backend == "local":
+            return initialize.create_local_database(
+                embed,
+                local_path,
+                settings.database.local_dtype,
+                settings.database.ivf_lists,
+                settings.database.ivf_probes,
+                result_cache,
+                embedding_store=embedding_store,
+                **initialize.thumbnail_options,
+            )
+        return initialize.create_database(
+            embed,
+            url,
+            collection_name,
+            result_cache,
+            settings.database.prefer_grpc,
+            settings.database.grpc_port,
+            storage=initialize.vector_storage,
+            indexed_fields=settings.database.indexed_fields,
+            embedding_store=embedding_store,
+            **initialize.thumbnail_options,
+        )
+
+    database = initialize.create_partitioned_database(
+        create_backend,
+        embed,
+        args.collection,
+        args.database_url,
+        args.local_path,
+        result_cache,
+        settings.database.shards,
+        settings.database.shard_urls,
+        settings.database.shard_timeout,
+        settings.database.partition_field,
+    )
+    return embed, database
+
+
+def run(args) -> Dict[str, float]:
+    """
+    Index all images with one shard per process. The first shard runs in
+    this process, which also creates the collection before the other
+    processes start.
+    :return: numbers of processed, new and failed images, and throughput
+    """
+    sources = list_images(args.directory, args.manifest)
+    os.makedirs(args.checkpoint_dir, exist_ok=True)
+    logger.info("Indexing %d images in %d processes",
+                len(sources), args.processes)
+    reporter = _ProgressReporter(args.report_interval)
+    embed, database = create_components(args)
+    bulk_load = getattr(database, "bulk_load", contextlib.nullcontext)
+
+    context = multiprocessing.get_context("spawn")
+    updates = context.Queue()
+    workers = [
+        context.Process(target=_run_worker,
+                        args=(args, shard, sources[shard::args.processes],
+                              updates),
+                        name=f"bulk-index-{shard}",
+                        )
+        for shard in range(1, args.processes)
+    ]
+    receiver = threading.Thread(target=_receive_updates,
+                                args=(updates, reporter),
+                                daemon=True,
+                                )
+    with bulk_load():
+        receiver.start()
+        for worker in workers:
+            worker.start()
+        try:
+            _index_shard(args, embed, database, 0,
+                         sources[::args.processes], reporter.update)
+        except BaseException:
+            for worker in workers:
+                worker.terminate()
+            raise
+        finally:
+            for worker in workers:
+                worker.join()
+            updates.put(None)
+            receiver.join()
+
+    failed = [worker.name for worker in workers if worker.exitcode != 0]
+    if failed:
+        raise RuntimeError(f"Indexing failed in {', '.join(failed)}; run "
+                           f"again to resume")
+    return reporter.finish()
+
+
+class _ProgressReporter:
+    """Log the number of processed images and the throughput of all shards"""
+
+    def __init__(self,
+                 interval: float,
+                 ):
+        """
+        :param interval: minimum seconds between two reports
+        """
+        self._interval = interval
+        self._lock = threading.Lock()
+        self._start = self._last_report = time.perf_counter()
+        self._counts = {"images": 0, "new": 0, "failed": 0}
+
+    def update(self,
+               n_images: int,
+               n_new: int,
+               n_failed: int,
+               ) -> None:
+        """
+        Count processed images and report if the interval elapsed
+        :param n_images: number of processed images
+        :param n_new: number of new images among them
+        :param n_failed: number of images that could not be loaded
+        """
+        with self._lock:
+            self._counts["images"] += n_images
+            self._counts["new"] += n_new
+            self._counts["failed"] += n_failed
+            now = time.perf_counter()
+            if now - self._last_report >= self._interval:
+                self._last_report = now
+                self._report(now)
+
+    def finish(self) -> Dict[str, float]:
+        """
+        Report the final counts
+        :return: numbers of processed, new and failed images, and throughput
+        """
+        with self._lock:
+            return self._report(time.perf_counter())
+
+    def _report(self,
+                now: float,
+                ) -> Dict[str, float]:
+        seconds = now - self._start
+        result = {**self._counts,
+                  "images_per_second": self._counts["images"] / seconds}
+        logger.info("%d images processed (%d new, %d failed), "
+                    "%.1f images/s",
+                    result["images"], result["new"], result["failed"],
+                    result["images_per_second"])
+        return result
+
+
+def _index_shard(args,
+                 embed: Any,
+                 database: Any,
+                 shard: int,
+                 sources: Sequence[str],
+                 progress: Progress,
+                 ) -> None:
+    """
+    Index a shard with the settings of the index task
+    :param shard: index of shard
+    :param sources: image paths of the shard
+    :param progress: function receiving the progress of the shard
+    """
+    from image_search.core.pipeline import IndexingPipeline
+
+    pipeline = IndexingPipeline(
+        embed,
+        database,
+        load_workers=args.load_workers,
+        batch_size=args.batch_size,
+        queue_size=settings.worker.queue_size,
+        near_duplicates=settings.worker.deduplication == "perceptual",
+        on_error=_log_error,
+    )
+    load = functools.partial(load_image,
+                             draft_size=settings.worker.draft_size,
+                             )
+    checkpoint = Checkpoint(
+        os.path.join(args.checkpoint_dir,
+                     f"shard-{shard}-of-{args.processes}.json"),
+        sources,
+    )
+    counts = index_shard(pipeline, sources, checkpoint, load,
+                         chunk_size=args.chunk_size,
+                         progress=progress,
+                         metadata=args.metadata,
+                         )
+    logger.info("Shard %d finished: %d images resumed from checkpoint, %d "
+                "processed", shard, counts["resumed"], counts["images"])
+
+
+def _run_worker(args,
+                shard: int,
+                sources: Sequence[str],
+                updates: Any,
+                ) -> None:
+    """Index a shard in a worker process"""
+    logging.basicConfig(level=logging.INFO,
+                        format="%(asctime)s %(processName)s %(message)s")
+    embed, database = create_components(args)
+    _index_shard(args, embed, database, shard, sources,
+                 lambda *counts: updates.put(counts))
+
+
+def _receive_updates(updates: Any,
+                     reporter: _ProgressReporter,
+                     ) -> None:
+    """Pass the progress of worker processes to the reporter until None"""
+    while (counts := updates.get()) is not None:
+        reporter.update(*counts)
+
+
+def _log_error(source: str,
+               exc: Exception,
+               ) -> None:
+    logger.warning("Skipping '%s': %s", source, exc)
+
+
+def main():
+    parser = ArgumentParser(description=__doc__)
+    sources = parser.add_mutually_exclusive_group(required=True)
+    sources.add_argument("--directory",
+                         help="Directory to crawl recursively for images")
+    sources.add_argument("--manifest",
+                         help="File with one image path per line")
+    parser.add_argument("--checkpoint-dir",
+                        required=True,
+                        help="Directory of checkpoints; a run with the same "
+                             "images and processes resumes from them")
+    parser.add_argument("--processes",
+                        type=int,
+                        default=1,
+                        help="Number of processes, each with its own model")
+    parser.add_argument("--num-threads",
+                        type=int,
+                        default=0,
+                        help="Intra-op threads per process (CPU cores per "
+                             "process if 0)")
+    parser.add_argument("--load-workers",
+                        type=int,
+                        default=settings.worker.load_workers,
+                        help="Threads decoding images per process")
+    parser.add_argument("--batch-size",
+                        type=int,
+                        default=settings.worker.batch_size,
+                        help="Images per embedding call and upsert")
+    parser.add_argument("--chunk-size",
+                        type=int,
+                        default=1024,
+                        help="Images per checkpoint")
+    parser.add_argument("--metadata",
+                        action="append",
+                        metavar="FIELD=VALUE",
+                        help="Metadata field of all images, e.g., the "
+                             "partition field of sharded databases like "
+                             "year=2024; may be repeated")
+    parser.add_argument("--report-interval",
+                        type=float,
+                        default=10.0,
+                        help="Seconds between progress reports")
+    add_embedding_args(parser)
+    add_database_args(parser)
+    args = parser.parse_args()
+    try:
+        args.metadata = parse_metadata(args.metadata)
+    except ValueError as exc:
+        parser.error(str(exc))
+    if not args.num_threads:
+        args.num_threads = max(1, (os.cpu_count() or 1) // args.processes)
+
+    logging.basicConfig(level=logging.INFO,
+                        format="%(asctime)s %(processName)s %(message)s")
+    run(args)
+
+
+if __name__ == "__main__":
+    main()
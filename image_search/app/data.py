@@ -1,7 +1,12 @@
 """Data transfer objects"""
-from typing import List, Optional
+import base64
+import binascii
+from typing import Any, Dict, List, Literal, Optional
 
-from pydantic import BaseModel
+from pydantic import BaseModel, model_validator
+
+# "lean": IDs, scores and links to thumbnails; "inline": base64 thumbnails
+ResultMode = Literal["lean", "inline"]
 
 
 class Trackable(BaseModel):
@@ -10,24 +15,54 @@ class Trackable(BaseModel):
     tracking_id: Optional[str] = None
 
 
+class FieldFilter(BaseModel):
+    """Condition on a metadata field of candidates"""
+
+    field: str  # name of metadata field, e.g., "source"
+    value: Optional[str | int | bool] = None  # equal to this value
+    values: Optional[List[str | int]] = None  # equal to one of these values
+    gt: Optional[float] = None  # greater than this number
+    gte: Optional[float] = None  # greater than or equal to this number
+    lt: Optional[float] = None  # less than this number
+    lte: Optional[float] = None  # less than or equal to this number
+
+
 class SearchRequest(Trackable):
     """Search request body"""
 
     queries: List[str]  # user queries
     n_similar: int = 5  # number of candidate images per query
+    offset: int = 0  # candidates to skip, e.g., next_offset of previous page
+    score_threshold: Optional[float] = None  # minimum score of candidates
+    mode: Optional[ResultMode] = None  # default from settings if not set
+    filters: List[FieldFilter] = []  # conditions met by all candidates
+    shards: Optional[List[str]] = None  # shards to search, all if not set
+
+
+class SearchHit(BaseModel):
+    """Candidate of a query"""
+
+    id: str  # ID of the candidate's point
+    score: float  # similarity to the query
+    text: Optional[str] = None  # text of text candidates
+    thumbnail: Optional[str] = None  # link to thumbnail, or base64 if inline
 
 
 class SearchResult(Trackable):
     """Search result body"""
 
     queries: List[str]  # user queries
-    images: List[List[str]]  # resulting images
+    results: List[List[SearchHit]]  # candidates per query, best first
+    next_offsets: List[Optional[int]]  # offset of next page, None if last
 
 
 class IndexRequest(Trackable):
     """Index request object"""
 
     images: List[str]  # base64 encoded image data
+    # metadata fields per image to filter searches by, e.g., {"source": "x",
+    # "created": 1700000000}; not updated for already indexed images
+    metadata: Optional[List[Optional[Dict[str, Any]]]] = None
 
 
 class IndexingJob(Trackable):
@@ -35,3 +70,63 @@ class IndexingJob(Trackable):
 
     job_id: str
     status: str
+    completed_tasks: Optional[int] = None  # finished tasks of streamed jobs
+    total_tasks: Optional[int] = None  # number of tasks of streamed jobs
+    new_images: Optional[int] = None  # indexed images of finished tasks
+    skipped_images: Optional[int] = None  # already indexed or duplicate
+    failed_images: Optional[int] = None  # images that could not be loaded
+    error: Optional[str] = None  # why a streamed job is incomplete
+
+
+class CacheStatistics(BaseModel):
+    """Cache statistics, e.g., hit and miss counts"""
+
+    embeddings: Optional[Dict[str, Any]] = None  # text embedding cache
+    results: Optional[Dict[str, Any]] = None  # search result cache
+
+
+class Readiness(BaseModel):
+    """Readiness of the API to serve search requests"""
+
+    status: str  # "ready"
+
+
+class EmbeddingInput(BaseModel):
+    """Text or image to embed with the embedding server"""
+
+    text: Optional[str] = None
+    image: Optional[str] = None  # base64 encoded RGB pixels
+    width: Optional[int] = None  # image width
+    height: Optional[int] = None  # image height
+
+    @model_validator(mode="after")
+    def check_input(self) -> "EmbeddingInput":
+        """Require either a text or an image whose size matches its pixels"""
+        if (self.text is None) == (self.image is None):
+            raise ValueError("Expected either a text or an image")
+        if self.image is None:
+            return self
+        if (self.width or 0) <= 0 or (self.height or 0) <= 0:
+            raise ValueError("Expected the positive width and height of the "
+                             "image")
+        try:
+            n_bytes = len(base64.b64decode(self.image, validate=True))
+        except binascii.Error as exc:
+            raise ValueError(f"Invalid base64 image: {exc}") from exc
+        if n_bytes != self.width * self.height * 3:
+            raise ValueError(f"Expected {self.width}x{self.height} RGB "
+                             f"pixels, got {n_bytes} bytes")
+        return self
+
+
+class EmbeddingRequest(BaseModel):
+    """Embedding server request body"""
+
+    inputs: List[EmbeddingInput]
+
+
+class EmbedderInfo(BaseModel):
+    """Properties of the embedding server's model"""
+
+    distance: str
+    embedding_dim: int
@@ -0,0 +1,59 @@
+"""Embedding server hosting a single model for the API and the workers"""
+import asyncio
+from contextlib import asynccontextmanager
+
+from fastapi import FastAPI, HTTPException, Response
+
+from image_search.app import initialize
+from image_search.app.config import settings
+from image_search.app.data import EmbedderInfo, EmbeddingRequest
+from image_search.core import telemetry
+from image_search.core.remote import (EMBEDDINGS_MEDIA_TYPE, decode_image,
+                                      encode_embeddings)
+
+
+@asynccontextmanager
+async def lifespan(_: FastAPI):
+    # load the model before serving
+    await asyncio.to_thread(getattr, initialize, "local_embedder")
+    yield
+
+
+app = FastAPI(lifespan=lifespan)
+
+if settings.metrics.enabled:
+    telemetry.enable(tracing=settings.metrics.tracing)
+
+
+@app.get("/info")
+def query_info() -> EmbedderInfo:
+    embed = initialize.local_embedder
+    return EmbedderInfo(distance=embed.distance,
+                        embedding_dim=embed.embedding_dim,
+                        )
+
+
+@app.post("/embed")
+def embed_objects(request: EmbeddingRequest,
+                  ) -> Response:
+    """
+    Embed texts and images. Concurrent requests are processed in threads,
+    whose inputs are batched dynamically if enabled.
+    :return: float32 embeddings (inputs × dimension) in NumPy format
+    """
+    objs = [item.text if item.text is not None
+            else decode_image(item.model_dump())
+            for item in request.inputs]
+    embeddings = initialize.local_embedder(objs)
+    return Response(content=encode_embeddings(embeddings),
+                    media_type=EMBEDDINGS_MEDIA_TYPE,
+                    )
+
+
+@app.get("/metrics")
+def query_metrics() -> Response:
+    """Export Prometheus metrics, if enabled"""
+    if not telemetry.is_enabled():
+        raise HTTPException(status_code=404, detail="Metrics are disabled")
+    content, media_type = telemetry.export()
+    return Response(content=content, media_type=media_type)
@@ -0,0 +1,236 @@
+"""Streaming ingestion of images for indexing"""
+import base64
+import json
+from typing import AsyncIterable, AsyncIterator, Callable, List, Optional
+
+from fastapi.concurrency import run_in_threadpool
+from multipart.multipart import MultipartParser, parse_options_header
+
+from image_search.core.storage import BlobStore, BlobWriter
+
+Dispatch = Callable[[List[str], str], None]
+
+
+class ChunkDispatcher:
+    """
+    Group staged images of one job into chunks and dispatch each chunk as a
+    task as soon as it is complete. Task IDs are derived from the job ID, and
+    the images of a chunk are staged with the chunk's task ID as owner.
+    Staging and dispatching block, so they are called from a thread pool
+    while ingesting a request.
+    """
+
+    def __init__(self,
+                 job_id: str,
+                 chunk_size: int,
+                 blob_store: BlobStore,
+                 dispatch: Dispatch,
+                 ):
+        """
+        :param job_id: ID of the job
+        :param chunk_size: number of images per task
+        :param blob_store: store for staged images
+        :param dispatch: function dispatching a task for image hashes with a
+                         given task ID
+        """
+        self._job_id = job_id
+        self._chunk_size = chunk_size
+        self._blob_store = blob_store
+        self._dispatch = dispatch
+        self._image_hashes: List[str] = []
+        self._task_ids: List[str] = []
+
+    @property
+    def task_id(self) -> str:
+        """
+        :return: ID of the task of the current chunk
+        """
+        return f"{self._job_id}.{len(self._task_ids)}"
+
+    @property
+    def task_ids(self) -> List[str]:
+        """
+        :return: IDs of the dispatched tasks
+        """
+        return list(self._task_ids)
+
+    def stage(self,
+              image: bytes,
+              ) -> None:
+        """
+        Stage an image that is completely in memory
+        :param image: encoded image data
+        """
+        self.add(self._blob_store.put(image, owner=self.task_id))
+
+    def writer(self) -> BlobWriter:
+        """
+        :return: writer to stage an image incrementally; its hash has to be
+                 added after closing it
+        """
+        return self._blob_store.writer(owner=self.task_id)
+
+    def add(self,
+            image_hash: str,
+            ) -> None:
+        """
+        Add a staged image to the current chunk
+        :param image_hash: hash of staged image
+        """
+        self._image_hashes.append(image_hash)
+        if len(self._image_hashes) >= self._chunk_size:
+            self.flush()
+
+    def flush(self) -> None:
+        """Dispatch the current chunk, unless it is empty"""
+        if not self._image_hashes:
+            return
+        self._dispatch(self._image_hashes, self.task_id)
+        self._task_ids.append(self.task_id)
+        self._image_hashes = []
+
+    def finish(self) -> List[str]:
+        """
+        Dispatch the last chunk
+        :return: IDs of all dispatched tasks
+        """
+        self.flush()
+        return self.task_ids
+
+    def abort(self) -> None:
+        """Release the staged images of the current chunk, which is dropped"""
+        self._blob_store.release(self.task_id)
+        self._image_hashes = []
+
+
+async def ingest_ndjson(stream: AsyncIterable[bytes],
+                        dispatcher: ChunkDispatcher,
+                        ) -> None:
+    """
+    Stage images from newline-delimited JSON, one object with a base64
+    encoded "image" per line
+    :param stream: request body
+    :param dispatcher: chunk dispatcher of job
+    """
+    async for line in _iter_lines(stream):
+        if line.strip():
+            record = json.loads(line)
+            await run_in_threadpool(dispatcher.stage,
+                                    base64.b64decode(record["image"]))
+
+
+async def ingest_multipart(stream: AsyncIterable[bytes],
+                           content_type: str,
+                           dispatcher: ChunkDispatcher,
+                           ) -> None:
+    """
+    Stage images from the file parts of a multipart/form-data body; other
+    form fields are ignored. The image of a part that is not complete, e.g.,
+    when the body is malformed, is discarded.
+    :param stream: request body
+    :param content_type: content type header including the boundary
+    :param dispatcher: chunk dispatcher of job
+    """
+    _, options = parse_options_header(content_type)
+    boundary = options.get(b"boundary")
+    if not boundary:
+        raise ValueError("Missing boundary in multipart content type")
+
+    parser = _MultipartImageParser(boundary, dispatcher)
+    try:
+        async for chunk in stream:
+            await run_in_threadpool(parser.write, chunk)
+        await run_in_threadpool(parser.finalize)
+    finally:
+        parser.abort()
+
+
+class _MultipartImageParser:
+    """Push parser staging file parts of multipart bodies as they arrive"""
+
+    def __init__(self,
+                 boundary: bytes,
+                 dispatcher: ChunkDispatcher,
+                 ):
+        """
+        :param boundary: multipart boundary
+        :param dispatcher: chunk dispatcher of job
+        """
+        self._dispatcher = dispatcher
+        self._header_field = b""
+        self._header_value = b""
+        self._headers: dict[bytes, bytes] = {}
+        self._writer: Optional[BlobWriter] = None
+        callbacks = {
+            "on_part_begin": self._on_part_begin,
+            "on_header_field": self._on_header_field,
+            "on_header_value": self._on_header_value,
+            "on_header_end": self._on_header_end,
+            "on_headers_finished": self._on_headers_finished,
+            "on_part_data": self._on_part_data,
+            "on_part_end": self._on_part_end,
+        }
+        self._parser = MultipartParser(boundary, callbacks)
+
+    def write(self,
+              chunk: bytes,
+              ) -> None:
+        self._parser.write(chunk)
+
+    def finalize(self) -> None:
+        self._parser.finalize()
+        self.abort()  # truncated body
+
+    def abort(self) -> None:
+        """Discard the image of the current part, if any"""
+        if self._writer is not None:
+            self._writer.abort()
+            self._writer = None
+
+    def _on_part_begin(self) -> None:
+        self._headers = {}
+
+    def _on_header_field(self, data: bytes, start: int, end: int) -> None:
+        self._header_field += data[start:end]
+
+    def _on_header_value(self, data: bytes, start: int, end: int) -> None:
+        self._header_value += data[start:end]
+
+    def _on_header_end(self) -> None:
+        self._headers[self._header_field.lower()] = self._header_value
+        self._header_field = b""
+        self._header_value = b""
+
+    def _on_headers_finished(self) -> None:
+        disposition = self._headers.get(b"content-disposition", b"")
+        _, options = parse_options_header(disposition)
+        if b"filename" in options:
+            self._writer = self._dispatcher.writer()
+
+    def _on_part_data(self, data: bytes, start: int, end: int) -> None:
+        if self._writer is not None:
+            self._writer.write(data[start:end])
+
+    def _on_part_end(self) -> None:
+        if self._writer is not None:
+            self._dispatcher.add(self._writer.close())
+            self._writer = None
+
+
+async def _iter_lines(stream: AsyncIterable[bytes],
+                      ) -> AsyncIterator[bytes]:
+    """
+    Split a byte stream into lines, holding at most one line in memory
+    :param stream: byte stream
+    :return: lines without line breaks
+    """
+    buffer = bytearray()
+    async for chunk in stream:
+        start = len(buffer)
+        buffer += chunk
+        while (end := buffer.find(b"\n", start)) >= 0:
+            yield bytes(buffer[:end])
+            del buffer[:end + 1]
+            start = 0
+    if buffer:
+        yield bytes(buffer)
@@ -1,29 +1,528 @@
 """Initialize from arguments"""
 
-from qdrant_client import QdrantClient
+from concurrent.futures import ThreadPoolExecutor
+import os
+import threading
+from typing import Any, Callable, Literal, Mapping, Optional, Sequence
+
+import httpx
+from qdrant_client import AsyncQdrantClient, QdrantClient
+import redis
 
 from image_search.app.config import settings
-from image_search.core.database import Database, QdrantVectorDatabase
-from image_search.core.embedding import CLIPEmbedder
+from image_search.core import telemetry
+from image_search.core.batching import BatchingEmbedder
+from image_search.core.cache import (Cache, CachingEmbedder, FileVersion,
+                                     LRUCache, RedisCache, TieredCache)
+from image_search.core.database import (AsyncDatabase, AsyncDatabaseAdapter,
+                                        AsyncQdrantVectorDatabase, Database,
+                                        QdrantVectorDatabase, VectorStorage,
+                                        dump_hits, load_hits)
+from image_search.core.embedding import (Backend, CLIPEmbedder, CompileMode,
+                                         Embedder, Precision, embedding_key)
+from image_search.core.embedding_store import EmbeddingStore
+from image_search.core.local_database import LocalVectorDatabase, VectorType
+from image_search.core.remote import RemoteEmbedder
+from image_search.core.sharded_database import (ShardedDatabase,
+                                                named_partition)
+from image_search.core.storage import BlobStore
+from image_search.core.thumbnail import ThumbnailCodec, ThumbnailFormat
+
+# creates a database from collection name, URL, local path and result cache
+BackendFactory = Callable[[str, str, str, Optional[Cache]], Database]
 
 
-def create_database(model_path: str,
+def create_embedder(model_path: str,
                     device: str,
-                    database_url: str,
-                    collection_name: str,
-                    ) -> Database:
+                    num_threads: int = None,
+                    num_interop_threads: int = None,
+                    compile_mode: CompileMode = "none",
+                    warmup: bool = False,
+                    max_batch_size: int = 0,
+                    max_batch_wait_ms: float = 0,
+                    cache: Optional[Cache] = None,
+                    fast_preprocessing: bool = False,
+                    precision: Precision = "fp32",
+                    backend: Backend = "torch",
+                    onnx_path: str = "",
+                    normalize: bool = False,
+                    snapshot_path: str = "",
+                    ) -> Embedder:
     embed = CLIPEmbedder(model_path=model_path,
                          device=device,
+                         num_threads=num_threads,
+                         num_interop_threads=num_interop_threads,
+                         compile_mode=compile_mode,
+                         warmup=warmup,
+                         fast_preprocessing=fast_preprocessing,
+                         precision=precision,
+                         backend=backend,
+                         onnx_path=onnx_path or None,
+                         normalize=normalize,
+                         snapshot_path=snapshot_path or None,
                          )
-    qdrant_client = QdrantClient(url=database_url)
+    if max_batch_size > 0:
+        embed = BatchingEmbedder(embed,
+                                 max_wait=max_batch_wait_ms / 1000,
+                                 max_batch_size=max_batch_size,
+                                 )
+    if cache is not None:
+        embed = CachingEmbedder(embed, cache)
+    return embed
+
+
+def create_remote_embedder(url: str,
+                           socket_path: str = "",
+                           image_size: int = 0,
+                           cache: Optional[Cache] = None,
+                           ) -> Embedder:
+    embed = RemoteEmbedder(url=url,
+                           socket_path=socket_path or None,
+                           image_size=image_size,
+                           )
+    if cache is not None:
+        embed = CachingEmbedder(embed, cache)
+    return embed
+
+
+def create_cache(max_size: int,
+                 ttl: float = 0,
+                 redis_url: str = "",
+                 prefix: str = "image-search",
+                 version_path: str = "",
+                 dump: Callable[[Any], bytes] = None,
+                 load: Callable[[bytes], Any] = None,
+                 ) -> Optional[Cache]:
+    """
+    Create a local LRU cache, optionally backed by a shared Redis cache
+    :param max_size: maximum size of local cache in bytes
+    :param ttl: time to live of entries in seconds, 0 for no expiry
+    :param redis_url: URL of Redis server for shared cache (optional)
+    :param prefix: key prefix in shared cache
+    :param version_path: file of the version shared with other processes
+                         without Redis, e.g., on the staging volume (version
+                         of this process if not set)
+    :param dump: serialization of values in shared cache (optional)
+    :param load: deserialization of values in shared cache (optional)
+    :return: cache or None if caching is disabled
+    """
+    if max_size <= 0 and not redis_url:
+        return None
+    if not redis_url:
+        version = FileVersion(version_path) if version_path else None
+        return LRUCache(max_size=max_size, ttl=ttl or None, version=version)
+    local_cache = LRUCache(max_size=max_size, ttl=ttl or None)
+    shared_cache = RedisCache(redis.Redis.from_url(redis_url),
+                              prefix=prefix,
+                              ttl=ttl or None,
+                              dump=dump,
+                              load=load,
+                              )
+    return TieredCache(local_cache, shared_cache)
+
+
+def create_embedding_store(path: str,
+                           model: str,
+                           embed: Embedder,
+                           precision: Precision = "fp32",
+                           normalize: bool = False,
+                           ) -> Optional[EmbeddingStore]:
+    """
+    Create the store of the embeddings of a model, which is kept apart from
+    the embeddings of other revisions, precisions or normalization
+    :param path: root directory of store, disabled if empty
+    :param model: name or path of model
+    :param embed: embedder of the model
+    :param precision: precision of the model
+    :param normalize: whether the embeddings are L2-normalized
+    :return: embedding store or None if disabled
+    """
+    if not path:
+        return None
+    return EmbeddingStore(path,
+                          embedding_key(model, precision, normalize),
+                          embedding_dim=embed.embedding_dim,
+                          distance=embed.distance,
+                          )
+
+
+def create_database(embed: Embedder,
+                    database_url: str,
+                    collection_name: str,
+                    result_cache: Optional[Cache] = None,
+                    prefer_grpc: bool = False,
+                    grpc_port: int = 6334,
+                    **kwargs,
+                    ) -> Database:
+    qdrant_client = QdrantClient(url=database_url,
+                                 prefer_grpc=prefer_grpc,
+                                 grpc_port=grpc_port,
+                                 )
     return QdrantVectorDatabase(embed=embed,
                                 client=qdrant_client,
                                 collection=collection_name,
+                                result_cache=result_cache,
+                                **kwargs,
                                 )
 
 
-database = create_database(settings.embedding.model_path,
+def create_async_database(embed: Embedder,
+                          database_url: str,
+                          collection_name: str,
+                          result_cache: Optional[Cache] = None,
+                          inference_workers: int = 1,
+                          max_connections: Optional[int] = None,
+                          max_keepalive_connections: Optional[int] = None,
+                          prefer_grpc: bool = False,
+                          grpc_port: int = 6334,
+                          **kwargs,
+                          ) -> AsyncDatabase:
+    limits = httpx.Limits(max_connections=max_connections or None,
+                          max_keepalive_connections=max_keepalive_connections,
+                          )
+    qdrant_client = AsyncQdrantClient(url=database_url,
+                                      limits=limits,
+                                      prefer_grpc=prefer_grpc,
+                                      grpc_port=grpc_port,
+                                      )
+    executor = ThreadPoolExecutor(max_workers=inference_workers,
+                                  thread_name_prefix="inference",
+                                  )
+    return AsyncQdrantVectorDatabase(embed=embed,
+                                     client=qdrant_client,
+                                     collection=collection_name,
+                                     result_cache=result_cache,
+                                     executor=executor,
+                                     **kwargs,
+                                     )
+
+
+def create_local_database(embed: Embedder,
+                          path: str,
+                          dtype: VectorType = "float32",
+                          ivf_lists: int = 0,
+                          ivf_probes: int = 8,
+                          result_cache: Optional[Cache] = None,
+                          **kwargs,
+                          ) -> LocalVectorDatabase:
+    return LocalVectorDatabase(embed=embed,
+                               path=path,
+                               dtype=dtype,
+                               ivf_lists=ivf_lists,
+                               ivf_probes=ivf_probes,
+                               result_cache=result_cache,
+                               **kwargs,
+                               )
+
+
+def create_sharded_database(embed: Embedder,
+                            shards: Mapping[str, Database],
+                            timeout: float = 0,
+                            result_cache: Optional[Cache] = None,
+                            partition_field: str = "",
+                            ) -> ShardedDatabase:
+    """
+    Create a database partitioned into shards
+    :param embed: embedder shared by all shards
+    :param shards: databases by shard name, without result caches
+    :param timeout: maximum time in seconds to wait for the results of a
+                    shard, 0 for no limit
+    :param result_cache: cache for merged search results (optional)
+    :param partition_field: metadata field naming the shard of an image;
+                            images without it, or with a value that is no
+                            shard name, are partitioned by the hash of their
+                            ID or value ("" to partition all by ID)
+    :return: sharded database
+    """
+    return ShardedDatabase(embed=embed,
+                           shards=shards,
+                           partition=(named_partition(list(shards))
+                                      if partition_field else None),
+                           partition_field=partition_field or None,
+                           timeout=timeout or None,
+                           result_cache=result_cache,
+                           )
+
+
+def create_partitioned_database(create_backend: BackendFactory,
+                                embed: Embedder,
+                                collection_name: str,
+                                url: str,
+                                local_path: str,
+                                result_cache: Optional[Cache] = None,
+                                shards: Sequence[str] = (),
+                                shard_urls: Mapping[str, str] = None,
+                                timeout: float = 0,
+                                partition_field: str = "",
+                                ) -> Database:
+    """
+    Create a database, which is partitioned into shards if any are set;
+    each shard has its own collection "<collection_name>-<shard>" and
+    local index "<local_path>/<shard>"
+    :param create_backend: function creating the database of a collection
+                           name, URL, local path and result cache
+    :param embed: embedder shared by all shards
+    :param collection_name: name of Qdrant collection
+    :param url: URL of Qdrant server
+    :param local_path: directory of local index
+    :param result_cache: cache for search results (optional)
+    :param shards: names of shards (no sharding if empty)
+    :param shard_urls: URL of the Qdrant server of a shard (`url` if
+                       missing)
+    :param timeout: maximum time in seconds to wait for the results of a
+                    shard, 0 for no limit
+    :param partition_field: metadata field naming the shard of an image
+    :return: database
+    """
+    if not shards:
+        return create_backend(collection_name, url, local_path, result_cache)
+    shard_urls = shard_urls or {}
+    return create_sharded_database(
+        embed,
+        {shard: create_backend(f"{collection_name}-{shard}",
+                               shard_urls.get(shard, url),
+                               os.path.join(local_path, shard),
+                               None,
+                               )
+         for shard in shards},
+        timeout,
+        result_cache,
+        partition_field,
+    )
+
+
+def create_thumbnail_options(size: Sequence[int],
+                             format: ThumbnailFormat,
+                             quality: int,
+                             storage: Literal["inline", "external"],
+                             path: str,
+                             inline_results: bool,
+                             ) -> dict[str, Any]:
+    """
+    Create thumbnail options of the database
+    :param size: maximum thumbnail size
+    :param format: image format of thumbnails
+    :param quality: compression quality of lossy formats
+    :param storage: store thumbnails in database ("inline") or in a blob
+                    store that is referenced in the database ("external")
+    :param path: root directory of blob store for external storage
+    :param inline_results: return thumbnails in search results, or
+                           references to the /images endpoint otherwise
+    :return: keyword arguments for database
+    """
+    return {
+        "thumbnail_codec": ThumbnailCodec(size=tuple(size),
+                                          format=format,
+                                          quality=quality,
+                                          ),
+        "thumbnail_store": BlobStore(path) if storage == "external" else None,
+        "thumbnail_url": None if inline_results else "/images/{id}",
+    }
+
+
+def _create_embedding_cache() -> Optional[Cache]:
+    cache = create_cache(
+        settings.cache.embedding_max_size,
+        settings.cache.embedding_ttl,
+        settings.cache.redis_url,
+        f"image-search:embeddings:{settings.embedding.model_path}",
+    )
+    telemetry.register_cache("embeddings", cache)
+    return cache
+
+
+def _create_result_cache() -> Optional[Cache]:
+    cache = create_cache(
+        settings.cache.result_max_size,
+        settings.cache.result_ttl,
+        settings.cache.redis_url,
+        f"image-search:results:{settings.database.collection_name}",
+        os.path.join(settings.staging.path,
+                      f"{settings.database.collection_name}.version"),
+        dump_hits,
+        load_hits,
+    )
+    telemetry.register_cache("results", cache)
+    return cache
+
+
+def _create_thumbnail_options() -> dict[str, Any]:
+    return create_thumbnail_options(
+        settings.thumbnails.size,
+        settings.thumbnails.format,
+        settings.thumbnails.quality,
+        settings.thumbnails.storage,
+        settings.thumbnails.path,
+        settings.thumbnails.inline_results,
+    )
+
+
+def _create_embedder() -> Embedder:
+    if not settings.embedding.server_url:
+        return _get("local_embedder")
+    return create_remote_embedder(settings.embedding.server_url,
+                                  settings.embedding.server_socket,
+                                  settings.embedding.server_image_size,
+                                  _get("embedding_cache"),
+                                  )
+
+
+def _create_local_embedder() -> Embedder:
+    return create_embedder(settings.embedding.model_path,
                            settings.embedding.device,
-                           settings.database.url,
-                           settings.database.collection_name,
+                           settings.embedding.num_threads,
+                           settings.embedding.num_interop_threads,
+                           settings.embedding.compile_mode,
+                           settings.embedding.warmup,
+                           settings.embedding.max_batch_size,
+                           settings.embedding.max_batch_wait_ms,
+                           _get("embedding_cache"),
+                           settings.embedding.fast_preprocessing,
+                           settings.embedding.precision,
+                           settings.embedding.backend,
+                           settings.embedding.onnx_path,
+                           settings.embedding.normalize,
+                           settings.embedding.snapshot_path,
                            )
+
+
+def _create_embedding_store() -> Optional[EmbeddingStore]:
+    return create_embedding_store(settings.embedding.store_path,
+                                  settings.embedding.model_path,
+                                  _get("embedder"),
+                                  settings.embedding.precision,
+                                  settings.embedding.normalize,
+                                  )
+
+
+def _create_vector_storage() -> VectorStorage:
+    return VectorStorage(
+        quantization=settings.database.quantization,
+        always_ram=settings.database.quantization_always_ram,
+        on_disk=settings.database.vectors_on_disk,
+        oversampling=settings.database.oversampling,
+        rescore=settings.database.rescore,
+    )
+
+
+def _create_database() -> Database:
+    return create_partitioned_database(_create_backend_database,
+                                       _get("embedder"),
+                                       settings.database.collection_name,
+                                       settings.database.url,
+                                       settings.database.local_path,
+                                       _get("result_cache"),
+                                       settings.database.shards,
+                                       settings.database.shard_urls,
+                                       settings.database.shard_timeout,
+                                       settings.database.partition_field,
+                                       )
+
+
+def _create_backend_database(collection_name: str,
+                             url: str,
+                             local_path: str,
+                             result_cache: Optional[Cache] = None,
+                             ) -> Database:
+    """
+    Create the database of the configured backend
+    :param collection_name: name of Qdrant collection
+    :param url: URL of Qdrant server
+    :param local_path: directory of local index
+    :param result_cache: cache for search results (optional)
+    :return: database
+    """
+    if settings.database.backend == "local":
+        return create_local_database(_get("embedder"),
+                                     local_path,
+                                     settings.database.local_dtype,
+                                     settings.database.ivf_lists,
+                                     settings.database.ivf_probes,
+                                     result_cache,
+                                     embedding_store=_get("embedding_store"),
+                                     **_get("thumbnail_options"),
+                                     )
+    if settings.database.backend == "qdrant":
+        return create_database(_get("embedder"),
+                               url,
+                               collection_name,
+                               result_cache,
+                               settings.database.prefer_grpc,
+                               settings.database.grpc_port,
+                               storage=_get("vector_storage"),
+                               indexed_fields=settings.database.indexed_fields,
+                               embedding_store=_get("embedding_store"),
+                               **_get("thumbnail_options"),
+                               )
+    raise ValueError(f"Unknown database backend: "
+                     f"'{settings.database.backend}'")
+
+
+def _create_async_database() -> AsyncDatabase:
+    if settings.database.backend == "local" or settings.database.shards:
+        return AsyncDatabaseAdapter(
+            _get("database"),
+            ThreadPoolExecutor(max_workers=settings.api.inference_workers,
+                               thread_name_prefix="inference",
+                               ),
+        )
+    if settings.database.backend == "qdrant":
+        return create_async_database(
+            _get("embedder"),
+            settings.database.url,
+            settings.database.collection_name,
+            _get("result_cache"),
+            settings.api.inference_workers,
+            settings.database.max_connections,
+            settings.database.max_keepalive_connections,
+            settings.database.prefer_grpc,
+            settings.database.grpc_port,
+            storage=_get("vector_storage"),
+            indexed_fields=settings.database.indexed_fields,
+            embedding_store=_get("embedding_store"),
+            **_get("thumbnail_options"),
+        )
+    raise ValueError(f"Unknown database backend: "
+                     f"'{settings.database.backend}'")
+
+
+_FACTORIES = {
+    # module attribute: function creating it from the settings
+    "embedding_cache": _create_embedding_cache,
+    "result_cache": _create_result_cache,
+    "thumbnail_options": _create_thumbnail_options,
+    "embedder": _create_embedder,
+    "local_embedder": _create_local_embedder,
+    "embedding_store": _create_embedding_store,
+    "vector_storage": _create_vector_storage,
+    "database": _create_database,
+    "async_database": _create_async_database,
+}
+_instances: dict[str, Any] = {}
+_lock = threading.RLock()
+
+
+def _get(name: str,
+         ) -> Any:
+    """
+    Get a component, creating it and its dependencies on first use
+    :param name: module attribute of component
+    :return: component
+    """
+    with _lock:
+        if name not in _instances:
+            _instances[name] = _FACTORIES[name]()
+        return _instances[name]
+
+
+def __getattr__(name: str,
+                ) -> Any:
+    """
+    Create components, e.g., `embedder` or `database`, on first access
+    instead of at import time, so that processes only load the model if
+    they need it
+    """
+    if name not in _FACTORIES:
+        raise AttributeError(f"module '{__name__}' has no attribute "
+                             f"'{name}'")
+    return _get(name)
@@ -0,0 +1,160 @@
+"""
+Rebuild or repopulate a collection from the embedding store without
+running the model, e.g., after changing the quantization of new
+collections or after losing the database
+"""
+from argparse import ArgumentParser
+import contextlib
+import logging
+import shutil
+import time
+from typing import Optional
+
+from qdrant_client import QdrantClient
+
+from image_search.app.arguments import add_database_args, add_embedding_args
+from image_search.app.config import settings
+from image_search.core.cache import Cache
+from image_search.core.database import Database, QdrantVectorDatabase
+from image_search.core.embedding import embedding_key
+from image_search.core.embedding_store import EmbeddingStore, StoredEmbedder
+
+logger = logging.getLogger(__name__)
+
+
+def rebuild(store: EmbeddingStore,
+            database,
+            batch_size: int = 256,
+            parallel: int = 1,
+            ) -> int:
+    """
+    Put all points of the store into the database; points of Qdrant
+    collections are uploaded in parallel batches and indexed afterwards,
+    points of sharded databases are put into the shards of their partition
+    keys
+    :param store: embedding store
+    :param database: database with `put_points`
+    :param batch_size: number of points per batch
+    :param parallel: number of uploading processes (Qdrant only)
+    :return: number of points
+    """
+    if isinstance(database, QdrantVectorDatabase):
+        with database.bulk_load():
+            database.upload(store.ids(),
+                            store.vectors(),
+                            store.payloads(),
+                            batch_size=batch_size,
+                            parallel=parallel,
+                            )
+    else:
+        bulk_load = getattr(database, "bulk_load", contextlib.nullcontext)
+        with bulk_load():
+            for points in store.points(batch_size):
+                database.put_points(points)
+    return len(store)
+
+
+def create_database(args,
+                    store: EmbeddingStore,
+                    ):
+    """
+    Create the database to rebuild, with a collection for the stored
+    embeddings, which is partitioned into the configured shards, if any;
+    options that are not command line arguments are taken from the
+    settings
+    :param store: embedding store
+    :return: database
+    """
+    from image_search.app import initialize
+
+    embed = StoredEmbedder(store)
+
+    def create_backend(collection_name: str,
+                       url: str,
+                       local_path: str,
+                       result_cache: Optional[Cache],
+                       ) -> Database:
+        if args.backend == "local":
+            if args.recreate:
+                shutil.rmtree(local_path, ignore_errors=True)
+            return initialize.create_local_database(
+                embed,
+                local_path,
+                settings.database.local_dtype,
+                settings.database.ivf_lists,
+                settings.database.ivf_probes,
+                result_cache,
+                **initialize.thumbnail_options,
+            )
+        if args.recreate:
+            QdrantClient(url=url).delete_collection(collection_name)
+        return initialize.create_database(
+            embed,
+            url,
+            collection_name,
+            result_cache,
+            settings.database.prefer_grpc,
+            settings.database.grpc_port,
+            storage=initialize.vector_storage,
+            indexed_fields=settings.database.indexed_fields,
+            **initialize.thumbnail_options,
+        )
+
+    return initialize.create_partitioned_database(
+        create_backend,
+        embed,
+        args.collection,
+        args.database_url,
+        args.local_path,
+        initialize.result_cache,
+        settings.database.shards,
+        settings.database.shard_urls,
+        settings.database.shard_timeout,
+        settings.database.partition_field,
+    )
+
+
+def main():
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument("--store-path",
+                        default=settings.embedding.store_path,
+                        help="Root directory of embedding store")
+    parser.add_argument("--recreate",
+                        action="store_true",
+                        help="Delete the collection or local index first, "
+                             "so that it is created with the current "
+                             "settings")
+    parser.add_argument("--batch-size",
+                        type=int,
+                        default=256,
+                        help="Points per request")
+    parser.add_argument("--parallel",
+                        type=int,
+                        default=1,
+                        help="Number of processes uploading to Qdrant")
+    add_embedding_args(parser)
+    add_database_args(parser)
+    args = parser.parse_args()
+    if not args.store_path:
+        parser.error("No embedding store; set --store-path")
+
+    logging.basicConfig(level=logging.INFO,
+                        format="%(asctime)s %(message)s")
+    store = EmbeddingStore(args.store_path,
+                           embedding_key(args.model,
+                                         settings.embedding.precision,
+                                         settings.embedding.normalize,
+                                         ))
+    database = create_database(args, store)
+    start = time.perf_counter()
+    n_points = rebuild(store, database,
+                      batch_size=args.batch_size,
+                      parallel=args.parallel,
+                      )
+    seconds = time.perf_counter() - start
+    logger.info("Put %d points in %.1f s (%.1f points/s)",
+                n_points, seconds, n_points / max(seconds, 1e-9))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,23 +1,185 @@
 """Celery worker"""
-import io
-from typing import Iterable
+from typing import Any, Dict, Iterable, List, Optional, Tuple
 
 from celery import Celery
+from celery import concurrency
+from celery.signals import worker_init, worker_process_shutdown
+from celery.utils.log import get_task_logger
 from PIL import Image
+from qdrant_client.http.exceptions import (ResponseHandlingException,
+                                           UnexpectedResponse)
 
 from image_search.app.config import settings
+from image_search.core import telemetry
+from image_search.core.hashing import hash_to_id
+from image_search.core.storage import BlobStore
 
 app = Celery("image_search.app.tasks",
              backend=settings.worker.backend_url,
              broker=settings.worker.broker_url,
              broker_connection_retry_on_startup=True)
 
+blob_store = BlobStore(settings.staging.path)
+logger = get_task_logger(__name__)
 
-@app.task(result_expires=settings.worker.result_lifetime)
-def index(images: Iterable[bytes],
-          ) -> None:
-    from image_search.app.initialize import database
+if settings.metrics.enabled:
+    telemetry.enable(tracing=settings.metrics.tracing)
+
+
+@worker_init.connect
+def start_metrics_exporter(sender: Any,
+                           **_,
+                           ) -> None:
+    if not settings.metrics.enabled:
+        return
+    if not telemetry.is_multiprocess() and _is_prefork(sender.pool_cls):
+        logger.warning("Tasks run in child processes of the prefork pool, "
+                       "whose metrics are only exported if "
+                       "PROMETHEUS_MULTIPROC_DIR is set")
+    telemetry.start_exporter(settings.metrics.worker_port)
+
+
+@worker_process_shutdown.connect
+def remove_process_metrics(pid: int,
+                           **_,
+                           ) -> None:
+    if settings.metrics.enabled:
+        telemetry.mark_process_dead(pid)
+
+
+@app.task(bind=True,
+          result_expires=settings.worker.result_lifetime,
+          max_retries=settings.worker.max_retries,
+          default_retry_delay=settings.worker.retry_delay,
+          )
+def index(self,
+          image_hashes: Iterable[str],
+          tracking_id: Optional[str] = None,
+          metadata: Optional[List[Optional[Dict[str, Any]]]] = None,
+          ) -> Dict[str, Any]:
+    """
+    Index staged images; the task ID is the owner of the staged images.
+    Point IDs are derived from the images' contents, and images that are
+    already indexed, e.g., when a task or request is retried, are skipped
+    before running the model. Decoding, encoding and upserting overlap in
+    an indexing pipeline. Images that cannot be loaded are skipped and
+    counted. A task that failed transiently, e.g., because the database was
+    unavailable, is retried; the staged images are released once the task
+    succeeded or failed for the last time.
+    :param image_hashes: hashes of images in blob store
+    :param tracking_id: tracking ID of the request, to trace the task
+                        (optional)
+    :param metadata: metadata fields of each image, stored in its payload
+                     to filter searches (optional)
+    :return: number of new, of skipped and of failed images, and the busy
+             time of each pipeline stage in seconds
+    """
+    from image_search.app.initialize import database, embedder
+    from image_search.core.pipeline import IndexingPipeline
+
+    image_hashes = list(image_hashes)
+    metadata_by_hash = {image_hash: image_metadata
+                        for image_hash, image_metadata
+                        in zip(image_hashes, metadata or [])
+                        if image_metadata}
+    owner = self.request.id  # the request is local to the task's thread
+    try:
+        unique_hashes = list(dict.fromkeys(image_hashes))
+        # skip known images before decoding them
+        existing_ids = database.existing_ids(
+            hash_to_id(image_hash) for image_hash in unique_hashes
+        )
+        unique_hashes = [image_hash for image_hash in unique_hashes
+                         if hash_to_id(image_hash) not in existing_ids]
+
+        def load(image_hash: str) -> Tuple[str, Image.Image]:
+            image = _load_image(image_hash,
+                                owner=owner,
+                                draft_size=settings.worker.draft_size,
+                                )
+            return hash_to_id(image_hash), image
+
+        pipeline = IndexingPipeline(
+            embedder,
+            database,
+            load_workers=settings.worker.load_workers,
+            batch_size=settings.worker.batch_size,
+            queue_size=settings.worker.queue_size,
+            near_duplicates=settings.worker.deduplication == "perceptual",
+            on_error=_log_error,
+        )
+        with telemetry.tracking(tracking_id, "index"):
+            report = pipeline.run(unique_hashes, load, metadata_by_hash)
+    except Exception as exc:
+        if _is_transient(exc) and self.request.retries < self.max_retries:
+            raise self.retry(exc=exc)  # keeps the staged images
+        blob_store.release(owner)
+        raise
+    finally:
+        blob_store.release_expired(settings.staging.max_age)
+        telemetry.publish_caches()
+    blob_store.release(owner)
+
+    logger.info("Indexed %d of %d images (%d failed), stage timings: %s",
+                report.n_new, len(image_hashes), report.n_failed,
+                ", ".join(f"{stage}={seconds:.3f}s"
+                          for stage, seconds in report.timings.items()))
+    return {
+        "new": report.n_new,
+        "skipped": len(image_hashes) - report.n_new - report.n_failed,
+        "failed": report.n_failed,
+        "timings": report.timings,
+    }
+
+
+def _is_prefork(pool_cls: Any,
+                ) -> bool:
+    """
+    :param pool_cls: pool class of a worker, or its name
+    :return: True if the pool runs tasks in child processes
+    """
+    from celery.concurrency.prefork import TaskPool
+
+    pool_cls = concurrency.get_implementation(pool_cls)
+    return isinstance(pool_cls, type) and issubclass(pool_cls, TaskPool)
+
+
+def _is_transient(exc: Exception,
+                  ) -> bool:
+    """
+    :param exc: error of an indexing task
+    :return: True if retrying the task may succeed, e.g., after a connection
+             error or a server error of the database
+    """
+    if isinstance(exc, UnexpectedResponse):
+        return exc.status_code is None or exc.status_code >= 500 \
+            or exc.status_code == 429
+    return isinstance(exc, (ConnectionError, TimeoutError,
+                            ResponseHandlingException))
+
+
+def _log_error(image_hash: str,
+               exc: Exception,
+               ) -> None:
+    logger.warning("Skipping image %s: %s", image_hash, exc)
+
+
+def _load_image(image_hash: str,
+                owner: str,
+                draft_size: int = 0,
+                ) -> Image.Image:
+    """
+    Decode a staged image from its memory-mapped file
+    :param image_hash: hash of image in blob store
+    :param owner: owner of the staged image
+    :param draft_size: decode JPEGs at a reduced scale, as long as width
+                       and height stay at least this large (0 for full size)
+    :return: decoded image
+    """
+    with blob_store.open(image_hash, owner) as fh:
+        image = Image.open(fh)
+        if draft_size:
+            image.draft(None, (draft_size, draft_size))
+        image.load()
+    return image
 
-    for image_bytes in images:
-        image = Image.open(io.BytesIO(image_bytes))
-        database.put(image)
@@ -0,0 +1,140 @@
+"""Dynamic batching of concurrent embedding calls"""
+from concurrent.futures import Future
+import queue
+import threading
+import time
+from typing import Any, Iterable, List, Sequence, Tuple, TypeVar
+
+import torch
+
+from image_search.core import telemetry
+from image_search.core.embedding import Distance, Embedder
+
+_T = TypeVar("_T")
+_Request = Tuple[List[_T], Future]
+
+
+class BatchingEmbedder(Embedder):
+    """
+    Collect the inputs of concurrent calls and embed them with a single call
+    to the wrapped embedder. A batch is dispatched once it holds the maximum
+    number of items or the maximum waiting time since its first request has
+    passed. While the wrapped embedder is busy, new requests keep queueing up
+    and form the next batch.
+    """
+
+    def __init__(self,
+                 embed: Embedder,
+                 max_wait: float = 0.005,
+                 max_batch_size: int = 64,
+                 ):
+        """
+        :param embed: wrapped embedding function
+        :param max_wait: maximum time (in seconds) to wait for further
+                         requests after the first request of a batch arrived
+        :param max_batch_size: maximum number of items per batch; a single
+                               request exceeding it is processed on its own
+        """
+        self._embed = embed
+        self._max_wait = max_wait
+        self._max_batch_size = max_batch_size
+        self._requests: queue.Queue[_Request] = queue.Queue()
+        self._overflow: _Request | None = None
+        self._worker = threading.Thread(target=self._run,
+                                        name="embedding-batcher",
+                                        daemon=True,
+                                        )
+        self._worker.start()
+
+    def __call__(self,
+                 inputs: Iterable[_T] = (),
+                 ) -> Sequence[torch.Tensor]:
+        """
+        Get embeddings for texts and/or images; blocks until the batch
+        containing the inputs has been processed
+        :param inputs: input objects
+        :return: embeddings for input objects
+        """
+        inputs = list(inputs)
+        if not inputs:
+            return []
+        future = Future()
+        self._requests.put((inputs, future))
+        return future.result()
+
+    def preprocess(self,
+                   obj: _T,
+                   ) -> Any:
+        return self._embed.preprocess(obj)
+
+    def encode(self,
+               inputs: Sequence[Any],
+               ) -> Sequence[torch.Tensor]:
+        """
+        Get embeddings for preprocessed objects, which are passed on to the
+        wrapped embedder directly, since callers of `encode` already batch
+        their inputs
+        :param inputs: results of `preprocess`
+        :return: embeddings for input objects
+        """
+        return self._embed.encode(inputs)
+
+    @property
+    def distance(self) -> Distance:
+        return self._embed.distance
+
+    @property
+    def embedding_dim(self) -> int:
+        return self._embed.embedding_dim
+
+    def _collect_batch(self,
+                       ) -> List[_Request]:
+        """
+        Block until a request arrives, then collect further requests until
+        the batch is full or the waiting time is exceeded
+        :return: requests of the batch
+        """
+        first_request = self._overflow or self._requests.get()
+        self._overflow = None
+        batch = [first_request]
+        batch_size = len(first_request[0])
+        deadline = time.monotonic() + self._max_wait
+        while batch_size < self._max_batch_size:
+            try:
+                timeout = max(deadline - time.monotonic(), 0)
+                request = self._requests.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if batch_size + len(request[0]) > self._max_batch_size:
+                self._overflow = request  # starts the next batch
+                break
+            batch.append(request)
+            batch_size += len(request[0])
+        return batch
+
+    def _process(self,
+                 batch: Sequence[_Request],
+                 ) -> None:
+        """
+        Embed all inputs of the batch at once and resolve the requests
+        :param batch: requests
+        """
+        inputs = [obj for objs, _ in batch for obj in objs]
+        telemetry.observe_batch_size("batcher", len(inputs))
+        telemetry.set_queue_depth("batcher", self._requests.qsize())
+        try:
+            embeddings = self._embed(inputs)
+        except Exception as exc:
+            for _, future in batch:
+                future.set_exception(exc)
+            return
+
+        offset = 0
+        for objs, future in batch:
+            future.set_result(embeddings[offset:offset + len(objs)])
+            offset += len(objs)
+
+    def _run(self,
+             ) -> None:
+        while True:
+            self._process(self._collect_batch())
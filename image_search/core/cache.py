@@ -0,0 +1,500 @@
+"""Caches for embeddings and search results"""
+from collections import OrderedDict
+import dataclasses
+import hashlib
+import io
+import os
+import sys
+import tempfile
+import threading
+import time
+from typing import (Any, Callable, Dict, Generic, Hashable, Iterable,
+                    Optional, Protocol, Sequence, TypeVar)
+
+import redis
+import torch
+
+from image_search.core.embedding import Distance, Embedder
+
+_K = TypeVar("_K", bound=Hashable)
+_V = TypeVar("_V")
+
+
+class Cache(Protocol[_K, _V]):
+
+    def get(self,
+            key: _K,
+            ) -> Optional[_V]:
+        """
+        Get cached value
+        :param key: cache key
+        :return: cached value or None if not cached
+        """
+        ...
+
+    def set(self,
+            key: _K,
+            value: _V,
+            ) -> None:
+        """
+        Cache value
+        :param key: cache key
+        :param value: value to cache
+        """
+        ...
+
+    def invalidate(self) -> None:
+        """Invalidate all cached values"""
+        ...
+
+    def version(self) -> int:
+        """
+        Get the version of the cached values, which changes with every
+        invalidation. Callers that make it part of their keys never read
+        invalidated values, even if another process invalidated them.
+        :return: current version
+        """
+        ...
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        :return: cache statistics, such as hit and miss counts
+        """
+        ...
+
+
+class Version(Protocol):
+
+    def get(self) -> int:
+        """
+        :return: current version
+        """
+        ...
+
+    def increment(self) -> None:
+        """Change the version to one that was not used before"""
+        ...
+
+
+class LocalVersion:
+    """Version of the current process"""
+
+    def __init__(self):
+        self._version = 0
+        self._lock = threading.Lock()
+
+    def get(self) -> int:
+        return self._version
+
+    def increment(self) -> None:
+        with self._lock:
+            self._version += 1
+
+
+class FileVersion:
+    """
+    Version shared by the processes that can access a file, e.g., on a
+    volume shared by API and workers; it is read on every `get`
+    """
+
+    def __init__(self,
+                 path: str,
+                 ):
+        """
+        :param path: file of the version, which is created on increment
+        """
+        self._path = path
+
+    def get(self) -> int:
+        try:
+            with open(self._path, "r", encoding="ascii") as file:
+                return int(file.read() or 0)
+        except FileNotFoundError:
+            return 0
+
+    def increment(self) -> None:
+        # a new timestamp, as concurrent increments need not add up
+        directory = os.path.dirname(self._path) or "."
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        with os.fdopen(fd, "w", encoding="ascii") as file:
+            file.write(str(max(time.time_ns(), self.get() + 1)))
+        os.replace(tmp_path, self._path)
+
+
+class RedisVersion:
+    """Version shared via a Redis counter"""
+
+    def __init__(self,
+                 client: redis.Redis,
+                 key: str,
+                 ):
+        """
+        :param client: Redis client
+        :param key: key of the counter
+        """
+        self._client = client
+        self._key = key
+
+    def get(self) -> int:
+        return int(self._client.get(self._key) or 0)
+
+    def increment(self) -> None:
+        self._client.incr(self._key)
+
+
+class LRUCache(Generic[_K, _V]):
+    """In-memory cache bounded by size, evicting least recently used values"""
+
+    def __init__(self,
+                 max_size: int,
+                 ttl: Optional[float] = None,
+                 sizeof: Callable[[_K, _V], int] = None,
+                 version: Version = None,
+                 ):
+        """
+        :param max_size: maximum total size of cached entries
+        :param ttl: time to live of entries in seconds (no expiry if not set)
+        :param sizeof: size function of an entry, defaults to its
+                       estimated memory footprint in bytes
+        :param version: version of the entries, which may be shared with
+                        other processes (version of this process if not set)
+        """
+        self._max_size = max_size
+        self._ttl = ttl
+        self._sizeof = sizeof or (lambda k, v: estimate_size(k)
+                                  + estimate_size(v))
+        self._entries: OrderedDict[_K, tuple[_V, float, int]] = OrderedDict()
+        self._size = 0
+        self._hits = 0
+        self._misses = 0
+        self._version = version or LocalVersion()
+        self._lock = threading.Lock()
+
+    def get(self,
+            key: _K,
+            ) -> Optional[_V]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and self._is_expired(entry):
+                self._remove(key)
+                entry = None
+            if entry is None:
+                self._misses += 1
+                return None
+            self._hits += 1
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def set(self,
+            key: _K,
+            value: _V,
+            ) -> None:
+        size = self._sizeof(key, value)
+        if size > self._max_size:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (value, time.monotonic(), size)
+            self._size += size
+            while self._size > self._max_size:
+                self._remove(next(iter(self._entries)))
+
+    def invalidate(self) -> None:
+        self._version.increment()
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+    def version(self) -> int:
+        return self._version.get()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "hits": self._hits,
+                "misses": self._misses,
+                "entries": len(self._entries),
+                "size": self._size,
+                "max_size": self._max_size,
+            }
+
+    def _is_expired(self,
+                    entry: tuple[_V, float, int],
+                    ) -> bool:
+        return (self._ttl is not None
+                and time.monotonic() - entry[1] > self._ttl)
+
+    def _remove(self,
+                key: _K,
+                ) -> None:
+        _, _, size = self._entries.pop(key)
+        self._size -= size
+
+
+class RedisCache(Generic[_K, _V]):
+    """
+    Cache shared between processes via Redis. Invalidation increments a
+    version counter in Redis; as callers make the version part of their
+    keys, stale entries are never read again and expire with their TTL.
+    """
+
+    def __init__(self,
+                 client: redis.Redis,
+                 prefix: str,
+                 ttl: Optional[float] = None,
+                 dump: Callable[[_V], bytes] = None,
+                 load: Callable[[bytes], _V] = None,
+                 ):
+        """
+        :param client: Redis client
+        :param prefix: key prefix, separating this cache from others
+        :param ttl: time to live of entries in seconds (no expiry if not set)
+        :param dump: serialization of values (`dump_value` if not set)
+        :param load: deserialization of values, which must not execute code
+                     from the data, as other clients may write to Redis
+                     (`load_value` if not set)
+        """
+        self._client = client
+        self._prefix = prefix
+        self._ttl = int(ttl) if ttl else None
+        self._dump = dump or dump_value
+        self._load = load or load_value
+        self._version = RedisVersion(client, f"{prefix}:version")
+        self._hits = 0
+        self._misses = 0
+
+    def get(self,
+            key: _K,
+            ) -> Optional[_V]:
+        data = self._client.get(self._redis_key(key))
+        if data is None:
+            self._misses += 1
+            return None
+        self._hits += 1
+        return self._load(data)
+
+    def set(self,
+            key: _K,
+            value: _V,
+            ) -> None:
+        self._client.set(self._redis_key(key),
+                         self._dump(value),
+                         ex=self._ttl)
+
+    def invalidate(self) -> None:
+        self._version.increment()
+
+    def version(self) -> int:
+        return self._version.get()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "hits": self._hits,
+            "misses": self._misses,
+        }
+
+    def _redis_key(self,
+                   key: _K,
+                   ) -> str:
+        return f"{self._prefix}:{hash_key(key)}"
+
+
+class TieredCache(Generic[_K, _V]):
+    """
+    Two-tier cache, e.g., a local cache in front of a shared cache; the
+    version is the one of the shared tier
+    """
+
+    def __init__(self,
+                 local: Cache[_K, _V],
+                 shared: Cache[_K, _V],
+                 ):
+        """
+        :param local: first tier, which is checked first
+        :param shared: second tier, which fills the first tier on hits
+        """
+        self._local = local
+        self._shared = shared
+
+    def get(self,
+            key: _K,
+            ) -> Optional[_V]:
+        value = self._local.get(key)
+        if value is None:
+            value = self._shared.get(key)
+            if value is not None:
+                self._local.set(key, value)
+        return value
+
+    def set(self,
+            key: _K,
+            value: _V,
+            ) -> None:
+        self._local.set(key, value)
+        self._shared.set(key, value)
+
+    def invalidate(self) -> None:
+        self._local.invalidate()
+        self._shared.invalidate()
+
+    def version(self) -> int:
+        return self._shared.version()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "local": self._local.stats(),
+            "shared": self._shared.stats(),
+        }
+
+
+class CachingEmbedder(Embedder):
+    """Cache text embeddings by their normalized text; images are not cached"""
+
+    def __init__(self,
+                 embed: Embedder,
+                 cache: Cache[str, torch.Tensor],
+                 ):
+        """
+        :param embed: wrapped embedding function
+        :param cache: text embedding cache
+        """
+        self._embed = embed
+        self._cache = cache
+
+    def __call__(self,
+                 inputs: Iterable[Any] = (),
+                 ) -> Sequence[torch.Tensor]:
+        """
+        Get embeddings for texts and/or images; only inputs that are not
+        cached are passed on to the wrapped embedder, in a single call
+        :param inputs: input objects
+        :return: embeddings for input objects
+        """
+        inputs = list(inputs)
+        embeddings = [
+            self._cache.get(normalize_text(obj))
+            if isinstance(obj, str)
+            else None
+            for obj in inputs
+        ]
+        missing_ids = [obj_id
+                       for obj_id, embedding in enumerate(embeddings)
+                       if embedding is None]
+        if missing_ids:
+            new_embeddings = self._embed([inputs[obj_id]
+                                          for obj_id in missing_ids])
+            for obj_id, embedding in zip(missing_ids, new_embeddings):
+                embeddings[obj_id] = embedding
+                if isinstance(inputs[obj_id], str):
+                    self._cache.set(normalize_text(inputs[obj_id]), embedding)
+        return embeddings
+
+    def preprocess(self,
+                   obj: Any,
+                   ) -> Any:
+        return self._embed.preprocess(obj)
+
+    def encode(self,
+               inputs: Sequence[Any],
+               ) -> Sequence[torch.Tensor]:
+        """
+        Get embeddings for preprocessed objects from the wrapped embedder;
+        these are not cached, as inputs are no longer texts after
+        preprocessing in general
+        :param inputs: results of `preprocess`
+        :return: embeddings for input objects
+        """
+        return self._embed.encode(inputs)
+
+    @property
+    def cache(self) -> Cache[str, torch.Tensor]:
+        return self._cache
+
+    @property
+    def distance(self) -> Distance:
+        return self._embed.distance
+
+    @property
+    def embedding_dim(self) -> int:
+        return self._embed.embedding_dim
+
+
+def normalize_text(text: str,
+                   ) -> str:
+    """
+    Normalize text for cache lookups. CLIP tokenizers lowercase the text and
+    ignore surrounding and repeated whitespace, so these variants share one
+    embedding.
+    :param text: input text
+    :return: normalized text
+    """
+    return " ".join(text.lower().split())
+
+
+def hash_key(key: Hashable,
+             ) -> str:
+    """
+    Create a stable hash of a cache key
+    :param key: cache key, such as a string, bytes or a tuple of both
+    :return: hex digest of the key
+    """
+    return hashlib.sha1(repr(key).encode("utf-8")).hexdigest()
+
+
+def tensor_key(tensor: torch.Tensor,
+               ) -> str:
+    """
+    Create a cache key from the contents of a tensor
+    :param tensor: tensor, e.g., an embedding
+    :return: hex digest of the tensor's data
+    """
+    data = tensor.detach().cpu().contiguous().numpy().tobytes()
+    return hashlib.sha1(data).hexdigest()
+
+
+def dump_value(value: Any,
+               ) -> bytes:
+    """
+    Serialize a value for a shared cache
+    :param value: tensor, string, number or (nested) list, tuple or dict of
+                  those
+    :return: serialized value
+    """
+    buffer = io.BytesIO()
+    torch.save(value, buffer)
+    return buffer.getvalue()
+
+
+def load_value(data: bytes,
+               ) -> Any:
+    """
+    Deserialize a value of `dump_value` without unpickling arbitrary
+    objects, which could execute code
+    :param data: serialized value
+    :return: value
+    """
+    return torch.load(io.BytesIO(data), weights_only=True)
+
+
+def estimate_size(obj: Any,
+                  ) -> int:
+    """
+    Estimate the memory footprint of an object in bytes
+    :param obj: tensor, string, bytes or (nested) container or dataclass
+                of those
+    :return: estimated size in bytes
+    """
+    if isinstance(obj, torch.Tensor):
+        return obj.element_size() * obj.nelement()
+    if isinstance(obj, str | bytes):
+        return len(obj)
+    if isinstance(obj, dict):
+        return sum(estimate_size(key) + estimate_size(value)
+                   for key, value in obj.items())
+    if isinstance(obj, list | tuple):
+        return sum(estimate_size(element) for element in obj)
+    if dataclasses.is_dataclass(obj) and not isinstance(obj, type):
+        return sum(estimate_size(value) for value in vars(obj).values())
+    return sys.getsizeof(obj)
@@ -1,26 +1,71 @@
+import asyncio
 import base64
-from typing import Iterable, Protocol, Sequence, Tuple, TypeVar
+from concurrent.futures import Executor
+import contextlib
+import dataclasses
+import functools
+from typing import (Any, Iterable, Iterator, List, Literal, Mapping,
+                    Optional, Protocol, Sequence, Tuple, TypeVar)
 import uuid
 
+import numpy as np
 from PIL.Image import Image
-from qdrant_client import QdrantClient
-from qdrant_client.models import (Distance, PointStruct, ScoredPoint,
-                                  SearchRequest, VectorParams)
+from qdrant_client import AsyncQdrantClient, QdrantClient
+from qdrant_client.models import (BinaryQuantization,
+                                  BinaryQuantizationConfig, Distance,
+                                  FieldCondition, Filter, MatchValue,
+                                  OptimizersConfigDiff,
+                                  PayloadSelectorExclude,
+                                  PayloadSchemaType, PayloadSelector,
+                                  PayloadSelectorInclude, PointStruct,
+                                  QuantizationConfig,
+                                  QuantizationSearchParams, RecommendRequest,
+                                  ScalarQuantization,
+                                  ScalarQuantizationConfig, ScalarType,
+                                  ScoredPoint, SearchParams, SearchRequest,
+                                  VectorParams)
+import torch
 
+from image_search.core import telemetry
+from image_search.core.cache import Cache, dump_value, load_value, tensor_key
 from image_search.core.embedding import Embedder
-from image_search.core.utils import scale_down
+from image_search.core.embedding_store import EmbeddingStore
+from image_search.core.hashing import object_id
+from image_search.core.storage import BlobStore
+from image_search.core.thumbnail import Thumbnail, ThumbnailCodec
+
+_THUMBNAIL_OWNER = "thumbnails"
+METADATA_KEY = "metadata"  # payload field of the metadata of images
+# Qdrant's default minimal size (kB) of segments with an HNSW index
+DEFAULT_INDEXING_THRESHOLD = 20000
 
 _T = TypeVar("_T")
+_OBJ_TYPE = str | Image
+Quantization = Literal["none", "scalar", "binary"]
 
 
 class Database(Protocol):
 
     def put(self,
             obj: _T | Iterable[_T],
+            ids: Sequence[str] = None,
             ) -> None:
         """
-        Put object into database
+        Put object into database; an object with the ID of an existing one
+        is not stored twice, but may replace it
         :param obj: object to store
+        :param ids: IDs of the objects (derived from their contents if not
+                    set)
+        """
+        ...
+
+    def existing_ids(self,
+                     ids: Iterable[str],
+                     ) -> set[str]:
+        """
+        Check which objects are already in the database
+        :param ids: object IDs
+        :return: IDs of the objects in the database
         """
         ...
 
@@ -36,61 +81,652 @@ class Database(Protocol):
         """
         ...
 
+    def search(self,
+               obj: _T | Iterable[_T],
+               n_similar: int = 5,
+               offset: int = 0,
+               score_threshold: float = None,
+               with_thumbnails: bool = False,
+               query_filter: Filter = None,
+               ) -> List[List["SearchHit"]]:
+        """
+        Get IDs and scores of similar objects from database
+        :param obj: reference object(s) for query
+        :param n_similar: number of candidates
+        :param offset: number of best candidates to skip
+        :param score_threshold: minimum score of candidates (optional)
+        :param with_thumbnails: include thumbnails of images
+        :param query_filter: conditions on the payloads of candidates,
+                             applied during the search (optional)
+        :return: hits per query, best first
+        """
+        ...
+
+    def search_by_ids(self,
+                      point_ids: Sequence[str],
+                      n_similar: int = 5,
+                      offset: int = 0,
+                      score_threshold: float = None,
+                      with_thumbnails: bool = False,
+                      query_filter: Filter = None,
+                      ) -> List[List["SearchHit"]]:
+        """
+        Get IDs and scores of the objects most similar to objects in the
+        database, by their stored vectors instead of embedding them again;
+        the reference objects are no candidates of their own query
+        :param point_ids: IDs of the reference objects
+        :param n_similar: number of candidates
+        :param offset: number of best candidates to skip
+        :param score_threshold: minimum score of candidates (optional)
+        :param with_thumbnails: include thumbnails of images
+        :param query_filter: conditions on the payloads of candidates,
+                             applied during the search (optional)
+        :return: hits per reference object, best first
+        """
+        ...
+
+
+class AsyncDatabase(Protocol):
+
+    async def put(self,
+                  obj: _T | Iterable[_T],
+                  ids: Sequence[str] = None,
+                  ) -> None:
+        """
+        Put object into database; an object with the ID of an existing one
+        is not stored twice, but may replace it
+        :param obj: object to store
+        :param ids: IDs of the objects (derived from their contents if not
+                    set)
+        """
+        ...
+
+    async def existing_ids(self,
+                           ids: Iterable[str],
+                           ) -> set[str]:
+        """
+        Check which objects are already in the database
+        :param ids: object IDs
+        :return: IDs of the objects in the database
+        """
+        ...
+
+    async def query_similar(self,
+                            obj: _T | Iterable[_T],
+                            n_similar: int = None,
+                            ) -> Iterable[Iterable[_T]]:
+        """
+        Get similar objects from database
+        :param obj: reference object(s) for query
+        :param n_similar: number of candidates
+        :return: similar objects from database
+        """
+        ...
+
+    async def search(self,
+                     obj: _T | Iterable[_T],
+                     n_similar: int = 5,
+                     offset: int = 0,
+                     score_threshold: float = None,
+                     with_thumbnails: bool = False,
+                     query_filter: Filter = None,
+                     ) -> List[List["SearchHit"]]:
+        """
+        Get IDs and scores of similar objects from database
+        :param obj: reference object(s) for query
+        :param n_similar: number of candidates
+        :param offset: number of best candidates to skip
+        :param score_threshold: minimum score of candidates (optional)
+        :param with_thumbnails: include thumbnails of images
+        :param query_filter: conditions on the payloads of candidates,
+                             applied during the search (optional)
+        :return: hits per query, best first
+        """
+        ...
+
+    async def search_by_ids(self,
+                            point_ids: Sequence[str],
+                            n_similar: int = 5,
+                            offset: int = 0,
+                            score_threshold: float = None,
+                            with_thumbnails: bool = False,
+                            query_filter: Filter = None,
+                            ) -> List[List["SearchHit"]]:
+        """
+        Get IDs and scores of the objects most similar to objects in the
+        database, by their stored vectors instead of embedding them again;
+        the reference objects are no candidates of their own query
+        :param point_ids: IDs of the reference objects
+        :param n_similar: number of candidates
+        :param offset: number of best candidates to skip
+        :param score_threshold: minimum score of candidates (optional)
+        :param with_thumbnails: include thumbnails of images
+        :param query_filter: conditions on the payloads of candidates,
+                             applied during the search (optional)
+        :return: hits per reference object, best first
+        """
+        ...
+
+
+@dataclasses.dataclass(frozen=True)
+class SearchHit:
+    """Point found by a search"""
+
+    id: str
+    score: float
+    text: Optional[str] = None  # text of text points
+    thumbnail: Optional[str] = None  # base64 thumbnail or its reference
+
+
+@dataclasses.dataclass(frozen=True)
+class SearchOptions:
+    """Page of candidates to search and the payload to return"""
+
+    n_similar: int = 5  # number of candidates
+    offset: int = 0  # number of best candidates to skip
+    score_threshold: Optional[float] = None  # minimum score of candidates
+    with_thumbnails: bool = True  # include thumbnails of images
+    # conditions on payloads; pydantic models are not hashable, but equal
+    query_filter: Optional[Filter] = dataclasses.field(default=None,
+                                                       hash=False)
+
+    @property
+    def limit(self) -> int:
+        """
+        :return: number of best candidates to find before skipping offset
+        """
+        return self.offset + self.n_similar
+
+
+@dataclasses.dataclass(frozen=True)
+class VectorStorage:
+    """
+    Storage of the vectors of new Qdrant collections. With quantization,
+    compressed copies of the vectors are searched first, and the best
+    `limit × oversampling` candidates are rescored with the original
+    vectors, which can then stay on disk.
+    """
+
+    quantization: Quantization = "none"  # "scalar" (int8) or "binary"
+    always_ram: bool = True  # keep quantized vectors in RAM
+    on_disk: bool = False  # memory-map original vectors from disk
+    oversampling: float = 2.0  # candidates per result to rescore
+    rescore: bool = True  # rescore candidates with original vectors
+
+    def quantization_config(self) -> Optional[QuantizationConfig]:
+        """
+        :return: quantization configuration for new collections
+        """
+        if self.quantization == "scalar":
+            return ScalarQuantization(scalar=ScalarQuantizationConfig(
+                type=ScalarType.INT8,
+                always_ram=self.always_ram,
+            ))
+        if self.quantization == "binary":
+            return BinaryQuantization(binary=BinaryQuantizationConfig(
+                always_ram=self.always_ram,
+            ))
+        if self.quantization != "none":
+            raise ValueError(f"Unknown quantization: '{self.quantization}'")
+        return None
+
+    def search_params(self) -> Optional[SearchParams]:
+        """
+        :return: search parameters for quantized collections
+        """
+        if self.quantization == "none":
+            return None
+        return SearchParams(quantization=QuantizationSearchParams(
+            rescore=self.rescore,
+            oversampling=self.oversampling,
+        ))
+
+
+class _VectorDatabaseBase:
+    """Conversions between objects and points shared by all databases"""
+
+    _storage = VectorStorage()
+
+    def __init__(self,
+                 embed: Embedder,
+                 result_cache: Cache = None,
+                 thumbnail_codec: ThumbnailCodec = None,
+                 thumbnail_store: BlobStore = None,
+                 thumbnail_url: str = None,
+                 embedding_store: EmbeddingStore = None,
+                 ):
+        """
+        :param embed: object embedding function
+        :param result_cache: cache for search results, which is invalidated
+                             whenever objects are put into the database
+        :param thumbnail_codec: encoding of image thumbnails
+        :param thumbnail_store: store thumbnails here and only a reference
+                                to them in DB (in DB if not set)
+        :param thumbnail_url: return references formatted with the point's
+                              `id` instead of thumbnails in search results,
+                              e.g., "/images/{id}" (inline if not set)
+        :param embedding_store: also append the embeddings and payloads of
+                                new points to this store, to rebuild the
+                                collection without the model (optional)
+        """
+        self._embed = embed
+        self._result_cache = result_cache
+        self._thumbnail_codec = thumbnail_codec or ThumbnailCodec()
+        self._thumbnail_store = thumbnail_store
+        self._thumbnail_url = thumbnail_url
+        self._embedding_store = embedding_store
+
+    def create_payload(self,
+                       obj: _OBJ_TYPE,
+                       metadata: dict[str, Any] = None,
+                       ) -> dict[str, Any]:
+        """
+        Create the payload of an object's point, e.g., its thumbnail; this
+        is independent of the embedding and may run concurrently to it
+        :param obj: text or image
+        :param metadata: fields to filter searches by, e.g., the source of
+                         an image (optional)
+        :return: payload
+        """
+        if isinstance(obj, str):
+            payload = self._text_to_payload(obj)
+        else:
+            payload = self._image_to_payload(obj)
+        if metadata:
+            payload[METADATA_KEY] = metadata
+        return payload
+
+    def _collection_config(self) -> VectorParams:
+        """
+        :return: vector configuration for new collections
+        """
+        size = self._embed.embedding_dim
+        distance = Distance(self._embed.distance.title())
+        return VectorParams(size=size,
+                            distance=distance,
+                            on_disk=self._storage.on_disk or None,
+                            quantization_config=(
+                                self._storage.quantization_config()
+                            ),
+                            )
+
+    def _create_points(self,
+                       objs: Sequence[_OBJ_TYPE],
+                       embeddings: Sequence[torch.Tensor],
+                       ids: Sequence[str] = None,
+                       ) -> List[PointStruct]:
+        """
+        Create points from objects and their embeddings
+        :param objs: texts and/or images
+        :param embeddings: embeddings of objects
+        :param ids: point IDs (derived from the objects if not set)
+        :return: points to upsert
+        """
+        if ids is None:
+            ids = [object_id(obj) for obj in objs]
+        payloads = (self.create_payload(obj) for obj in objs)
+        return [
+            PointStruct(id=str(point_id),
+                        vector=embedding,
+                        payload=payload,
+                        )
+            for point_id, embedding, payload in zip(ids, embeddings,
+                                                    payloads)
+        ]
+
+    def _archive(self,
+                 points: Sequence[PointStruct],
+                 ) -> None:
+        """
+        Append points to the embedding store, if any, before they are put
+        into the database; a point that only made it into the store is
+        stored again with the retried indexing
+        :param points: points
+        """
+        if self._embedding_store is not None:
+            self._embedding_store.append(points)
+
+    def _lookup_results(self,
+                        embeddings: Sequence[torch.Tensor],
+                        options: SearchOptions,
+                        ) -> Tuple[List[Any], List[Optional[Any]], List[int]]:
+        """
+        Look up cached search results
+        :param embeddings: query embeddings
+        :param options: page of candidates and payload to return
+        :return: cache keys, cached results (None if missing) and the
+                 indices of the embeddings whose results are missing
+        """
+        if self._result_cache is None:
+            return [], [None] * len(embeddings), list(range(len(embeddings)))
+
+        version = self._result_cache.version()
+        keys = [(tensor_key(embedding), options, version)
+                for embedding in embeddings]
+        results = [self._result_cache.get(key) for key in keys]
+        missing_ids = [obj_id
+                       for obj_id, result in enumerate(results)
+                       if result is None]
+        return keys, results, missing_ids
+
+    def _store_results(self,
+                       keys: Sequence[Any],
+                       results: List[Optional[Any]],
+                       missing_ids: Sequence[int],
+                       new_results: Sequence[Any],
+                       ) -> List[Any]:
+        """
+        Fill in and cache the results of the searched embeddings
+        :param keys: cache keys
+        :param results: cached results, which are completed in place
+        :param missing_ids: indices of the searched embeddings
+        :param new_results: search results of the searched embeddings
+        :return: complete results
+        """
+        for obj_id, result in zip(missing_ids, new_results):
+            results[obj_id] = result
+            if self._result_cache is not None:
+                self._result_cache.set(keys[obj_id], result)
+        return results
+
+    def _image_to_payload(self,
+                          image: Image,
+                          ) -> dict[str, str | int]:
+        """
+        Transform image to payload
+        :param image: image
+        :return: payload dict for database
+        """
+        thumbnail = self._thumbnail_codec.encode(image)
+        if self._thumbnail_store is None:
+            data = base64.b64encode(thumbnail.data).decode("ascii")
+            return {"thumbnail": data, **thumbnail.metadata()}
+
+        thumbnail_hash = self._thumbnail_store.put(thumbnail.data,
+                                                   owner=_THUMBNAIL_OWNER)
+        return {"thumbnail_ref": thumbnail_hash, **thumbnail.metadata()}
+
+    def _payload_to_thumbnail(self,
+                              payload: dict[str, Any],
+                              ) -> Optional[Thumbnail]:
+        """
+        Load thumbnail referenced in or contained by payload
+        :param payload: payload of image point
+        :return: thumbnail or None if the payload has no decodable thumbnail,
+                 e.g., if the thumbnail store is not configured or no longer
+                 contains the referenced thumbnail
+        """
+        if "thumbnail" in payload:
+            data = base64.b64decode(payload["thumbnail"])
+        elif "thumbnail_ref" in payload and self._thumbnail_store is not None:
+            try:
+                with self._thumbnail_store.open(payload["thumbnail_ref"],
+                                                owner=_THUMBNAIL_OWNER) as fh:
+                    data = bytes(fh.read())
+            except FileNotFoundError:
+                return None
+        else:
+            return None
+        return Thumbnail(data=data,
+                         format=payload["format"],
+                         width=payload["width"],
+                         height=payload["height"],
+                         mode=payload["mode"],
+                         )
+
+    def _extract_hits(self,
+                      results: Sequence[Sequence[ScoredPoint]],
+                      with_thumbnails: bool,
+                      ) -> List[List[SearchHit]]:
+        """
+        Extract IDs, scores, texts and optionally image thumbnails (or
+        references to them) from search results
+        :param results: scored points per query
+        :param with_thumbnails: include thumbnails of images
+        :return: hits per query
+        """
+        return [
+            [self._extract_hit(scored_point, with_thumbnails)
+             for scored_point in candidates]
+            for candidates in results
+        ]
+
+    def _extract_hit(self,
+                     point: ScoredPoint,
+                     with_thumbnails: bool,
+                     ) -> SearchHit:
+        payload = point.payload or {}
+        hit = SearchHit(id=str(point.id), score=point.score)
+        if "text" in payload:
+            return dataclasses.replace(hit, text=payload["text"])
+        if not with_thumbnails:
+            return hit
+        if self._thumbnail_url is not None:
+            thumbnail = self._thumbnail_url.format(id=point.id)
+        elif "pixels" in payload:  # uncompressed pixels of old points
+            thumbnail = payload["pixels"]
+        else:
+            stored = self._payload_to_thumbnail(payload)
+            if stored is None:  # thumbnail store is not available
+                return hit
+            thumbnail = base64.b64encode(stored.data).decode("ascii")
+        return dataclasses.replace(hit, thumbnail=thumbnail)
+
+    def _search_requests(self,
+                         embeddings: Sequence[torch.Tensor],
+                         options: SearchOptions,
+                         ) -> List[SearchRequest]:
+        """
+        Create one search request per embedding
+        :param embeddings: query embeddings
+        :param options: page of candidates and payload to return
+        :return: search requests
+        """
+        with_payload = self._payload_selector(options)
+        search_params = self._storage.search_params()
+        vectors = torch.stack(tuple(embeddings)).detach().float().cpu()
+        return [
+            SearchRequest(vector=vector,
+                          limit=options.n_similar,
+                          offset=options.offset or None,
+                          score_threshold=options.score_threshold,
+                          filter=options.query_filter,
+                          with_payload=with_payload,
+                          params=search_params,
+                          )
+            for vector in vectors.numpy().tolist()
+        ]
+
+    def _recommend_requests(self,
+                            point_ids: Sequence[str],
+                            options: SearchOptions,
+                            ) -> List[RecommendRequest]:
+        """
+        Create one request per reference point, searching by the point's
+        stored vector; Qdrant leaves the reference point out of its results
+        :param point_ids: IDs of reference points
+        :param options: page of candidates and payload to return
+        :return: recommend requests
+        """
+        with_payload = self._payload_selector(options)
+        search_params = self._storage.search_params()
+        return [
+            RecommendRequest(positive=[point_id],
+                             limit=options.n_similar,
+                             offset=options.offset or None,
+                             score_threshold=options.score_threshold,
+                             filter=options.query_filter,
+                             with_payload=with_payload,
+                             params=search_params,
+                             )
+            for point_id in point_ids
+        ]
+
+    def _payload_selector(self,
+                          options: SearchOptions,
+                          ) -> PayloadSelector | bool:
+        """
+        :param options: payload to return
+        :return: payload fields to request with search results
+        """
+        if not options.with_thumbnails:
+            return PayloadSelectorInclude(include=["text"])
+        if self._thumbnail_url is not None:
+            return PayloadSelectorExclude(exclude=["thumbnail", "pixels"])
+        return True
+
+    @staticmethod
+    def _hits_to_objects(results: Sequence[Sequence[SearchHit]],
+                         ) -> List[List[str]]:
+        """
+        :param results: hits per query
+        :return: texts and thumbnails (or references to them) per query
+        """
+        return [
+            [hit.thumbnail if hit.text is None else hit.text for hit in hits]
+            for hits in results
+        ]
+
+    @staticmethod
+    def _text_to_payload(text: str,
+                         ) -> dict[str, str]:
+        """
+        Transform text to payload
+        :param text: text
+        :return: payload dict for database
+        """
+        return {
+            "text": text,
+        }
 
-class QdrantVectorDatabase:
 
-    _OBJ_TYPE = str | Image
+class QdrantVectorDatabase(_VectorDatabaseBase):
 
     def __init__(self,
                  embed: Embedder,
                  client: QdrantClient,
                  collection: str = None,
-                 thumbnail_size: Tuple[int, int] = (128, 128),
+                 storage: VectorStorage = None,
+                 indexed_fields: Mapping[str, str] = None,
+                 **kwargs,
                  ):
         """
         :param embed: object embedding function
         :param client: Qdrant client object
         :param collection: already existing collection to use
-        :param thumbnail_size: size of thumbnail that is stored in DB
+        :param storage: vector storage of a new collection and how to search
+                        it (plain float32 vectors if not set)
+        :param indexed_fields: schema of the metadata fields to index, e.g.,
+                               {"source": "keyword"}, so that filtered
+                               searches do not scan all points (optional)
+        :param kwargs: caching and thumbnail options, see
+                       `_VectorDatabaseBase`
         """
-        self._embed = embed
+        super().__init__(embed=embed, **kwargs)
+        self._storage = storage or VectorStorage()
         self._client = client
-        self._thumbnail_size = thumbnail_size
+        self._indexed_fields = indexed_fields or {}
         if not collection or not self._client.collection_exists(collection):
             self._collection = self._initialize_collection(collection)
         else:
             self._collection = collection
+            self._create_payload_indexes(collection)
 
     def put(self,
             objs: _OBJ_TYPE | Iterable[_OBJ_TYPE],
+            ids: Sequence[str] = None,
             ) -> None:
         """
-        Put objects into Qdrant database
+        Put objects into Qdrant database; an object with the ID of an
+        existing one is not stored twice, but replaces it
         :param objs: object(s) to store
+        :param ids: IDs of the objects (derived from their contents if not
+                    set, see `object_id`)
         """
         if isinstance(objs, str | Image):
             objs = [objs]
 
+        objs = list(objs)
         embeddings = self._embed(objs)
-        payloads = (
-            self._text_to_payload(obj)
-            if isinstance(obj, str)
-            else self._image_to_payload(obj)
-            for obj in objs
-        )
+        self.put_points(self._create_points(objs, embeddings, ids))
 
-        points = [
-            PointStruct(id=str(uuid.uuid4()),
-                        vector=embedding,
-                        payload=payload,
-                        )
-            for embedding, payload in zip(embeddings, payloads)
-        ]
+    def put_points(self,
+                   points: Sequence[PointStruct],
+                   ) -> None:
+        """
+        Upsert points whose embeddings and payloads are already created
+        :param points: points
+        """
+        self._archive(points)
         # TODO: check result
-        # TODO: async?
-        self._client.upsert(collection_name=self._collection,
-                            points=points,
-                            )
+        with telemetry.stage("database", "upsert"):
+            self._client.upsert(collection_name=self._collection,
+                                points=points,
+                                )
+        if self._result_cache is not None:
+            self._result_cache.invalidate()
+
+    def upload(self,
+               ids: Iterable[str],
+               vectors: np.ndarray,
+               payloads: Iterable[dict[str, Any]],
+               batch_size: int = 256,
+               parallel: int = 1,
+               ) -> None:
+        """
+        Upload many points whose embeddings are already created, e.g., from
+        an embedding store, in batches sent by parallel processes
+        :param ids: point IDs
+        :param vectors: embeddings, e.g., memory-mapped, one row per point
+        :param payloads: payloads of points
+        :param batch_size: number of points per request
+        :param parallel: number of uploading processes
+        """
+        self._client.upload_collection(collection_name=self._collection,
+                                       vectors=vectors,
+                                       payload=payloads,
+                                       ids=ids,
+                                       batch_size=batch_size,
+                                       parallel=parallel,
+                                       wait=True,
+                                       )
+        if self._result_cache is not None:
+            self._result_cache.invalidate()
+
+    def existing_ids(self,
+                     ids: Iterable[str],
+                     ) -> set[str]:
+        """
+        Check which objects are already in the database with one request
+        :param ids: object IDs
+        :return: IDs of the objects in the database
+        """
+        points = self._client.retrieve(collection_name=self._collection,
+                                       ids=list(ids),
+                                       with_payload=False,
+                                       with_vectors=False,
+                                       )
+        return {str(point.id) for point in points}
+
+    def find_by_metadata(self,
+                         field: str,
+                         value: Any,
+                         ) -> Optional[str]:
+        """
+        Find a point by the value of a metadata field, e.g., an image with
+        the same perceptual hash
+        :param field: metadata field
+        :param value: value of the field
+        :return: ID of a point with the value, None if there is none
+        """
+        points, _ = self._client.scroll(
+            collection_name=self._collection,
+            scroll_filter=metadata_filter(field, value),
+            limit=1,
+            with_payload=False,
+            with_vectors=False,
+        )
+        return str(points[0].id) if points else None
 
     def query_similar(self,
                       objs: _OBJ_TYPE | Iterable[_OBJ_TYPE],
@@ -102,75 +738,651 @@ class QdrantVectorDatabase:
         :param n_similar: number of similar objects to return
         :return: similar objects from database
         """
+        return self._hits_to_objects(self.search(objs,
+                                                 n_similar=n_similar,
+                                                 with_thumbnails=True,
+                                                 ))
+
+    def search(self,
+               objs: _OBJ_TYPE | Iterable[_OBJ_TYPE],
+               n_similar: int = 5,
+               offset: int = 0,
+               score_threshold: float = None,
+               with_thumbnails: bool = False,
+               query_filter: Filter = None,
+               ) -> List[List[SearchHit]]:
+        """
+        Get IDs and scores of similar texts or images from the database;
+        only the payload fields of the returned hits are requested
+        :param objs: reference text(s) or image(s)
+        :param n_similar: number of similar objects to return
+        :param offset: number of best candidates to skip, e.g., to page
+        :param score_threshold: minimum score of candidates (optional)
+        :param with_thumbnails: include thumbnails of images
+        :param query_filter: conditions on the payloads of candidates,
+                             applied during the search (optional)
+        :return: hits per query, best first
+        """
         if isinstance(objs, str | Image):
             objs = [objs]
 
-        embeddings = self._embed(objs)
-        requests = [
-            SearchRequest(vector=embedding.tolist(),
-                          limit=n_similar,
-                          )
-            for embedding in embeddings
-        ]
+        return self.search_vectors(self._embed(objs),
+                                   n_similar=n_similar,
+                                   offset=offset,
+                                   score_threshold=score_threshold,
+                                   with_thumbnails=with_thumbnails,
+                                   query_filter=query_filter,
+                                   )
 
-        # TODO: async?
-        hits = self._client.search_batch(collection_name=self._collection,
-                                         requests=requests,
-                                         )
-        return self._extract_payloads(hits)
+    def search_vectors(self,
+                       embeddings: Sequence[torch.Tensor],
+                       n_similar: int = 5,
+                       offset: int = 0,
+                       score_threshold: float = None,
+                       with_thumbnails: bool = False,
+                       query_filter: Filter = None,
+                       ) -> List[List[SearchHit]]:
+        """
+        Get IDs and scores of the points most similar to query embeddings,
+        e.g., to search several databases with the same embeddings
+        :param embeddings: query embeddings
+        :param n_similar: number of similar objects to return
+        :param offset: number of best candidates to skip, e.g., to page
+        :param score_threshold: minimum score of candidates (optional)
+        :param with_thumbnails: include thumbnails of images
+        :param query_filter: conditions on the payloads of candidates,
+                             applied during the search (optional)
+        :return: hits per query, best first
+        """
+        options = SearchOptions(n_similar=n_similar,
+                                offset=offset,
+                                score_threshold=score_threshold,
+                                with_thumbnails=with_thumbnails,
+                                query_filter=query_filter,
+                                )
+        keys, results, missing_ids = self._lookup_results(embeddings,
+                                                          options)
+        new_results = []
+        if missing_ids:
+            requests = self._search_requests([embeddings[obj_id]
+                                              for obj_id in missing_ids],
+                                             options)
+            with telemetry.stage("database", "search"):
+                hits = self._client.search_batch(
+                    collection_name=self._collection,
+                    requests=requests,
+                )
+            with telemetry.stage("database", "results"):
+                new_results = self._extract_hits(hits, with_thumbnails)
+        return self._store_results(keys, results, missing_ids, new_results)
 
-    def _image_to_payload(self,
-                          image: Image,
-                          ) -> dict[str, bytes]:
+    def search_by_ids(self,
+                      point_ids: Sequence[str],
+                      n_similar: int = 5,
+                      offset: int = 0,
+                      score_threshold: float = None,
+                      with_thumbnails: bool = False,
+                      query_filter: Filter = None,
+                      ) -> List[List[SearchHit]]:
         """
-        Transform image to payload
-        :param image: image
-        :return: payload dict for database
+        Get IDs and scores of the texts or images most similar to points in
+        the database, searching by their stored vectors in one request
+        :param point_ids: IDs of reference points
+        :param n_similar: number of similar objects to return
+        :param offset: number of best candidates to skip, e.g., to page
+        :param score_threshold: minimum score of candidates (optional)
+        :param with_thumbnails: include thumbnails of images
+        :param query_filter: conditions on the payloads of candidates,
+                             applied during the search (optional)
+        :return: hits per reference point, best first
         """
-        image.thumbnail(scale_down(image.size, self._thumbnail_size))
-        return {
-            "pixels": base64.b64encode(image.tobytes()),
-        }
+        options = SearchOptions(n_similar=n_similar,
+                                offset=offset,
+                                score_threshold=score_threshold,
+                                with_thumbnails=with_thumbnails,
+                                query_filter=query_filter,
+                                )
+        with telemetry.stage("database", "search"):
+            hits = self._client.recommend_batch(
+                collection_name=self._collection,
+                requests=self._recommend_requests(point_ids, options),
+            )
+        with telemetry.stage("database", "results"):
+            return self._extract_hits(hits, with_thumbnails)
+
+    def get_vectors(self,
+                    point_ids: Iterable[str],
+                    ) -> dict[str, torch.Tensor]:
+        """
+        Get the stored vectors of points
+        :param point_ids: point IDs
+        :return: vectors of the points in the database by ID
+        """
+        points = self._client.retrieve(collection_name=self._collection,
+                                       ids=list(point_ids),
+                                       with_payload=False,
+                                       with_vectors=True,
+                                       )
+        return {str(point.id): torch.tensor(point.vector)
+                for point in points}
+
+    def get_thumbnail(self,
+                      point_id: str,
+                      ) -> Optional[Thumbnail]:
+        """
+        Get the thumbnail of an image in the database
+        :param point_id: ID of the image's point
+        :return: thumbnail or None if there is none
+        """
+        points = self._client.retrieve(collection_name=self._collection,
+                                       ids=[point_id],
+                                       with_payload=True,
+                                       )
+        if not points:
+            return None
+        return self._payload_to_thumbnail(points[0].payload)
+
+    @contextlib.contextmanager
+    def bulk_load(self) -> Iterator[None]:
+        """
+        Defer building the HNSW index while many points are upserted, e.g.,
+        by several processes; Qdrant builds it once afterwards instead of
+        updating it with every batch. A threshold of 0 on entry was left by
+        an interrupted bulk load, e.g., of a killed process, and is restored
+        to Qdrant's default.
+        """
+        info = self._client.get_collection(self._collection)
+        indexing_threshold = (info.config.optimizer_config.indexing_threshold
+                              or DEFAULT_INDEXING_THRESHOLD)
+        self._client.update_collection(
+            collection_name=self._collection,
+            optimizers_config=OptimizersConfigDiff(indexing_threshold=0),
+        )
+        try:
+            yield
+        finally:
+            self._client.update_collection(
+                collection_name=self._collection,
+                optimizers_config=OptimizersConfigDiff(
+                    indexing_threshold=indexing_threshold,
+                ),
+            )
 
     def _initialize_collection(self,
                                collection_name: str = None,
                                ) -> str:
         """
         Initialize collection and return collection name
-        :param embed: embedding function
         :param collection_name: name of collection (optional)
         :return: name of initialized collection
         """
         collection_name = collection_name or str(uuid.uuid4())
-        size = self._embed.embedding_dim
-        distance = Distance(self._embed.distance.title())
-        config = VectorParams(size=size,
-                              distance=distance)
+        config = self._collection_config()
         self._client.recreate_collection(collection_name=collection_name,
                                          vectors_config=config)
+        self._create_payload_indexes(collection_name)
         return collection_name
 
-    @staticmethod
-    def _extract_payloads(results: Sequence[Sequence[ScoredPoint]],
-                          ) -> Sequence[Sequence[str | bytes]]:
-        return [
-            [
-                scored_point.payload["text"]
-                if "text" in scored_point.payload
-                else scored_point.payload["pixels"]
-                for scored_point in candidates
-            ]
-            for candidates in results
-        ]
+    def _create_payload_indexes(self,
+                                collection_name: str,
+                                ) -> None:
+        """
+        Index the metadata fields of a collection; existing indexes are kept
+        :param collection_name: name of collection
+        """
+        for field_name, field_schema in _payload_indexes(
+                self._indexed_fields):
+            self._client.create_payload_index(collection_name=collection_name,
+                                              field_name=field_name,
+                                              field_schema=field_schema,
+                                              )
+
+
+class AsyncQdrantVectorDatabase(_VectorDatabaseBase):
+    """
+    Qdrant database for use in an event loop. Blocking work, i.e., model
+    inference and cache access, runs in an executor.
+    """
+
+    def __init__(self,
+                 embed: Embedder,
+                 client: AsyncQdrantClient,
+                 collection: str = None,
+                 executor: Executor = None,
+                 storage: VectorStorage = None,
+                 indexed_fields: Mapping[str, str] = None,
+                 **kwargs,
+                 ):
+        """
+        :param embed: object embedding function
+        :param client: asynchronous Qdrant client object
+        :param collection: collection to use; created on first use if it
+                           does not exist
+        :param executor: executor for blocking work, e.g., a bounded thread
+                         pool (default executor of event loop if not set)
+        :param storage: vector storage of a new collection and how to search
+                        it (plain float32 vectors if not set)
+        :param indexed_fields: schema of the metadata fields to index, e.g.,
+                               {"source": "keyword"}, so that filtered
+                               searches do not scan all points (optional)
+        :param kwargs: caching and thumbnail options, see
+                       `_VectorDatabaseBase`
+        """
+        super().__init__(embed=embed, **kwargs)
+        self._storage = storage or VectorStorage()
+        self._client = client
+        self._collection = collection
+        self._indexed_fields = indexed_fields or {}
+        self._executor = executor
+        self._initialized = False
+        self._initialize_lock = asyncio.Lock()
+
+    async def put(self,
+                  objs: _OBJ_TYPE | Iterable[_OBJ_TYPE],
+                  ids: Sequence[str] = None,
+                  ) -> None:
+        """
+        Put objects into Qdrant database; an object with the ID of an
+        existing one is not stored twice, but replaces it
+        :param objs: object(s) to store
+        :param ids: IDs of the objects (derived from their contents if not
+                    set, see `object_id`)
+        """
+        if isinstance(objs, str | Image):
+            objs = [objs]
+
+        objs = list(objs)
+        await self._initialize_collection()
+        points = await self._run_blocking(self._embed_points, objs, ids)
+        await self._run_blocking(self._archive, points)
+        await self._client.upsert(collection_name=self._collection,
+                                  points=points,
+                                  )
+        if self._result_cache is not None:
+            await self._run_blocking(self._result_cache.invalidate)
+
+    async def existing_ids(self,
+                           ids: Iterable[str],
+                           ) -> set[str]:
+        """
+        Check which objects are already in the database with one request
+        :param ids: object IDs
+        :return: IDs of the objects in the database
+        """
+        await self._initialize_collection()
+        points = await self._client.retrieve(collection_name=self._collection,
+                                             ids=list(ids),
+                                             with_payload=False,
+                                             with_vectors=False,
+                                             )
+        return {str(point.id) for point in points}
+
+    async def query_similar(self,
+                            objs: _OBJ_TYPE | Iterable[_OBJ_TYPE],
+                            n_similar: int = 5,
+                            ) -> Iterable[Iterable[_OBJ_TYPE]]:
+        """
+        Get similar texts or images from the database
+        :param objs: reference text(s) or image(s)
+        :param n_similar: number of similar objects to return
+        :return: similar objects from database
+        """
+        return self._hits_to_objects(await self.search(objs,
+                                                       n_similar=n_similar,
+                                                       with_thumbnails=True,
+                                                       ))
+
+    async def search(self,
+                     objs: _OBJ_TYPE | Iterable[_OBJ_TYPE],
+                     n_similar: int = 5,
+                     offset: int = 0,
+                     score_threshold: float = None,
+                     with_thumbnails: bool = False,
+                     query_filter: Filter = None,
+                     ) -> List[List[SearchHit]]:
+        """
+        Get IDs and scores of similar texts or images from the database;
+        only the payload fields of the returned hits are requested
+        :param objs: reference text(s) or image(s)
+        :param n_similar: number of similar objects to return
+        :param offset: number of best candidates to skip, e.g., to page
+        :param score_threshold: minimum score of candidates (optional)
+        :param with_thumbnails: include thumbnails of images
+        :param query_filter: conditions on the payloads of candidates,
+                             applied during the search (optional)
+        :return: hits per query, best first
+        """
+        if isinstance(objs, str | Image):
+            objs = [objs]
+
+        options = SearchOptions(n_similar=n_similar,
+                                offset=offset,
+                                score_threshold=score_threshold,
+                                with_thumbnails=with_thumbnails,
+                                query_filter=query_filter,
+                                )
+        await self._initialize_collection()
+        embeddings, keys, results, missing_ids = await self._run_blocking(
+            self._embed_and_lookup, list(objs), options,
+        )
+        if not missing_ids:
+            return results
+
+        requests = self._search_requests([embeddings[obj_id]
+                                          for obj_id in missing_ids],
+                                         options)
+        with telemetry.stage("database", "search"):
+            hits = await self._client.search_batch(
+                collection_name=self._collection,
+                requests=requests,
+            )
+        return await self._run_blocking(self._extract_and_store_results,
+                                        hits, keys, results, missing_ids,
+                                        with_thumbnails)
+
+    async def search_by_ids(self,
+                            point_ids: Sequence[str],
+                            n_similar: int = 5,
+                            offset: int = 0,
+                            score_threshold: float = None,
+                            with_thumbnails: bool = False,
+                            query_filter: Filter = None,
+                            ) -> List[List[SearchHit]]:
+        """
+        Get IDs and scores of the texts or images most similar to points in
+        the database, searching by their stored vectors in one request
+        :param point_ids: IDs of reference points
+        :param n_similar: number of similar objects to return
+        :param offset: number of best candidates to skip, e.g., to page
+        :param score_threshold: minimum score of candidates (optional)
+        :param with_thumbnails: include thumbnails of images
+        :param query_filter: conditions on the payloads of candidates,
+                             applied during the search (optional)
+        :return: hits per reference point, best first
+        """
+        options = SearchOptions(n_similar=n_similar,
+                                offset=offset,
+                                score_threshold=score_threshold,
+                                with_thumbnails=with_thumbnails,
+                                query_filter=query_filter,
+                                )
+        await self._initialize_collection()
+        with telemetry.stage("database", "search"):
+            hits = await self._client.recommend_batch(
+                collection_name=self._collection,
+                requests=self._recommend_requests(point_ids, options),
+            )
+        return await self._run_blocking(self._extract_hits,
+                                        hits, with_thumbnails)
+
+    async def get_thumbnail(self,
+                            point_id: str,
+                            ) -> Optional[Thumbnail]:
+        """
+        Get the thumbnail of an image in the database
+        :param point_id: ID of the image's point
+        :return: thumbnail or None if there is none
+        """
+        await self._initialize_collection()
+        points = await self._client.retrieve(collection_name=self._collection,
+                                             ids=[point_id],
+                                             with_payload=True,
+                                             )
+        if not points:
+            return None
+        return await self._run_blocking(self._payload_to_thumbnail,
+                                        points[0].payload)
+
+    async def close(self) -> None:
+        """Close connections to Qdrant"""
+        await self._client.close()
+
+    def _embed_and_lookup(self,
+                          objs: Sequence[_OBJ_TYPE],
+                          options: SearchOptions,
+                          ) -> Tuple[Sequence[torch.Tensor], List[Any],
+                                     List[Optional[Any]], List[int]]:
+        """
+        Embed query objects and look up their cached results
+        :param objs: reference text(s) or image(s)
+        :param options: page of candidates and payload to return
+        :return: embeddings, cache keys, cached results and indices of
+                 the embeddings whose results are missing
+        """
+        embeddings = self._embed(objs)
+        return embeddings, *self._lookup_results(embeddings, options)
+
+    def _extract_and_store_results(self,
+                                   hits: Sequence[Sequence[ScoredPoint]],
+                                   keys: Sequence[Any],
+                                   results: List[Optional[Any]],
+                                   missing_ids: Sequence[int],
+                                   with_thumbnails: bool,
+                                   ) -> List[Any]:
+        """
+        Extract hits from search results, which may load thumbnails from
+        the thumbnail store, and cache them
+        :param hits: scored points of the searched embeddings
+        :param keys: cache keys
+        :param results: cached results, which are completed in place
+        :param missing_ids: indices of the searched embeddings
+        :param with_thumbnails: include thumbnails of images
+        :return: complete results
+        """
+        with telemetry.stage("database", "results"):
+            new_results = self._extract_hits(hits, with_thumbnails)
+        return self._store_results(keys, results, missing_ids, new_results)
+
+    def _embed_points(self,
+                      objs: Sequence[_OBJ_TYPE],
+                      ids: Sequence[str] = None,
+                      ) -> List[PointStruct]:
+        """
+        Embed objects and create points from them
+        :param objs: texts and/or images
+        :param ids: point IDs (derived from the objects if not set)
+        :return: points to upsert
+        """
+        return self._create_points(objs, self._embed(objs), ids)
+
+    async def _initialize_collection(self) -> None:
+        """
+        Create the collection, unless it already exists, and index its
+        metadata fields
+        """
+        if self._initialized:
+            return
+        async with self._initialize_lock:
+            if self._initialized:
+                return
+            if (not self._collection
+                    or not await self._client.collection_exists(
+                        self._collection)):
+                self._collection = self._collection or str(uuid.uuid4())
+                await self._client.recreate_collection(
+                    collection_name=self._collection,
+                    vectors_config=self._collection_config(),
+                )
+            for field_name, field_schema in _payload_indexes(
+                    self._indexed_fields):
+                await self._client.create_payload_index(
+                    collection_name=self._collection,
+                    field_name=field_name,
+                    field_schema=field_schema,
+                )
+            self._initialized = True
+
+    async def _run_blocking(self,
+                            func,
+                            *args,
+                            ):
+        """
+        Run blocking function in executor
+        :param func: blocking function
+        :param args: positional arguments of function
+        :return: return value of function
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor,
+                                          telemetry.propagate(func),
+                                          *args)
+
+
+class AsyncDatabaseAdapter:
+    """Run a synchronous database in an executor for use in an event loop"""
+
+    def __init__(self,
+                 database: Database,
+                 executor: Executor = None,
+                 ):
+        """
+        :param database: synchronous database
+        :param executor: executor for database calls, e.g., a bounded thread
+                         pool (default executor of event loop if not set)
+        """
+        self._database = database
+        self._executor = executor
+
+    async def put(self,
+                  objs: _OBJ_TYPE | Iterable[_OBJ_TYPE],
+                  ids: Sequence[str] = None,
+                  ) -> None:
+        await self._run_blocking(self._database.put, objs, ids)
+
+    async def existing_ids(self,
+                           ids: Iterable[str],
+                           ) -> set[str]:
+        return await self._run_blocking(self._database.existing_ids, ids)
+
+    async def query_similar(self,
+                            objs: _OBJ_TYPE | Iterable[_OBJ_TYPE],
+                            n_similar: int = 5,
+                            ) -> Iterable[Iterable[_OBJ_TYPE]]:
+        return await self._run_blocking(self._database.query_similar,
+                                        objs, n_similar)
+
+    async def search(self,
+                     objs: _OBJ_TYPE | Iterable[_OBJ_TYPE],
+                     n_similar: int = 5,
+                     offset: int = 0,
+                     score_threshold: float = None,
+                     with_thumbnails: bool = False,
+                     query_filter: Filter = None,
+                     shards: Sequence[str] = None,
+                     ) -> List[List[SearchHit]]:
+        return await self._run_blocking(
+            self._with_shards(self._database.search, shards),
+            objs, n_similar, offset, score_threshold, with_thumbnails,
+            query_filter,
+        )
+
+    async def search_by_ids(self,
+                            point_ids: Sequence[str],
+                            n_similar: int = 5,
+                            offset: int = 0,
+                            score_threshold: float = None,
+                            with_thumbnails: bool = False,
+                            query_filter: Filter = None,
+                            shards: Sequence[str] = None,
+                            ) -> List[List[SearchHit]]:
+        return await self._run_blocking(
+            self._with_shards(self._database.search_by_ids, shards),
+            point_ids, n_similar, offset, score_threshold, with_thumbnails,
+            query_filter,
+        )
+
+    async def get_thumbnail(self,
+                            point_id: str,
+                            ) -> Optional[Thumbnail]:
+        return await self._run_blocking(self._database.get_thumbnail,
+                                        point_id)
+
+    async def close(self) -> None:
+        pass
 
     @staticmethod
-    def _text_to_payload(text: str,
-                         ) -> dict[str, str]:
+    def _with_shards(func,
+                     shards: Optional[Sequence[str]],
+                     ):
         """
-        Transform text to payload
-        :param text: text
-        :return: payload dict for database
+        Select the shards of a search, which only sharded databases accept
+        :param func: search method
+        :param shards: names of the shards to search (all if not set)
+        :return: search method
         """
-        return {
-            "text": text,
-        }
+        if shards is None:
+            return func
+        return functools.partial(func, shards=shards)
+
+    async def _run_blocking(self,
+                            func,
+                            *args,
+                            ):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor,
+                                          telemetry.propagate(func),
+                                          *args)
+
+
+def dump_hits(hits: Sequence[SearchHit],
+              ) -> bytes:
+    """
+    Serialize the search results of a query for a shared result cache
+    :param hits: search results
+    :return: serialized search results
+    """
+    return dump_value([dataclasses.astuple(hit) for hit in hits])
+
+
+def load_hits(data: bytes,
+              ) -> List[SearchHit]:
+    """
+    Deserialize the search results of `dump_hits`
+    :param data: serialized search results
+    :return: search results
+    """
+    return [SearchHit(*fields) for fields in load_value(data)]
+
+
+def metadata_filter(field: str,
+                    value: Any,
+                    ) -> Filter:
+    """
+    :param field: metadata field
+    :param value: value of the field
+    :return: filter matching points whose metadata field has the value
+    """
+    return Filter(must=[FieldCondition(key=f"{METADATA_KEY}.{field}",
+                                       match=MatchValue(value=value))])
+
+
+def _exclude_references(results: Sequence[Sequence[SearchHit]],
+                        point_ids: Sequence[str],
+                        offset: int,
+                        n_similar: int,
+                        ) -> List[List[SearchHit]]:
+    """
+    Remove the reference points from the results of searches by their
+    vectors, like Qdrant's recommendations, and page the remaining hits
+    :param results: hits per reference point, from the best one on, at
+                    least `offset + n_similar + 1`
+    :param point_ids: IDs of reference points
+    :param offset: number of best candidates to skip
+    :param n_similar: number of candidates
+    :return: hits per reference point, best first
+    """
+    return [
+        [hit for hit in hits if hit.id != point_id][offset:offset + n_similar]
+        for hits, point_id in zip(results, point_ids)
+    ]
+
+
+def _payload_indexes(indexed_fields: Mapping[str, str],
+                     ) -> List[Tuple[str, PayloadSchemaType]]:
+    """
+    :param indexed_fields: schema of metadata fields, e.g.,
+                           {"source": "keyword", "created": "integer"}
+    :return: payload keys and schemas of the indexes
+    """
+    return [(f"{METADATA_KEY}.{name}", PayloadSchemaType(schema))
+            for name, schema in indexed_fields.items()]
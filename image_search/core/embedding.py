@@ -1,17 +1,30 @@
 """Encode text or images as vector space embedding"""
 import abc
+import hashlib
 from operator import itemgetter
-from typing import Generic, Iterable, List, Literal, Sequence, Tuple, TypeVar
+import os
+import pickle
+import shutil
+import tempfile
+from typing import (Any, Generic, Iterable, List, Literal, Optional,
+                    Sequence, Tuple, TypeVar)
+import warnings
 
 from PIL import Image
 import torch
-from transformers import (AutoTokenizer, CLIPModel, CLIPConfig,
-                          CLIPImageProcessor)
+from transformers import (AutoTokenizer, CLIPConfig, CLIPImageProcessor,
+                          CLIPModel)
+from transformers.modeling_utils import no_init_weights
 
+from image_search.core import telemetry
+from image_search.core.preprocessing import FastImageProcessor
 from image_search.core.utils import group_by_type
 
 _T = TypeVar("_T")
 Distance = Literal["cosine", "dot", "euclid", "manhattan"]
+CompileMode = Literal["none", "compile", "trace"]
+Precision = Literal["fp32", "int8", "bf16"]
+Backend = Literal["torch", "onnx"]
 
 
 class Embedder(abc.ABC, Generic[_T]):
@@ -31,6 +44,60 @@ class Embedder(abc.ABC, Generic[_T]):
         """
         raise NotImplemented
 
+    def preprocess(self,
+                   obj: _T,
+                   ) -> Any:
+        """
+        Prepare a single object for encoding. This is independent of other
+        objects and of the model, so it may run in a thread pool while
+        `encode` runs the model.
+        :param obj: input object
+        :return: model input of the object
+        """
+        return obj
+
+    def encode(self,
+               inputs: Sequence[Any],
+               ) -> Sequence[torch.Tensor]:
+        """
+        Get embeddings for preprocessed objects
+        :param inputs: results of `preprocess`
+        :return: embeddings for input objects
+        """
+        return self(inputs)
+
+
+class _TextEncoder(torch.nn.Module):
+    """Text head of a CLIP model as standalone module for compilation"""
+
+    def __init__(self,
+                 model: CLIPModel,
+                 ):
+        super().__init__()
+        self.model = model
+
+    def forward(self,
+                input_ids: torch.Tensor,
+                attention_mask: torch.Tensor,
+                ) -> torch.Tensor:
+        return self.model.get_text_features(input_ids=input_ids,
+                                            attention_mask=attention_mask)
+
+
+class _ImageEncoder(torch.nn.Module):
+    """Image head of a CLIP model as standalone module for compilation"""
+
+    def __init__(self,
+                 model: CLIPModel,
+                 ):
+        super().__init__()
+        self.model = model
+
+    def forward(self,
+                pixel_values: torch.Tensor,
+                ) -> torch.Tensor:
+        return self.model.get_image_features(pixel_values=pixel_values)
+
 
 class CLIPEmbedder(Embedder):
     """Use CLIP compatible model to embed text and/or images in vector space"""
@@ -41,50 +108,193 @@ class CLIPEmbedder(Embedder):
     def __init__(self,
                  model_path: str,
                  device: str | torch.device = torch.device("cpu"),
+                 num_threads: Optional[int] = None,
+                 num_interop_threads: Optional[int] = None,
+                 compile_mode: CompileMode = "none",
+                 warmup: bool = False,
+                 inference_mode: bool = True,
+                 fast_preprocessing: bool = False,
+                 precision: Precision = "fp32",
+                 backend: Backend = "torch",
+                 onnx_path: Optional[str] = None,
+                 normalize: bool = False,
+                 snapshot_path: Optional[str] = None,
                  ):
         """
         :param model_path: path to transformers model folder
         :param device: device (e.g., cpu, cuda, ...)
+        :param num_threads: number of intra-op threads (torch default if
+                            not set)
+        :param num_interop_threads: number of inter-op threads (torch
+                                    default if not set)
+        :param compile_mode: compile encoder heads with `torch.compile`
+                             ("compile"), trace them with TorchScript
+                             ("trace") or run them eagerly ("none")
+        :param warmup: run a dummy forward pass through both encoders
+        :param inference_mode: disable autograd during forward passes
+        :param fast_preprocessing: preprocess images with
+                                   `FastImageProcessor` instead of the
+                                   model's image processor
+        :param precision: run the linear layers with dynamically quantized
+                          int8 weights ("int8"), under bfloat16 autocast
+                          ("bf16", falls back to fp32 if the device does
+                          not support it) or in full precision ("fp32")
+        :param backend: run the encoders with torch ("torch") or export them
+                        to ONNX and run them with ONNX Runtime ("onnx", fp32
+                        only; requires the onnx and onnxruntime packages)
+        :param onnx_path: cache directory of exported ONNX encoders; each
+                          model and precision is exported to its own
+                          subdirectory, which is reused if it exists
+                          (user cache directory if not set)
+        :param normalize: L2-normalize the embeddings, so that they can be
+                          compared by dot product ("dot" distance) instead
+                          of cosine similarity
+        :param snapshot_path: file of a copy of the model's weights, which
+                              is memory-mapped if it exists and created
+                              otherwise (optional)
         """
+        _set_num_threads(num_threads, num_interop_threads)
         self._process_image = CLIPImageProcessor.from_pretrained(model_path)
+        self._fast_process_image = (FastImageProcessor(self._process_image)
+                                    if fast_preprocessing else None)
         self._tokenize = AutoTokenizer.from_pretrained(model_path)
         self._device = device
-        self._model = CLIPModel.from_pretrained(model_path).to(self._device)
-        self._model = self._model.eval()
-        self._config = CLIPConfig.from_pretrained(model_path)
+        self._model = _load_model(model_path, snapshot_path)
+        self._model = self._model.to(self._device).eval()
+        self._config = self._model.config
+        self._compile_mode = compile_mode
+        self._inference_mode = inference_mode
+        self._num_threads = num_threads
+        self._autocast = False
+        self._normalize = normalize
+        if normalize:
+            self.distance = "dot"
+        if precision == "int8":
+            self._model = torch.ao.quantization.quantize_dynamic(
+                self._model, {torch.nn.Linear}, dtype=torch.qint8,
+            )
+        elif precision == "bf16":
+            self._autocast = _supports_bf16(self._device_type)
+        elif precision != "fp32":
+            raise ValueError(f"Unknown precision: '{precision}'")
+        if backend == "onnx":
+            if precision != "fp32" or compile_mode != "none":
+                raise ValueError("The ONNX backend only supports fp32 "
+                                 "precision without compilation")
+            self._encode_text, self._encode_image = self._export_onnx(
+                os.path.join(onnx_path or _default_onnx_path(),
+                             _model_key(model_path, self._config, precision)),
+            )
+        elif backend == "torch":
+            self._encode_text, self._encode_image = self._build_encoders()
+        else:
+            raise ValueError(f"Unknown backend: '{backend}'")
+        if warmup:
+            self.warmup()
 
     def __call__(self,
                  inputs: Iterable[_INPUT_TYPE] = (),
                  ) -> Sequence[torch.Tensor]:
         """
-        Get embeddings for texts and/or images
-        :param texts: input texts
-        :param images: input images
+        Get embeddings for texts and/or images. Without fast preprocessing,
+        the images are processed in one call of the model's image processor.
+        :param inputs: input texts and/or images
         :return: embeddings for input
         """
-        texts_with_ids, images_with_ids = self._categorize_inputs(inputs)
+        inputs = list(inputs)
+        if self._fast_process_image is not None:
+            return self.encode([self.preprocess(obj) for obj in inputs])
+        image_ids = [i for i, obj in enumerate(inputs)
+                     if isinstance(obj, Image.Image)]
+        if image_ids:
+            image_inputs = self._process_image(
+                images=[inputs[i] for i in image_ids],
+                return_tensors="pt",
+            )
+            for i, pixel_values in zip(image_ids,
+                                       image_inputs["pixel_values"]):
+                inputs[i] = pixel_values
+        return self.encode(inputs)
 
-        embeddings_with_ids = []
-        if texts_with_ids:
-            text_ids, texts = zip(*texts_with_ids)
-            text_inputs = self._tokenize(text=texts,
-                                         return_tensors="pt",
-                                         padding=True,
-                                         )
-            text_embedding = self._model.get_text_features(**text_inputs)
-            embeddings_with_ids.append((text_embedding, text_ids))
-
-        if images_with_ids:
-            image_ids, images = zip(*images_with_ids)
-            image_inputs = self._process_image(images=images,
+    def preprocess(self,
+                   obj: _INPUT_TYPE,
+                   ) -> str | torch.Tensor:
+        """
+        Convert an image to pixel values; texts are tokenized in batches by
+        `encode`, since they are padded to a common length. With fast
+        preprocessing, images are only resized and cropped here and
+        normalized in batches by `encode`.
+        :param obj: text or image
+        :return: text, or pixel values (float32 or uint8) of image
+        """
+        if (isinstance(obj, Image.Image)
+                and self._fast_process_image is not None):
+            return self._fast_process_image(obj)
+        if isinstance(obj, Image.Image):
+            image_inputs = self._process_image(images=obj,
                                                return_tensors="pt",
                                                )
-            image_embedding = self._model.get_image_features(**image_inputs)
-            embeddings_with_ids.append((image_embedding, image_ids))
+            return image_inputs["pixel_values"][0]
+        return obj
+
+    def encode(self,
+               inputs: Sequence[str | torch.Tensor],
+               ) -> Sequence[torch.Tensor]:
+        """
+        Get embeddings for texts and preprocessed images
+        :param inputs: texts and/or pixel values of images
+        :return: embeddings for input
+        """
+        texts_with_ids, pixels_with_ids = self._categorize_inputs(inputs)
+        telemetry.observe_batch_size("embedder", len(inputs))
+
+        embeddings_with_ids = []
+        with torch.inference_mode(self._inference_mode), \
+                torch.autocast(self._device_type,
+                               dtype=torch.bfloat16,
+                               enabled=self._autocast,
+                               ):
+            if texts_with_ids:
+                text_ids, texts = zip(*texts_with_ids)
+                with telemetry.stage("embedder", "tokenize"):
+                    text_inputs = self._tokenize_texts(texts)
+                with telemetry.stage("embedder", "text_encoder"):
+                    text_embedding = self._encode_text(**text_inputs).float()
+                embeddings_with_ids.append((text_embedding, text_ids))
 
+            if pixels_with_ids:
+                image_ids, pixel_values = zip(*pixels_with_ids)
+                with telemetry.stage("embedder", "normalize_images"):
+                    pixel_values = torch.stack(pixel_values)
+                    if pixel_values.dtype == torch.uint8:
+                        pixel_values = self._fast_process_image.normalize(
+                            pixel_values,
+                        )
+                    pixel_values = pixel_values.to(self._device)
+                with telemetry.stage("embedder", "image_encoder"):
+                    image_embedding = self._encode_image(
+                        pixel_values=pixel_values,
+                    ).float()
+                embeddings_with_ids.append((image_embedding, image_ids))
+
+        if self._normalize:
+            embeddings_with_ids = [
+                (torch.nn.functional.normalize(embedding, dim=-1), ids)
+                for embedding, ids in embeddings_with_ids
+            ]
         embeddings = self._restore_order(*embeddings_with_ids)
         return embeddings
 
+    def warmup(self,
+               ) -> None:
+        """
+        Run dummy inputs through both encoders, so that lazy initialization
+        and compilation do not slow down the first real request
+        """
+        crop_size = self._process_image.crop_size
+        image = Image.new("RGB", (crop_size["width"], crop_size["height"]))
+        self(["warmup", image])
+
     @property
     def embedding_dim(self):
         """
@@ -92,21 +302,150 @@ class CLIPEmbedder(Embedder):
         """
         return self._config.vision_config.projection_dim
 
+    @property
+    def _device_type(self) -> str:
+        return torch.device(self._device).type
+
+    def _build_encoders(self,
+                        ) -> Tuple[torch.nn.Module, torch.nn.Module]:
+        """
+        Create the text and image encoder functions for the compile mode
+        :return: text encoder and image encoder
+        """
+        encode_text = _TextEncoder(self._model).eval()
+        encode_image = _ImageEncoder(self._model).eval()
+        if self._compile_mode == "compile":
+            return torch.compile(encode_text), torch.compile(encode_image)
+        if self._compile_mode == "trace":
+            text_inputs = self._tokenize_texts(["trace"])
+            crop_size = self._process_image.crop_size
+            pixel_values = torch.zeros(1, 3,
+                                       crop_size["height"],
+                                       crop_size["width"],
+                                       device=self._device)
+            with torch.no_grad(), warnings.catch_warnings():
+                warnings.simplefilter("ignore", torch.jit.TracerWarning)
+                encode_text = torch.jit.trace(
+                    encode_text,
+                    example_kwarg_inputs=text_inputs,
+                )
+                encode_image = torch.jit.trace(
+                    encode_image,
+                    example_kwarg_inputs={"pixel_values": pixel_values},
+                )
+            return (torch.jit.freeze(encode_text),
+                    torch.jit.freeze(encode_image))
+        if self._compile_mode != "none":
+            raise ValueError(f"Unknown compile mode: '{self._compile_mode}'")
+        return encode_text, encode_image
+
+    def _export_onnx(self,
+                     path: str,
+                     ) -> Tuple["_OnnxEncoder", "_OnnxEncoder"]:
+        """
+        Export both encoders to ONNX, unless they are already exported, and
+        load them into ONNX Runtime sessions. The encoders are exported to a
+        temporary directory, which is renamed to the final one, so that
+        processes exporting concurrently never load a partial export.
+        :param path: directory of exported encoders
+        :return: text encoder and image encoder
+        """
+        try:
+            import onnx  # noqa: F401, required by the exporter
+            import onnxruntime
+        except ImportError as exc:
+            raise ImportError("The ONNX backend requires the onnx and "
+                              "onnxruntime packages") from exc
+
+        text_path = os.path.join(path, "text_encoder.onnx")
+        image_path = os.path.join(path, "image_encoder.onnx")
+        if not os.path.exists(path):
+            parent = os.path.dirname(os.path.abspath(path))
+            os.makedirs(parent, exist_ok=True)
+            export_path = tempfile.mkdtemp(prefix=".export-", dir=parent)
+            try:
+                self._export_encoders(export_path)
+                os.rename(export_path, path)
+            except OSError:
+                if not os.path.exists(path):  # not exported by another
+                    raise
+            finally:
+                shutil.rmtree(export_path, ignore_errors=True)
+
+        options = onnxruntime.SessionOptions()
+        if self._num_threads:
+            options.intra_op_num_threads = self._num_threads
+        return tuple(
+            _OnnxEncoder(onnxruntime.InferenceSession(
+                model_path,
+                sess_options=options,
+                providers=["CPUExecutionProvider"],
+            ))
+            for model_path in (text_path, image_path)
+        )
+
+    def _export_encoders(self,
+                         path: str,
+                         ) -> None:
+        """
+        Export both encoders to ONNX
+        :param path: directory of exported encoders
+        """
+        text_inputs = self._tokenize_texts(["export"])
+        _export(_TextEncoder(self._model).eval(),
+                (text_inputs["input_ids"], text_inputs["attention_mask"]),
+                os.path.join(path, "text_encoder.onnx"),
+                input_axes={"input_ids": {0: "batch", 1: "sequence"},
+                            "attention_mask": {0: "batch", 1: "sequence"}},
+                )
+        crop_size = self._process_image.crop_size
+        pixel_values = torch.zeros(1, 3,
+                                   crop_size["height"],
+                                   crop_size["width"],
+                                   device=self._device)
+        _export(_ImageEncoder(self._model).eval(),
+                (pixel_values,),
+                os.path.join(path, "image_encoder.onnx"),
+                input_axes={"pixel_values": {0: "batch"}},
+                )
+
+    def _tokenize_texts(self,
+                        texts: Sequence[str],
+                        ) -> dict[str, torch.Tensor]:
+        """
+        Tokenize texts. Traced encoders only support the sequence length
+        they were traced with, hence texts are padded to maximum length then.
+        :param texts: input texts
+        :return: model inputs
+        """
+        padding = "max_length" if self._compile_mode == "trace" else True
+        max_length = self._config.text_config.max_position_embeddings
+        text_inputs = self._tokenize(text=texts,
+                                     return_tensors="pt",
+                                     padding=padding,
+                                     truncation=True,
+                                     max_length=max_length,
+                                     )
+        return {
+            "input_ids": text_inputs["input_ids"].to(self._device),
+            "attention_mask": text_inputs["attention_mask"].to(self._device),
+        }
+
     @staticmethod
-    def _categorize_inputs(objs: Iterable[_INPUT_TYPE],
+    def _categorize_inputs(objs: Iterable[str | torch.Tensor],
                            ) -> Tuple[Sequence[Tuple[int, str]],
-                                      Sequence[Tuple[int, Image.Image]]]:
+                                      Sequence[Tuple[int, torch.Tensor]]]:
         """
-        Split the list into a list with texts and images
-        :param objs: list of input objects
+        Split the list into a list with texts and preprocessed images
+        :param objs: list of preprocessed input objects
         :return: tuple containing (1) list with texts from input, and
-                 (2) list with images from input
+                 (2) list with pixel values of images from input
         """
         groupings = group_by_type(enumerate(objs),
                                   key=itemgetter(1),
-                                  types={str, Image.Image},
+                                  types={str, torch.Tensor},
                                   )
-        return groupings.get(str, ()), groupings.get(Image.Image, ())
+        return groupings.get(str, ()), groupings.get(torch.Tensor, ())
 
     @staticmethod
     def _restore_order(*elements_with_ids: Tuple[Sequence[_T], Sequence[int]],
@@ -122,3 +461,188 @@ class CLIPEmbedder(Embedder):
             for element, element_id in zip(elements, ids):
                 output[element_id] = element
         return output
+
+
+def embedding_key(model_path: str,
+                  precision: str = "fp32",
+                  normalize: bool = False,
+                  ) -> str:
+    """
+    Identify the embeddings of a model, e.g., to store them apart from the
+    embeddings of other models, revisions or settings; only the model's
+    configuration is loaded
+    :param model_path: path to transformers model folder
+    :param precision: precision of the model
+    :param normalize: whether the embeddings are L2-normalized
+    :return: key of the embeddings
+    """
+    config = CLIPConfig.from_pretrained(model_path)
+    key = _model_key(model_path, config, precision)
+    return f"{key}-normalized" if normalize else key
+
+
+class _OnnxEncoder:
+    """Run an exported encoder with ONNX Runtime like a torch module"""
+
+    def __init__(self,
+                 session: Any,
+                 ):
+        """
+        :param session: ONNX Runtime inference session
+        """
+        self._session = session
+
+    def __call__(self,
+                 **inputs: torch.Tensor,
+                 ) -> torch.Tensor:
+        outputs = self._session.run(None, {
+            name: tensor.cpu().numpy()
+            for name, tensor in inputs.items()
+        })
+        return torch.from_numpy(outputs[0])
+
+
+def _load_model(model_path: str,
+                snapshot_path: Optional[str] = None,
+                ) -> CLIPModel:
+    """
+    Load a model, or a snapshot of its weights, which are memory-mapped
+    instead of read into memory. Processes mapping the same snapshot share
+    its weights via the page cache, and start without parsing or copying
+    them. The snapshot only holds tensors, so it is loaded without
+    unpickling code, and is keyed by the model; it is re-created if it is
+    a snapshot of another model or in another format.
+    :param model_path: path to transformers model folder
+    :param snapshot_path: file of snapshot, created if missing (optional)
+    :return: model
+    """
+    if not snapshot_path:
+        return CLIPModel.from_pretrained(model_path)
+
+    config = CLIPConfig.from_pretrained(model_path)
+    key = _model_key(model_path, config, "fp32")
+    if os.path.exists(snapshot_path):
+        try:
+            snapshot = torch.load(snapshot_path,
+                                  mmap=True,
+                                  weights_only=True,
+                                  )
+        except (pickle.UnpicklingError, RuntimeError):
+            snapshot = None
+        if isinstance(snapshot, dict) and snapshot.get("model_key") == key:
+            with no_init_weights():  # the weights are replaced anyway
+                model = CLIPModel(config)
+            model.load_state_dict(snapshot["state_dict"], assign=True)
+            return model
+        warnings.warn(f"Snapshot '{snapshot_path}' is not a snapshot of "
+                      f"'{model_path}', re-creating it")
+
+    model = CLIPModel.from_pretrained(model_path)
+    directory = os.path.dirname(os.path.abspath(snapshot_path))
+    os.makedirs(directory, exist_ok=True)
+    with tempfile.NamedTemporaryFile(dir=directory,
+                                     delete=False,
+                                     ) as fh:
+        torch.save({"model_key": key, "state_dict": model.state_dict()}, fh)
+    os.chmod(fh.name, 0o644)  # readable by processes of other users
+    os.replace(fh.name, snapshot_path)  # never expose partial snapshots
+    return model
+
+
+def _model_key(model_path: str,
+               config: Any,
+               precision: str,
+               ) -> str:
+    """
+    Identify a model and precision, e.g., to cache artifacts derived from
+    the model. The model is identified by its name or path, its revision
+    if it was downloaded, and the files of a local model folder.
+    :param model_path: path to transformers model folder
+    :param config: model configuration
+    :param precision: precision of the model
+    :return: file name identifying the model and precision
+    """
+    identity = [model_path,
+                precision,
+                getattr(config, "_commit_hash", None) or "",
+                config.to_json_string(use_diff=False),
+                ]
+    if os.path.isdir(model_path):
+        for name in sorted(os.listdir(model_path)):
+            stat = os.stat(os.path.join(model_path, name))
+            identity.append(f"{name}:{stat.st_size}:{stat.st_mtime_ns}")
+    digest = hashlib.sha256("\0".join(identity).encode()).hexdigest()
+    name = model_path.strip("/").replace("/", "--")
+    return f"{name}-{precision}-{digest[:16]}"
+
+
+def _default_onnx_path() -> str:
+    """
+    :return: cache directory of exported ONNX encoders of the user
+    """
+    cache_home = os.getenv("XDG_CACHE_HOME",
+                           os.path.join(os.path.expanduser("~"), ".cache"))
+    return os.path.join(cache_home, "image_search", "onnx")
+
+
+def _export(encoder: torch.nn.Module,
+            inputs: Tuple[torch.Tensor, ...],
+            path: str,
+            input_axes: dict[str, dict[int, str]],
+            ) -> None:
+    """
+    Export encoder to ONNX with dynamic batch (and sequence) dimensions
+    :param encoder: encoder module
+    :param inputs: example inputs, in order of the input names
+    :param path: path of ONNX file
+    :param input_axes: dynamic axes of each input
+    """
+    with torch.no_grad(), warnings.catch_warnings():
+        warnings.simplefilter("ignore", torch.jit.TracerWarning)
+        torch.onnx.export(encoder,
+                          inputs,
+                          path,
+                          input_names=list(input_axes),
+                          output_names=["embeddings"],
+                          dynamic_axes={**input_axes,
+                                        "embeddings": {0: "batch"}},
+                          opset_version=17,
+                          )
+
+
+def _supports_bf16(device_type: str,
+                   ) -> bool:
+    """
+    Check whether the device supports bfloat16 computations efficiently
+    :param device_type: device type, e.g., "cpu" or "cuda"
+    :return: True if bfloat16 autocast should be used
+    """
+    if device_type == "cpu":
+        supported = torch.ops.mkldnn._is_mkldnn_bf16_supported()
+    elif device_type == "cuda":
+        supported = torch.cuda.is_bf16_supported()
+    else:
+        supported = False
+    if not supported:
+        warnings.warn(f"bfloat16 is not supported on '{device_type}', "
+                      f"falling back to float32")
+    return supported
+
+
+def _set_num_threads(num_threads: Optional[int] = None,
+                     num_interop_threads: Optional[int] = None,
+                     ) -> None:
+    """
+    Configure torch's CPU thread pools. Values that are not set keep torch's
+    defaults.
+    :param num_threads: number of intra-op threads
+    :param num_interop_threads: number of inter-op threads
+    """
+    if num_threads:
+        torch.set_num_threads(num_threads)
+    if num_interop_threads:
+        try:
+            torch.set_num_interop_threads(num_interop_threads)
+        except RuntimeError:  # can only be set before first parallel work
+            warnings.warn("Number of inter-op threads could not be set, "
+                          "because inter-op parallelism has already started")
@@ -0,0 +1,299 @@
+"""Append-only store of embeddings to rebuild collections without the model"""
+import contextlib
+import fcntl
+import json
+import os
+import re
+import threading
+import uuid
+from typing import Any, Iterable, Iterator, List, Optional, Sequence
+
+import numpy as np
+from qdrant_client.models import PointStruct
+import torch
+
+from image_search.core.embedding import Distance, Embedder
+
+_META_FILE = "meta.json"
+_INDEX_FILE = "index.bin"
+_VECTORS_FILE = "vectors.bin"
+_PAYLOADS_FILE = "payloads.jsonl"
+_LOCK_FILE = "lock"
+_INDEX_DTYPE = np.dtype([("id", "V16"), ("payload_end", "<i8")])
+
+
+class EmbeddingStore:
+    """
+    Embeddings, IDs and payloads of points in append-only column files, so
+    that collections can be rebuilt, e.g., with other settings, without
+    encoding the images again. Each model key, which identifies the model
+    and the settings that change its embeddings, has its own directory
+    below the root:
+      - meta.json: model key, embedding dimension and distance
+      - vectors.bin: float32 embeddings, one row per point
+      - payloads.jsonl: payloads, e.g., thumbnails, one line per point
+      - index.bin: point ID (derived from the content hash) and end offset
+                   of the payload of each point
+    Rows are written to the vectors and payloads first and committed by
+    their index entry, so a crashed writer leaves no partial points behind.
+    Multiple processes may append; writes are serialized by a file lock.
+    """
+
+    def __init__(self,
+                 root: str,
+                 model_key: str,
+                 embedding_dim: Optional[int] = None,
+                 distance: Optional[Distance] = None,
+                 ):
+        """
+        :param root: root directory of the store
+        :param model_key: key of the model that created the embeddings,
+                          see `embedding_key`
+        :param embedding_dim: embedding dimension to create the store of the
+                              model, if it does not exist yet (optional)
+        :param distance: distance of the embeddings of a new store; a store
+                         of another distance is rejected (optional)
+        """
+        self._path = os.path.join(root, _directory_name(model_key))
+        self._lock = threading.Lock()
+        os.makedirs(self._path, exist_ok=True)
+        self._meta = self._load_meta(model_key, embedding_dim, distance)
+        self._ids: set[bytes] = set()
+        self._n_rows = 0
+        self._refresh()
+
+    @property
+    def embedding_dim(self) -> int:
+        return self._meta["dim"]
+
+    @property
+    def distance(self) -> Distance:
+        return self._meta["distance"]
+
+    def append(self,
+               points: Sequence[PointStruct],
+               ) -> int:
+        """
+        Append points that are not stored yet
+        :param points: points with vectors
+        :return: number of appended points
+        """
+        with self._file_lock():
+            self._refresh()
+            new_points = {}
+            for point in points:
+                point_id = uuid.UUID(str(point.id)).bytes
+                if point_id not in self._ids:
+                    new_points.setdefault(point_id, point)
+            if not new_points:
+                return 0
+
+            vectors = np.asarray([point.vector
+                                  for point in new_points.values()],
+                                 dtype=np.float32)
+            lines = [(json.dumps(point.payload or {}) + "\n").encode("utf-8")
+                     for point in new_points.values()]
+            index = np.empty(len(new_points), dtype=_INDEX_DTYPE)
+            index["id"] = [np.void(point_id) for point_id in new_points]
+            index["payload_end"] = (self._payload_end()
+                                    + np.cumsum([len(line)
+                                                 for line in lines]))
+            self._truncate()
+            with open(self._file(_VECTORS_FILE), "ab") as fh:
+                fh.write(vectors.tobytes())
+            with open(self._file(_PAYLOADS_FILE), "ab") as fh:
+                fh.write(b"".join(lines))
+            with open(self._file(_INDEX_FILE), "ab") as fh:
+                fh.write(index.tobytes())
+            self._refresh()
+        return len(new_points)
+
+    def existing_ids(self,
+                     ids: Iterable[str],
+                     ) -> set[str]:
+        """
+        :param ids: point IDs
+        :return: IDs of the stored points
+        """
+        self._refresh()
+        return {point_id for point_id in ids
+                if uuid.UUID(point_id).bytes in self._ids}
+
+    def ids(self) -> List[str]:
+        """
+        :return: IDs of all stored points in order
+        """
+        return [str(uuid.UUID(bytes=bytes(row)))
+                for row in self._index()["id"]]
+
+    def vectors(self) -> np.ndarray:
+        """
+        :return: memory-mapped embeddings of all stored points in order
+        """
+        n_rows = len(self)
+        if not n_rows:
+            return np.empty((0, self.embedding_dim), dtype=np.float32)
+        return np.memmap(self._file(_VECTORS_FILE),
+                         dtype=np.float32,
+                         mode="r",
+                         shape=(n_rows, self.embedding_dim),
+                         )
+
+    def payloads(self) -> Iterator[dict[str, Any]]:
+        """
+        :return: payloads of all stored points in order
+        """
+        ends = self._index()["payload_end"]
+        if not len(ends):
+            return
+        with open(self._file(_PAYLOADS_FILE), "rb") as fh:
+            for end in ends.tolist():
+                yield json.loads(fh.read(end - fh.tell()))
+
+    def points(self,
+               batch_size: int = 256,
+               ) -> Iterator[List[PointStruct]]:
+        """
+        Read all stored points in batches
+        :param batch_size: number of points per batch
+        :return: batches of points
+        """
+        ids, vectors, payloads = self.ids(), self.vectors(), self.payloads()
+        for start in range(0, len(ids), batch_size):
+            yield [
+                PointStruct(id=point_id,
+                            vector=vector.tolist(),
+                            payload=payload,
+                            )
+                for point_id, vector, payload in zip(
+                    ids[start:start + batch_size],
+                    vectors[start:start + batch_size],
+                    payloads,
+                )
+            ]
+
+    def __len__(self) -> int:
+        self._refresh()
+        return self._n_rows
+
+    def _index(self) -> np.ndarray:
+        n_rows = len(self)
+        if not n_rows:
+            return np.empty(0, dtype=_INDEX_DTYPE)
+        return np.memmap(self._file(_INDEX_FILE),
+                         dtype=_INDEX_DTYPE,
+                         mode="r",
+                         shape=(n_rows,),
+                         )
+
+    def _refresh(self) -> None:
+        """Load the IDs of points committed since the last refresh"""
+        index_path = self._file(_INDEX_FILE)
+        if not os.path.exists(index_path):
+            return
+        n_rows = os.path.getsize(index_path) // _INDEX_DTYPE.itemsize
+        with self._lock:
+            if n_rows <= self._n_rows:
+                return
+            index = np.memmap(index_path,
+                              dtype=_INDEX_DTYPE,
+                              mode="r",
+                              shape=(n_rows,),
+                              )
+            self._ids.update(bytes(row)
+                             for row in index["id"][self._n_rows:])
+            self._n_rows = n_rows
+
+    def _payload_end(self) -> int:
+        """
+        :return: end offset of the payload of the last committed point
+        """
+        if not self._n_rows:
+            return 0
+        return int(self._index()["payload_end"][-1])
+
+    def _truncate(self) -> None:
+        """Remove uncommitted rows of a crashed writer; needs the lock"""
+        sizes = {
+            _INDEX_FILE: self._n_rows * _INDEX_DTYPE.itemsize,
+            _VECTORS_FILE: self._n_rows * self.embedding_dim * 4,
+            _PAYLOADS_FILE: self._payload_end(),
+        }
+        for name, size in sizes.items():
+            path = self._file(name)
+            if os.path.exists(path) and os.path.getsize(path) > size:
+                os.truncate(path, size)
+
+    def _load_meta(self,
+                   model_key: str,
+                   embedding_dim: Optional[int],
+                   distance: Optional[Distance],
+                   ) -> dict[str, Any]:
+        """
+        Load the store's metadata or initialize it for a new store
+        :param model_key: key of model
+        :param embedding_dim: embedding dimension of a new store
+        :param distance: distance of a new store
+        :return: metadata
+        """
+        meta_path = self._file(_META_FILE)
+        if not os.path.exists(meta_path):
+            if embedding_dim is None:
+                raise FileNotFoundError(f"No embedding store of model "
+                                        f"'{model_key}' in '{self._path}'")
+            meta = {"model": model_key, "dim": embedding_dim,
+                    "distance": distance or "cosine"}
+            with self._file_lock():
+                if not os.path.exists(meta_path):
+                    with open(meta_path, "w") as fh:
+                        json.dump(meta, fh)
+        with open(meta_path) as fh:
+            meta = json.load(fh)
+        if embedding_dim is not None and meta["dim"] != embedding_dim:
+            raise ValueError(f"Embedding store has dimension {meta['dim']} "
+                             f"instead of {embedding_dim}")
+        if distance is not None and meta["distance"] != distance:
+            raise ValueError(f"Embedding store has distance "
+                             f"'{meta['distance']}' instead of '{distance}'")
+        return meta
+
+    @contextlib.contextmanager
+    def _file_lock(self):
+        with open(self._file(_LOCK_FILE), "w") as fh:
+            fcntl.flock(fh, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(fh, fcntl.LOCK_UN)
+
+    def _file(self,
+              name: str,
+              ) -> str:
+        return os.path.join(self._path, name)
+
+
+class StoredEmbedder(Embedder):
+    """
+    Dimension and distance of stored embeddings, to create collections for
+    them without loading the model; it cannot embed new objects
+    """
+
+    def __init__(self,
+                 store: EmbeddingStore,
+                 ):
+        self.distance = store.distance
+        self.embedding_dim = store.embedding_dim
+
+    def __call__(self,
+                 objs: Iterable[Any],
+                 ) -> Sequence[torch.Tensor]:
+        raise NotImplementedError("Stored embeddings cannot embed objects")
+
+
+def _directory_name(model_key: str,
+                    ) -> str:
+    """
+    :param model_key: key of model, e.g., "openai/clip-vit-base-patch32"
+    :return: directory name, e.g., "openai--clip-vit-base-patch32"
+    """
+    return re.sub(r"[^\w.-]+", "--", model_key).strip("-")
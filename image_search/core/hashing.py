@@ -0,0 +1,88 @@
+"""Content hashes and the point IDs derived from them"""
+import hashlib
+import uuid
+
+from PIL import Image
+
+
+def hash_to_id(content_hash: str,
+               ) -> str:
+    """
+    Derive a point ID from a content hash, so that the same content is
+    always stored under the same ID
+    :param content_hash: hexadecimal hash; only the first 128 bits are used,
+                         and shorter hashes, e.g., perceptual hashes, are
+                         padded with zeros
+    :return: UUID string
+    """
+    return str(uuid.UUID(hex=content_hash[:32].zfill(32)))
+
+
+def content_id(data: bytes,
+               ) -> str:
+    """
+    Derive the point ID of an encoded image from its bytes, like the index
+    task and bulk-index do
+    :param data: contents of image file
+    :return: UUID string
+    """
+    return hash_to_id(hashlib.sha256(data).hexdigest())
+
+
+def object_id(obj: str | Image.Image,
+              ) -> str:
+    """
+    Derive a point ID from a text or an image. An image opened from a file
+    gets the ID of the file's contents (`content_id`), so that it is the
+    same point as the file indexed by the index task; other images get an
+    ID of their decoded pixels.
+    :param obj: text or image
+    :return: UUID string
+    """
+    if isinstance(obj, Image.Image) and getattr(obj, "filename", None):
+        with open(obj.filename, "rb") as fh:
+            return content_id(fh.read())
+    hasher = hashlib.sha256()
+    if isinstance(obj, str):
+        hasher.update(b"text:")
+        hasher.update(obj.encode("utf-8"))
+    else:
+        hasher.update(f"image:{obj.mode}:{obj.width}x{obj.height}:".encode())
+        hasher.update(obj.tobytes())
+    return hash_to_id(hasher.hexdigest())
+
+
+def perceptual_hash(image: Image.Image,
+                    hash_size: int = 8,
+                    ) -> str:
+    """
+    Compute the difference hash of an image, which is equal for images that
+    only differ in size, encoding or slight color changes. Images without
+    horizontal gradients, e.g., blank or solid-color images, all hash to 0,
+    see `has_gradients`.
+    :param image: image
+    :param hash_size: number of horizontal gradients per row and of rows
+    :return: hexadecimal hash with hash_size² bits
+    """
+    pixels = image.convert("L").resize((hash_size + 1, hash_size),
+                                       Image.Resampling.BILINEAR)
+    values = list(pixels.getdata())
+    bits = 0
+    for row in range(hash_size):
+        for col in range(hash_size):
+            left = values[row * (hash_size + 1) + col]
+            bits = (bits << 1) | (left > values[row * (hash_size + 1)
+                                                 + col + 1])
+    return f"{bits:0{hash_size * hash_size // 4}x}"
+
+
+def has_gradients(image_hash: str,
+                  ) -> bool:
+    """
+    Check whether a perceptual hash describes an image's structure, so that
+    equal hashes identify near-duplicates; blank or solid-color images all
+    share the hash 0
+    :param image_hash: hexadecimal hash of `perceptual_hash`
+    :return: True if the image has horizontal gradients
+    """
+    return int(image_hash, 16) != 0
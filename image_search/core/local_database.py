@@ -0,0 +1,688 @@
+"""In-process vector database backed by memory-mapped files"""
+import contextlib
+import fcntl
+import json
+import os
+import threading
+from typing import (Any, Iterable, List, Literal, Optional, Sequence,
+                    Tuple)
+
+import numpy as np
+from PIL.Image import Image
+from qdrant_client.models import (FieldCondition, Filter, MatchAny,
+                                  MatchExcept, MatchValue, PointStruct,
+                                  ScoredPoint)
+import torch
+
+from image_search.core import telemetry
+from image_search.core.database import (_OBJ_TYPE, SearchHit, SearchOptions,
+                                        _exclude_references,
+                                        _VectorDatabaseBase, metadata_filter)
+from image_search.core.embedding import Embedder
+from image_search.core.thumbnail import Thumbnail
+from image_search.core.utils import topk_similarity
+
+VectorType = Literal["float32", "float16"]
+
+_META_FILE = "meta.json"
+_VECTORS_FILE = "vectors.bin"
+_POINTS_FILE = "points.jsonl"
+_LOCK_FILE = "lock"
+_MIN_POINTS_PER_LIST = 40  # minimum training points per IVF centroid
+
+
+class LocalVectorDatabase(_VectorDatabaseBase):
+    """
+    Exact (or, with an IVF layer, approximate) nearest neighbor search in
+    process, without a database server. Vectors are appended to a flat file
+    and memory-mapped, payloads are appended to a JSON lines file. Multiple
+    processes may share the directory; writes are serialized by a file lock
+    and readers pick up new points before each query. The line of a point
+    commits it, so it is written after the vector; rows that a crashed
+    writer left without their line are truncated before the next write.
+    """
+
+    def __init__(self,
+                 embed: Embedder,
+                 path: str,
+                 dtype: VectorType = "float32",
+                 ivf_lists: int = 0,
+                 ivf_probes: int = 8,
+                 **kwargs,
+                 ):
+        """
+        :param embed: object embedding function
+        :param path: directory of the index, created if it does not exist
+        :param dtype: data type of stored vectors
+        :param ivf_lists: number of inverted lists of the IVF layer, 0 for
+                          exact search; the layer is only used once there are
+                          enough points to train it
+        :param ivf_probes: number of inverted lists searched per query
+        :param kwargs: caching and thumbnail options, see
+                       `_VectorDatabaseBase`
+        """
+        super().__init__(embed=embed, **kwargs)
+        if self._embed.distance not in ("cosine", "dot"):
+            raise ValueError(f"Unsupported distance for local database: "
+                             f"'{self._embed.distance}'")
+
+        self._path = path
+        self._normalize = self._embed.distance == "cosine"
+        self._lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+        self._dim, self._dtype = self._load_meta(dtype)
+
+        self._ids: List[str] = []
+        self._payloads: List[dict[str, Any]] = []
+        self._rows: dict[str, int] = {}
+        self._points_offset = 0
+        self._vectors = torch.empty((0, self._dim))
+        self._ivf = _IVFIndex(ivf_lists, ivf_probes) if ivf_lists else None
+        self._refresh()
+
+    def put(self,
+            objs: _OBJ_TYPE | Iterable[_OBJ_TYPE],
+            ids: Sequence[str] = None,
+            ) -> None:
+        """
+        Append objects to the database; as the index is append-only, objects
+        with the ID of an existing object are skipped
+        :param objs: object(s) to store
+        :param ids: IDs of the objects (derived from their contents if not
+                    set)
+        """
+        if isinstance(objs, str | Image):
+            objs = [objs]
+
+        objs = list(objs)
+        embeddings = self._embed(objs)
+        self.put_points(self._create_points(objs, embeddings, ids))
+
+    def put_points(self,
+                   points: Sequence[PointStruct],
+                   ) -> None:
+        """
+        Append points whose embeddings and payloads are already created;
+        points with the ID of an existing point are skipped
+        :param points: points
+        """
+        self._archive(points)
+        with self._file_lock():
+            self._refresh()
+            new_points = {}
+            for point in points:
+                if str(point.id) not in self._rows:
+                    new_points.setdefault(str(point.id), point)
+            if not new_points:
+                return
+            vectors = self._prepare(torch.tensor([point.vector for point
+                                                  in new_points.values()]))
+            lines = "".join(json.dumps({"id": point_id,
+                                        "payload": point.payload}) + "\n"
+                            for point_id, point in new_points.items())
+            self._truncate()
+            with open(self._file(_VECTORS_FILE), "ab") as fh:
+                fh.write(vectors.numpy().astype(self._dtype).tobytes())
+            with open(self._file(_POINTS_FILE), "a") as fh:
+                fh.write(lines)
+            self._refresh()
+
+        if self._result_cache is not None:
+            self._result_cache.invalidate()
+
+    def existing_ids(self,
+                     ids: Iterable[str],
+                     ) -> set[str]:
+        """
+        Check which objects are already in the database
+        :param ids: object IDs
+        :return: IDs of the objects in the database
+        """
+        self._refresh()
+        return {point_id for point_id in ids if point_id in self._rows}
+
+    def find_by_metadata(self,
+                         field: str,
+                         value: Any,
+                         ) -> Optional[str]:
+        """
+        Find a point by the value of a metadata field, e.g., an image with
+        the same perceptual hash; scans all payloads
+        :param field: metadata field
+        :param value: value of the field
+        :return: ID of a point with the value, None if there is none
+        """
+        self._refresh()
+        query_filter = metadata_filter(field, value)
+        return next((point_id for point_id, payload
+                     in zip(self._ids, self._payloads)
+                     if _matches(payload, query_filter)), None)
+
+    def query_similar(self,
+                      objs: _OBJ_TYPE | Iterable[_OBJ_TYPE],
+                      n_similar: int = 5,
+                      ) -> Iterable[Iterable[_OBJ_TYPE]]:
+        """
+        Get similar texts or images from the database
+        :param objs: reference text(s) or image(s)
+        :param n_similar: number of similar objects to return
+        :return: similar objects from database
+        """
+        return self._hits_to_objects(self.search(objs,
+                                                 n_similar=n_similar,
+                                                 with_thumbnails=True,
+                                                 ))
+
+    def search(self,
+               objs: _OBJ_TYPE | Iterable[_OBJ_TYPE],
+               n_similar: int = 5,
+               offset: int = 0,
+               score_threshold: float = None,
+               with_thumbnails: bool = False,
+               query_filter: Filter = None,
+               ) -> List[List[SearchHit]]:
+        """
+        Get IDs and scores of similar texts or images from the database
+        :param objs: reference text(s) or image(s)
+        :param n_similar: number of similar objects to return
+        :param offset: number of best candidates to skip, e.g., to page
+        :param score_threshold: minimum score of candidates (optional)
+        :param with_thumbnails: include thumbnails of images
+        :param query_filter: conditions on the payloads of candidates,
+                             applied during the search (optional)
+        :return: hits per query, best first
+        """
+        if isinstance(objs, str | Image):
+            objs = [objs]
+
+        return self.search_vectors(self._embed(list(objs)),
+                                   n_similar=n_similar,
+                                   offset=offset,
+                                   score_threshold=score_threshold,
+                                   with_thumbnails=with_thumbnails,
+                                   query_filter=query_filter,
+                                   )
+
+    def search_vectors(self,
+                       embeddings: Sequence[torch.Tensor],
+                       n_similar: int = 5,
+                       offset: int = 0,
+                       score_threshold: float = None,
+                       with_thumbnails: bool = False,
+                       query_filter: Filter = None,
+                       ) -> List[List[SearchHit]]:
+        """
+        Get IDs and scores of the points most similar to query embeddings,
+        e.g., to search several databases with the same embeddings
+        :param embeddings: query embeddings
+        :param n_similar: number of similar objects to return
+        :param offset: number of best candidates to skip, e.g., to page
+        :param score_threshold: minimum score of candidates (optional)
+        :param with_thumbnails: include thumbnails of images
+        :param query_filter: conditions on the payloads of candidates,
+                             applied during the search (optional)
+        :return: hits per query, best first
+        """
+        options = SearchOptions(n_similar=n_similar,
+                                offset=offset,
+                                score_threshold=score_threshold,
+                                with_thumbnails=with_thumbnails,
+                                query_filter=query_filter,
+                                )
+        keys, results, missing_ids = self._lookup_results(embeddings,
+                                                          options)
+        new_results = []
+        if missing_ids:
+            self._refresh()
+            queries = torch.stack([embeddings[obj_id]
+                                   for obj_id in missing_ids])
+            hits = self._search(self._prepare(queries), options)
+            new_results = self._extract_hits(hits, with_thumbnails)
+        return self._store_results(keys, results, missing_ids, new_results)
+
+    def search_by_ids(self,
+                      point_ids: Sequence[str],
+                      n_similar: int = 5,
+                      offset: int = 0,
+                      score_threshold: float = None,
+                      with_thumbnails: bool = False,
+                      query_filter: Filter = None,
+                      ) -> List[List[SearchHit]]:
+        """
+        Get IDs and scores of the texts or images most similar to points in
+        the database, searching by their stored vectors; the reference
+        points are left out of their own results
+        :param point_ids: IDs of reference points
+        :param n_similar: number of similar objects to return
+        :param offset: number of best candidates to skip, e.g., to page
+        :param score_threshold: minimum score of candidates (optional)
+        :param with_thumbnails: include thumbnails of images
+        :param query_filter: conditions on the payloads of candidates,
+                             applied during the search (optional)
+        :return: hits per reference point, best first
+        """
+        vectors = self.get_vectors(point_ids)
+        missing_ids = [point_id for point_id in point_ids
+                       if point_id not in vectors]
+        if missing_ids:
+            raise KeyError(f"Unknown points: {missing_ids}")
+        results = self.search_vectors([vectors[point_id]
+                                       for point_id in point_ids],
+                                      n_similar=offset + n_similar + 1,
+                                      score_threshold=score_threshold,
+                                      with_thumbnails=with_thumbnails,
+                                      query_filter=query_filter,
+                                      )
+        return _exclude_references(results, point_ids, offset, n_similar)
+
+    def get_vectors(self,
+                    point_ids: Iterable[str],
+                    ) -> dict[str, torch.Tensor]:
+        """
+        Get the stored vectors of points
+        :param point_ids: point IDs
+        :return: vectors of the points in the database by ID
+        """
+        self._refresh()
+        with self._lock:
+            rows = {point_id: self._rows[point_id] for point_id in point_ids
+                    if point_id in self._rows}
+            vectors = self._vectors
+        return {point_id: vectors[row].float()
+                for point_id, row in rows.items()}
+
+    def get_thumbnail(self,
+                      point_id: str,
+                      ) -> Optional[Thumbnail]:
+        """
+        Get the thumbnail of an image in the database
+        :param point_id: ID of the image's point
+        :return: thumbnail or None if there is none
+        """
+        self._refresh()
+        row = self._rows.get(point_id)
+        if row is None:
+            return None
+        return self._payload_to_thumbnail(self._payloads[row])
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    def _search(self,
+                queries: torch.Tensor,
+                options: SearchOptions,
+                ) -> List[List[ScoredPoint]]:
+        """
+        Search the most similar points of each query; with a filter, only
+        the matching points are searched, exactly
+        :param queries: prepared query vectors
+        :param options: page of candidates to search
+        :return: scored points per query
+        """
+        with self._lock:
+            vectors, ivf = self._vectors, self._ivf
+            ids, payloads = self._ids, self._payloads
+        with telemetry.stage("database", "search"):
+            if options.query_filter is not None:
+                scores, rows = _search_filtered(queries, vectors, payloads,
+                                                options)
+            elif ivf is not None and ivf.is_trained:
+                scores, rows = ivf.search(queries, vectors, options.limit)
+            else:
+                scores, rows = topk_similarity(queries, vectors,
+                                               options.limit)
+        scores = scores[:, options.offset:]
+        rows = rows[:, options.offset:]
+        if options.score_threshold is not None:
+            rows = rows.masked_fill(scores < options.score_threshold, -1)
+        return [
+            [
+                ScoredPoint(id=ids[row],
+                            version=0,
+                            score=score,
+                            payload=payloads[row],
+                            )
+                for score, row in zip(query_scores.tolist(),
+                                      query_rows.tolist())
+                if row >= 0
+            ]
+            for query_scores, query_rows in zip(scores, rows)
+        ]
+
+    def _prepare(self,
+                 vectors: torch.Tensor,
+                 ) -> torch.Tensor:
+        """
+        Convert vectors for storage or search, i.e., normalize them for
+        cosine similarity
+        :param vectors: embeddings
+        :return: float32 vectors
+        """
+        vectors = vectors.detach().float().cpu()
+        if self._normalize:
+            vectors = torch.nn.functional.normalize(vectors, dim=-1)
+        return vectors
+
+    def _refresh(self) -> None:
+        """Load points appended since the last refresh, e.g., by others"""
+        points_path = self._file(_POINTS_FILE)
+        if not os.path.exists(points_path):
+            return
+        if os.path.getsize(points_path) <= self._points_offset:
+            return
+
+        with self._lock:
+            with open(points_path, "rb") as fh:
+                fh.seek(self._points_offset)
+                data = fh.read()
+            complete = data[:data.rfind(b"\n") + 1]  # skip partial writes
+            if not complete:
+                return
+            ids, payloads = list(self._ids), list(self._payloads)
+            for line in complete.splitlines():
+                point = json.loads(line)
+                self._rows[point["id"]] = len(ids)
+                ids.append(point["id"])
+                payloads.append(point["payload"])
+
+            vectors = np.memmap(self._file(_VECTORS_FILE),
+                                dtype=self._dtype,
+                                mode="c",
+                                shape=(len(ids), self._dim),
+                                )
+            self._vectors = torch.from_numpy(vectors)
+            self._ids, self._payloads = ids, payloads
+            self._points_offset += len(complete)
+            if self._ivf is not None:
+                self._ivf.update(self._vectors)
+
+    def _truncate(self) -> None:
+        """
+        Remove the uncommitted vectors and the partial line of a crashed
+        writer, so that new vectors are aligned with their lines again;
+        needs the file lock
+        """
+        sizes = {
+            _VECTORS_FILE: len(self._ids) * self._dim * self._dtype.itemsize,
+            _POINTS_FILE: self._points_offset,
+        }
+        for name, size in sizes.items():
+            path = self._file(name)
+            if os.path.exists(path) and os.path.getsize(path) > size:
+                os.truncate(path, size)
+
+    def _load_meta(self,
+                   dtype: VectorType,
+                   ) -> Tuple[int, np.dtype]:
+        """
+        Load the index's vector format or initialize it for a new index
+        :param dtype: data type for a new index
+        :return: vector dimension and data type
+        """
+        meta_path = self._file(_META_FILE)
+        if not os.path.exists(meta_path):
+            meta = {"dim": self._embed.embedding_dim, "dtype": dtype}
+            with open(meta_path, "w") as fh:
+                json.dump(meta, fh)
+        with open(meta_path) as fh:
+            meta = json.load(fh)
+        return meta["dim"], np.dtype(meta["dtype"])
+
+    @contextlib.contextmanager
+    def _file_lock(self):
+        with open(self._file(_LOCK_FILE), "w") as fh:
+            fcntl.flock(fh, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(fh, fcntl.LOCK_UN)
+
+    def _file(self,
+              name: str,
+              ) -> str:
+        return os.path.join(self._path, name)
+
+
+class _IVFIndex:
+    """
+    Inverted file index: vectors are assigned to their most similar k-means
+    centroid, and only the lists of the centroids most similar to a query
+    are searched. Centroids are retrained whenever the number of vectors
+    doubled since the last training.
+    """
+
+    def __init__(self,
+                 n_lists: int,
+                 n_probes: int,
+                 n_iterations: int = 10,
+                 query_block_size: int = 64,
+                 ):
+        """
+        :param n_lists: number of centroids (inverted lists)
+        :param n_probes: number of lists searched per query
+        :param n_iterations: number of k-means iterations
+        :param query_block_size: number of queries searched together; the
+                                 union of their probed lists is scored at
+                                 once
+        """
+        self._n_lists = n_lists
+        self._n_probes = n_probes
+        self._n_iterations = n_iterations
+        self._query_block_size = query_block_size
+        self._centroids: Optional[torch.Tensor] = None
+        self._assignments = torch.empty(0, dtype=torch.long)  # list per row
+        self._n_trained = 0
+
+    @property
+    def is_trained(self) -> bool:
+        return self._centroids is not None
+
+    def update(self,
+               vectors: torch.Tensor,
+               ) -> None:
+        """
+        Assign new vectors to lists, retraining the centroids if necessary
+        :param vectors: all vectors of the database, of which the first ones
+                        have been assigned already
+        """
+        n_vectors = vectors.shape[0]
+        if n_vectors < self._n_lists * _MIN_POINTS_PER_LIST:
+            return
+        if not self.is_trained or n_vectors >= 2 * self._n_trained:
+            self._train(vectors)
+        else:
+            self._assign(vectors, start=len(self._assignments))
+
+    def search(self,
+               queries: torch.Tensor,
+               vectors: torch.Tensor,
+               k: int,
+               ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        Search the probed lists of each query. The queries of a block are
+        scored against the union of their probed lists in one matrix
+        product, masking the lists that a query does not probe.
+        :param queries: query vectors
+        :param vectors: all vectors of the database
+        :param k: number of results per query
+        :return: scores and rows of the results; missing results have a row
+                 of -1
+        """
+        n_probes = min(self._n_probes, self._n_lists)
+        _, probes = topk_similarity(queries, self._centroids, n_probes)
+        probed = torch.zeros((queries.shape[0], self._n_lists),
+                             dtype=torch.bool,
+                             ).scatter_(1, probes, True)
+        scores = torch.full((queries.shape[0], k), -torch.inf)
+        rows = torch.full((queries.shape[0], k), -1, dtype=torch.long)
+        for start in range(0, queries.shape[0], self._query_block_size):
+            block = slice(start, start + self._query_block_size)
+            block_probed = probed[block]
+            candidates = torch.nonzero(
+                block_probed.any(dim=0)[self._assignments],
+            ).squeeze(1)
+            if not len(candidates):
+                continue
+            candidate_scores = (queries[block]
+                                @ vectors[candidates].float().T)
+            candidate_scores.masked_fill_(
+                ~block_probed[:, self._assignments[candidates]], -torch.inf,
+            )
+            block_scores, positions = candidate_scores.topk(
+                min(k, len(candidates)), dim=1,
+            )
+            n_found = positions.shape[1]
+            scores[block, :n_found] = block_scores
+            rows[block, :n_found] = candidates[positions].masked_fill(
+                block_scores == -torch.inf, -1,
+            )
+        return scores, rows
+
+    def _train(self,
+               vectors: torch.Tensor,
+               ) -> None:
+        """
+        Train centroids with spherical k-means and reassign all vectors
+        :param vectors: all vectors of the database
+        """
+        sample_size = self._n_lists * 64
+        generator = torch.Generator().manual_seed(0)
+        sample_ids = torch.randperm(vectors.shape[0], generator=generator)
+        sample = vectors[sample_ids[:sample_size]].float()
+        centroids = sample[:self._n_lists].clone()
+        for _ in range(self._n_iterations):
+            assignments = _nearest_centroids(sample, centroids)
+            sums = torch.zeros_like(centroids).index_add_(0, assignments,
+                                                          sample)
+            empty = sums.norm(dim=-1) == 0
+            sums[empty] = centroids[empty]  # keep centroids without vectors
+            centroids = torch.nn.functional.normalize(sums, dim=-1)
+
+        self._centroids = centroids
+        self._n_trained = vectors.shape[0]
+        self._assign(vectors, start=0)
+
+    def _assign(self,
+                vectors: torch.Tensor,
+                start: int,
+                ) -> None:
+        """
+        Assign vectors to their most similar centroid
+        :param vectors: all vectors of the database
+        :param start: first vector to assign
+        """
+        assignments = _nearest_centroids(vectors[start:], self._centroids)
+        self._assignments = torch.cat((self._assignments[:start],
+                                       assignments))
+
+
+def _search_filtered(queries: torch.Tensor,
+                     vectors: torch.Tensor,
+                     payloads: Sequence[dict[str, Any]],
+                     options: SearchOptions,
+                     ) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    Search the points whose payloads match the filter of the options. All
+    payloads are matched in Python and the matching points are searched
+    exactly, without the IVF index, so filtered searches take time linear
+    in the number of points.
+    :param queries: prepared query vectors
+    :param vectors: all vectors of the database
+    :param payloads: payloads of all points
+    :param options: page of candidates and filter
+    :return: scores and rows of the results
+    """
+    candidates = torch.tensor([row for row, payload in enumerate(payloads)
+                               if _matches(payload, options.query_filter)],
+                              dtype=torch.long)
+    if not len(candidates):
+        empty = torch.empty((queries.shape[0], 0))
+        return empty, empty.long()
+    scores, positions = topk_similarity(queries, vectors[candidates],
+                                        options.limit)
+    return scores, candidates[positions]
+
+
+def _matches(payload: dict[str, Any],
+             query_filter: Filter,
+             ) -> bool:
+    """
+    Evaluate a filter on a payload like Qdrant: all `must` conditions, at
+    least one `should` condition (if any) and no `must_not` condition hold
+    :param payload: payload of point
+    :param query_filter: filter with field conditions and nested filters
+    :return: whether the payload matches
+    """
+    must = query_filter.must or []
+    should = query_filter.should or []
+    must_not = query_filter.must_not or []
+    return (all(_holds(payload, condition) for condition in must)
+            and (not should
+                 or any(_holds(payload, condition) for condition in should))
+            and not any(_holds(payload, condition) for condition in must_not))
+
+
+def _holds(payload: dict[str, Any],
+           condition: Any,
+           ) -> bool:
+    """
+    Evaluate a condition on a payload; only nested filters, matches and
+    ranges are supported
+    :param payload: payload of point
+    :param condition: filter or field condition
+    :return: whether the condition holds
+    """
+    if isinstance(condition, Filter):
+        return _matches(payload, condition)
+    if not isinstance(condition, FieldCondition) or (
+            condition.match is None and condition.range is None):
+        raise ValueError(f"Unsupported filter condition for local "
+                         f"database: {condition!r}")
+    values = _field_values(payload, condition.key)
+    match, bounds = condition.match, condition.range
+    if isinstance(match, MatchValue):
+        return match.value in values
+    if isinstance(match, MatchAny):
+        return any(value in match.any for value in values)
+    if isinstance(match, MatchExcept):
+        return any(value not in match.except_ for value in values)
+    if match is not None:
+        raise ValueError(f"Unsupported match for local database: "
+                         f"{match!r}")
+    return any(
+        isinstance(value, int | float)
+        and (bounds.gt is None or value > bounds.gt)
+        and (bounds.gte is None or value >= bounds.gte)
+        and (bounds.lt is None or value < bounds.lt)
+        and (bounds.lte is None or value <= bounds.lte)
+        for value in values
+    )
+
+
+def _field_values(payload: dict[str, Any],
+                  key: str,
+                  ) -> List[Any]:
+    """
+    :param payload: payload of point
+    :param key: dotted path of field, e.g., "metadata.source"
+    :return: values of the field; the elements of array fields, or none if
+             the field is missing
+    """
+    value = payload
+    for part in key.split("."):
+        if not isinstance(value, dict) or part not in value:
+            return []
+        value = value[part]
+    return value if isinstance(value, list) else [value]
+
+
+def _nearest_centroids(vectors: torch.Tensor,
+                       centroids: torch.Tensor,
+                       ) -> torch.Tensor:
+    """
+    Find the most similar centroid of each vector
+    :param vectors: vectors
+    :param centroids: centroids
+    :return: index of most similar centroid per vector
+    """
+    return topk_similarity(vectors, centroids, 1)[1][:, 0]
@@ -0,0 +1,378 @@
+"""Concurrent indexing pipeline"""
+from collections import defaultdict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+import contextlib
+from dataclasses import dataclass, field
+import queue
+import threading
+import time
+from typing import (Any, Callable, Dict, Iterable, Iterator, List, Mapping,
+                    Optional, Tuple, TypeVar)
+
+from PIL import Image
+from qdrant_client.models import PointStruct
+
+from image_search.core import telemetry
+from image_search.core.database import _VectorDatabaseBase
+from image_search.core.embedding import Embedder
+from image_search.core.hashing import has_gradients, perceptual_hash
+from image_search.core.utils import create_batches
+
+_S = TypeVar("_S")
+PERCEPTUAL_HASH_FIELD = "perceptual_hash"  # metadata field of near-duplicates
+Loader = Callable[[_S], Tuple[str, Image.Image]]
+
+
+@dataclass
+class _PreparedImage:
+    """Everything needed to create an image's point, without the image"""
+
+    point_id: str
+    payload: dict[str, Any]
+    inputs: Any
+
+
+@dataclass
+class IndexingReport:
+    """Outcome of a pipeline run"""
+
+    n_new: int = 0  # number of upserted points
+    n_failed: int = 0  # number of images that could not be loaded
+    timings: Dict[str, float] = field(default_factory=dict)  # busy seconds
+
+
+class IndexingPipeline:
+    """
+    Index images in overlapping stages:
+      1. load: decode images, create their payloads (thumbnails) and
+         preprocess them for the model in a thread pool
+      2. encode: embed full batches in the calling thread, which is the only
+         thread running the model
+      3. upsert: send points to the database in a background thread
+    The stages are connected by bounded queues, so a fast stage waits for a
+    slow one instead of piling up decoded images or pending upserts.
+    """
+
+    def __init__(self,
+                 embed: Embedder,
+                 database: _VectorDatabaseBase,
+                 load_workers: int = 4,
+                 batch_size: int = 32,
+                 queue_size: int = 2,
+                 deduplicate: bool = True,
+                 near_duplicates: bool = False,
+                 on_error: Callable[[_S, Exception], None] = None,
+                 ):
+        """
+        :param embed: embedding function
+        :param database: database with `create_payload`, `put_points` and
+                         `existing_ids`
+        :param load_workers: number of threads decoding and preprocessing
+                             images
+        :param batch_size: maximum number of images per embedding call and
+                           upsert
+        :param queue_size: maximum number of batches waiting between two
+                           stages
+        :param deduplicate: skip images whose ID is already in the database
+                            or earlier in the run
+        :param near_duplicates: store the perceptual hash of each image in
+                                its metadata, and also skip images with the
+                                perceptual hash of an image in the database
+                                (`find_by_metadata`) or earlier in the run;
+                                requires `deduplicate`. Images without
+                                gradients, e.g., blank ones, are never
+                                near-duplicates.
+        :param on_error: skip images that cannot be loaded and pass their
+                         source and the error to this function; loading
+                         errors abort the run if not set
+        """
+        self._embed = embed
+        self._database = database
+        self._load_workers = load_workers
+        self._batch_size = batch_size
+        self._queue_size = queue_size
+        self._deduplicate = deduplicate
+        self._near_duplicates = near_duplicates and deduplicate
+        self._on_error = on_error
+
+    def run(self,
+            sources: Iterable[_S],
+            load: Loader,
+            metadata: Mapping[_S, dict[str, Any]] = None,
+            ) -> IndexingReport:
+        """
+        Index images
+        :param sources: references to images, e.g., hashes of staged images
+        :param load: function loading a source's image and point ID; called
+                     from the load threads
+        :param metadata: metadata fields of the images of sources, stored in
+                         their payloads to filter searches (optional)
+        :return: number of new points and busy time per stage
+        """
+        metadata = metadata or {}
+        timer = _StageTimer()
+        report = IndexingReport()
+        seen_ids = set()
+        near_duplicates = _NearDuplicates(self._database)
+
+        def prepare(source: _S) -> Optional[_PreparedImage]:
+            with timer.measure("decode"):
+                try:
+                    point_id, image = load(source)
+                except Exception as exc:
+                    if self._on_error is None:
+                        raise
+                    self._on_error(source, exc)
+                    return None
+            image_metadata = metadata.get(source)
+            if self._near_duplicates:
+                with timer.measure("near_duplicates"):
+                    image_hash = perceptual_hash(image)
+                    image_metadata = {**(image_metadata or {}),
+                                      PERCEPTUAL_HASH_FIELD: image_hash}
+                    point_id = near_duplicates.resolve(point_id, image_hash)
+            with timer.measure("thumbnail"):
+                payload = self._database.create_payload(image,
+                                                        image_metadata)
+            with timer.measure("preprocess"):
+                inputs = self._embed.preprocess(image)
+            return _PreparedImage(point_id=point_id,
+                                  payload=payload,
+                                  inputs=inputs,
+                                  )
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=self._load_workers,
+                                thread_name_prefix="index-load",
+                                ) as executor, \
+                _Upserter(self._database, self._queue_size, timer) as upsert:
+            # loaded images ahead of the encoder: one per load thread plus
+            # the images of the batches that may wait in the queues
+            max_pending = (self._load_workers
+                           + self._queue_size * self._batch_size)
+            prepared = _map_bounded(executor, telemetry.propagate(prepare),
+                                    sources, max_pending)
+            batches = create_batches(self._count_failed(prepared, report),
+                                     batch_size=self._batch_size,
+                                     )
+            with contextlib.closing(prepared):
+                for batch in batches:
+                    batch = self._filter_new(batch, seen_ids, timer)
+                    if not batch:
+                        continue
+                    telemetry.observe_batch_size("index", len(batch))
+                    with timer.measure("encode"):
+                        embeddings = self._embed.encode([item.inputs
+                                                         for item in batch])
+                    upsert([
+                        PointStruct(id=item.point_id,
+                                    vector=embedding,
+                                    payload=item.payload,
+                                    )
+                        for item, embedding in zip(batch, embeddings)
+                    ])
+                    report.n_new += len(batch)
+
+        timer.add("total", time.perf_counter() - start)
+        report.timings = timer.timings
+        return report
+
+    @staticmethod
+    def _count_failed(prepared: Iterable[Optional[_PreparedImage]],
+                      report: IndexingReport,
+                      ) -> Iterator[_PreparedImage]:
+        """
+        Skip images that could not be loaded
+        :param prepared: prepared images, None for failed ones
+        :param report: report whose failure count is updated
+        :return: prepared images
+        """
+        for item in prepared:
+            if item is None:
+                report.n_failed += 1
+            else:
+                yield item
+
+    def _filter_new(self,
+                    batch: List[_PreparedImage],
+                    seen_ids: set,
+                    timer: "_StageTimer",
+                    ) -> List[_PreparedImage]:
+        """
+        Remove images that are already indexed or queued for upserting
+        :param batch: prepared images
+        :param seen_ids: IDs of images of previous batches, updated in place
+        :param timer: stage timer
+        :return: new images
+        """
+        if not self._deduplicate:
+            return batch
+        with timer.measure("deduplicate"):
+            existing_ids = self._database.existing_ids(
+                item.point_id for item in batch
+            )
+        new_items = []
+        for item in batch:
+            if item.point_id in existing_ids or item.point_id in seen_ids:
+                continue
+            seen_ids.add(item.point_id)
+            new_items.append(item)
+        return new_items
+
+
+class _NearDuplicates:
+    """Map images to the first image with their perceptual hash"""
+
+    def __init__(self,
+                 database: _VectorDatabaseBase,
+                 ):
+        """
+        :param database: database with `find_by_metadata`
+        """
+        self._database = database
+        self._ids: Dict[str, str] = {}
+        self._lock = threading.Lock()
+
+    def resolve(self,
+                point_id: str,
+                image_hash: str,
+                ) -> str:
+        """
+        :param point_id: point ID of an image
+        :param image_hash: perceptual hash of the image
+        :return: ID of the indexed image or of the earlier image of the run
+                 with the same perceptual hash, otherwise the given ID
+        """
+        if not has_gradients(image_hash):
+            return point_id
+        with self._lock:
+            if image_hash in self._ids:
+                return self._ids[image_hash]
+        existing_id = self._database.find_by_metadata(PERCEPTUAL_HASH_FIELD,
+                                                      image_hash)
+        with self._lock:
+            return self._ids.setdefault(image_hash, existing_id or point_id)
+
+
+class _Upserter:
+    """Upsert batches of points in a background thread"""
+
+    def __init__(self,
+                 database: _VectorDatabaseBase,
+                 queue_size: int,
+                 timer: "_StageTimer",
+                 ):
+        """
+        :param database: database
+        :param queue_size: maximum number of batches waiting for upsert;
+                           further batches block the caller
+        :param timer: stage timer
+        """
+        self._database = database
+        self._timer = timer
+        self._batches: queue.Queue[Optional[List[PointStruct]]] = queue.Queue(
+            maxsize=queue_size,
+        )
+        self._error: Optional[BaseException] = None
+        self._thread = threading.Thread(target=telemetry.propagate(self._run),
+                                        name="index-upsert",
+                                        daemon=True,
+                                        )
+
+    def __enter__(self) -> Callable[[List[PointStruct]], None]:
+        self._thread.start()
+        return self._put
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self._batches.put(None)
+        self._thread.join()
+        if self._error is not None and exc_value is None:
+            raise self._error
+
+    def _put(self,
+             points: List[PointStruct],
+             ) -> None:
+        """
+        Queue points for upsert; blocks while the queue is full
+        :param points: points
+        """
+        if self._error is not None:
+            raise self._error
+        self._batches.put(points)
+        telemetry.set_queue_depth("upsert", self._batches.qsize())
+
+    def _run(self) -> None:
+        while (points := self._batches.get()) is not None:
+            if self._error is not None:
+                continue  # drain queue after failure
+            try:
+                with self._timer.measure("upsert"):
+                    self._database.put_points(points)
+            except BaseException as exc:
+                self._error = exc
+
+
+class _StageTimer:
+    """Thread-safe accumulation of the time spent in each stage"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._timings: Dict[str, float] = defaultdict(float)
+
+    @contextlib.contextmanager
+    def measure(self,
+                stage: str,
+                ) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            with telemetry.stage("index", stage):
+                yield
+        finally:
+            self.add(stage, time.perf_counter() - start, observe=False)
+
+    def add(self,
+            stage: str,
+            seconds: float,
+            observe: bool = True,
+            ) -> None:
+        """
+        :param stage: stage
+        :param seconds: time spent in stage
+        :param observe: also record the time in the stage metrics
+        """
+        with self._lock:
+            self._timings[stage] += seconds
+        if observe:
+            telemetry.observe_stage("index", stage, seconds)
+
+    @property
+    def timings(self) -> Dict[str, float]:
+        with self._lock:
+            return dict(self._timings)
+
+
+def _map_bounded(executor: ThreadPoolExecutor,
+                 func: Callable[[_S], Any],
+                 items: Iterable[_S],
+                 max_pending: int,
+                 ) -> Iterator[Any]:
+    """
+    Like `executor.map`, but submits items lazily, so that at most a given
+    number of results is pending or waiting to be consumed
+    :param executor: executor
+    :param func: function
+    :param items: function arguments
+    :param max_pending: maximum number of submitted, unconsumed items
+    :return: results in order of the items
+    """
+    pending: deque[Future] = deque()
+    try:
+        for item in items:
+            if len(pending) >= max_pending:
+                yield pending.popleft().result()
+            pending.append(executor.submit(func, item))
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        for future in pending:
+            future.cancel()
@@ -0,0 +1,92 @@
+"""Fast image preprocessing for CLIP models"""
+from typing import Sequence, Tuple
+
+import numpy as np
+from PIL import Image
+import torch
+from transformers import CLIPImageProcessor
+
+
+class FastImageProcessor:
+    """
+    Reimplementation of a `CLIPImageProcessor` with the same resize,
+    center-crop and normalization settings. Images are resized and cropped
+    with Pillow only, without conversions to float arrays in between, and
+    kept as uint8 tensors; a whole batch is then rescaled and normalized in
+    a single vectorized operation.
+    """
+
+    def __init__(self,
+                 processor: CLIPImageProcessor,
+                 ):
+        """
+        :param processor: processor whose settings to use
+        """
+        self._do_convert_rgb = processor.do_convert_rgb
+        self._do_resize = processor.do_resize
+        self._size = processor.size
+        self._resample = Image.Resampling(processor.resample)
+        self._do_center_crop = processor.do_center_crop
+        self._crop_size = processor.crop_size
+        scale = processor.rescale_factor if processor.do_rescale else 1.0
+        mean = processor.image_mean if processor.do_normalize else [0.0] * 3
+        std = processor.image_std if processor.do_normalize else [1.0] * 3
+        mean = torch.tensor(mean).view(1, 3, 1, 1)
+        std = torch.tensor(std).view(1, 3, 1, 1)
+        # (x * scale - mean) / std = x * (scale / std) - mean / std
+        self._scale = scale / std
+        self._offset = mean / std
+
+    def __call__(self,
+                 image: Image.Image,
+                 ) -> torch.Tensor:
+        """
+        Resize and crop an image
+        :param image: image
+        :return: uint8 tensor (channels × height × width)
+        """
+        if self._do_convert_rgb and image.mode != "RGB":
+            image = image.convert("RGB")
+        if self._do_resize:
+            image = image.resize(self._output_size(image.size),
+                                 resample=self._resample,
+                                 )
+        if self._do_center_crop:
+            width, height = image.size
+            crop_width = self._crop_size["width"]
+            crop_height = self._crop_size["height"]
+            left = (width - crop_width) // 2
+            top = (height - crop_height) // 2
+            image = image.crop((left, top,
+                                left + crop_width, top + crop_height))
+        pixels = torch.from_numpy(np.array(image, dtype=np.uint8))
+        return pixels.permute(2, 0, 1)
+
+    def normalize(self,
+                  pixels: Sequence[torch.Tensor] | torch.Tensor,
+                  ) -> torch.Tensor:
+        """
+        Rescale and normalize a batch of images
+        :param pixels: uint8 tensors of the same size, or a stacked batch
+        :return: float32 pixel values (batch × channels × height × width)
+        """
+        if not isinstance(pixels, torch.Tensor):
+            pixels = torch.stack(tuple(pixels))
+        pixels = pixels.to(torch.float32)
+        return pixels.mul_(self._scale).sub_(self._offset)
+
+    def _output_size(self,
+                     size: Tuple[int, int],
+                     ) -> Tuple[int, int]:
+        """
+        Compute the size of a resized image like the processor does
+        :param size: width and height of the image
+        :return: width and height of the resized image
+        """
+        if "shortest_edge" not in self._size:
+            return self._size["width"], self._size["height"]
+        width, height = size
+        edge = self._size["shortest_edge"]
+        if width <= height:
+            return edge, int(edge * height / width)
+        return int(edge * width / height), edge
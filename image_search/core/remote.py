@@ -0,0 +1,162 @@
+"""Embed texts and images with a model hosted by an embedding server"""
+import base64
+import functools
+import io
+from typing import Any, Dict, Iterable, Optional, Sequence
+
+import httpx
+import numpy as np
+from PIL import Image
+import torch
+
+from image_search.core import telemetry
+from image_search.core.embedding import Distance, Embedder
+
+EMBEDDINGS_MEDIA_TYPE = "application/x-npy"
+
+
+class RemoteEmbedder(Embedder):
+    """
+    Send texts and images to an embedding server (see
+    `image_search.app.embedding_server`), so that several processes share
+    a single model and its dynamic batching
+    """
+
+    def __init__(self,
+                 url: str,
+                 socket_path: Optional[str] = None,
+                 image_size: int = 0,
+                 timeout: float = 60.0,
+                 retries: int = 3,
+                 ):
+        """
+        :param url: base URL of embedding server, e.g.,
+                    "http://localhost:8081"
+        :param socket_path: path of the server's Unix domain socket; the
+                            host of the URL is ignored then (optional)
+        :param image_size: downscale images so that their shorter edge is
+                           at most this size before sending them; should be
+                           the model's input size (0 to send full images)
+        :param timeout: timeout of requests in seconds
+        :param retries: number of retries of failed connection attempts
+        """
+        transport = httpx.HTTPTransport(uds=socket_path, retries=retries)
+        self._client = httpx.Client(base_url=url,
+                                    transport=transport,
+                                    timeout=timeout,
+                                    )
+        self._image_size = image_size
+
+    def __call__(self,
+                 inputs: Iterable[str | Image.Image] = (),
+                 ) -> Sequence[torch.Tensor]:
+        """
+        Get embeddings for texts and/or images
+        :param inputs: input texts and/or images
+        :return: embeddings for input
+        """
+        return self.encode([self.preprocess(obj) for obj in inputs])
+
+    def preprocess(self,
+                   obj: str | Image.Image,
+                   ) -> str | Dict[str, Any]:
+        """
+        Convert an image to a request item with its downscaled RGB pixels;
+        texts are sent as they are
+        :param obj: text or image
+        :return: text, or request item of image
+        """
+        if not isinstance(obj, Image.Image):
+            return obj
+        if obj.mode != "RGB":
+            obj = obj.convert("RGB")
+        if self._image_size and min(obj.size) > self._image_size:
+            obj = obj.resize(_shortest_edge_size(obj.size, self._image_size),
+                             resample=Image.Resampling.BICUBIC,
+                             )
+        return {
+            "image": base64.b64encode(obj.tobytes()).decode("ascii"),
+            "width": obj.width,
+            "height": obj.height,
+        }
+
+    def encode(self,
+               inputs: Sequence[str | Dict[str, Any]],
+               ) -> Sequence[torch.Tensor]:
+        """
+        Get embeddings for texts and preprocessed images in one request
+        :param inputs: texts and/or request items of images
+        :return: embeddings for input
+        """
+        if not inputs:
+            return []
+        items = [{"text": obj} if isinstance(obj, str) else obj
+                 for obj in inputs]
+        with telemetry.stage("embedder", "remote"):
+            response = self._client.post("/embed", json={"inputs": items})
+        response.raise_for_status()
+        embeddings = np.load(io.BytesIO(response.content))
+        return list(torch.from_numpy(embeddings))
+
+    @property
+    def distance(self) -> Distance:
+        return self._info["distance"]
+
+    @property
+    def embedding_dim(self) -> int:
+        return self._info["embedding_dim"]
+
+    @functools.cached_property
+    def _info(self) -> Dict[str, Any]:
+        """
+        :return: distance and embedding dimension of the server's model
+        """
+        response = self._client.get("/info")
+        response.raise_for_status()
+        return response.json()
+
+    def close(self) -> None:
+        self._client.close()
+
+
+def encode_embeddings(embeddings: Sequence[torch.Tensor],
+                      ) -> bytes:
+    """
+    Serialize embeddings for a response of the embedding server
+    :param embeddings: embeddings of the same size
+    :return: float32 matrix in NumPy format
+    """
+    buffer = io.BytesIO()
+    matrix = (torch.stack(tuple(embeddings)).float().numpy()
+              if len(embeddings) else np.empty((0, 0), dtype=np.float32))
+    np.save(buffer, matrix, allow_pickle=False)
+    return buffer.getvalue()
+
+
+def decode_image(item: Dict[str, Any],
+                 ) -> Image.Image:
+    """
+    Deserialize an image sent by `RemoteEmbedder`
+    :param item: request item of image
+    :return: RGB image
+    """
+    return Image.frombytes("RGB",
+                           (item["width"], item["height"]),
+                           base64.b64decode(item["image"]),
+                           )
+
+
+def _shortest_edge_size(size: tuple[int, int],
+                        edge: int,
+                        ) -> tuple[int, int]:
+    """
+    Compute the size of an image resized to a given shorter edge, rounding
+    like CLIP's image processor
+    :param size: width and height of image
+    :param edge: size of shorter edge
+    :return: width and height of resized image
+    """
+    width, height = size
+    if width <= height:
+        return edge, int(edge * height / width)
+    return int(edge * width / height), edge
@@ -0,0 +1,477 @@
+"""Database partitioned into several collections, e.g., on several nodes"""
+from concurrent.futures import Executor, Future, ThreadPoolExecutor
+import concurrent.futures
+import contextlib
+import heapq
+import itertools
+import logging
+from typing import (Any, Callable, Dict, Iterable, Iterator, List, Mapping,
+                    Optional, Sequence)
+import zlib
+
+from PIL.Image import Image
+from qdrant_client.models import Filter, PointStruct
+import torch
+
+from image_search.core import telemetry
+from image_search.core.cache import Cache, tensor_key
+from image_search.core.database import (_OBJ_TYPE, METADATA_KEY, SearchHit,
+                                        SearchOptions, _exclude_references,
+                                        _VectorDatabaseBase)
+from image_search.core.embedding import Embedder
+from image_search.core.hashing import object_id
+from image_search.core.thumbnail import Thumbnail
+
+logger = logging.getLogger(__name__)
+
+Partition = Callable[[str], str]
+
+
+class ShardedDatabase:
+    """
+    Points partitioned into shards, i.e., databases of the same model, e.g.,
+    collections per tenant, time period or image source. Points are put into
+    the shard of their partition key, e.g., the value of a metadata field.
+    Queries are embedded once and searched in all (or selected) shards
+    concurrently; the candidates of the shards are merged by score. Shards
+    that do not answer in time are left out, so that one slow shard only
+    makes the results partial.
+    """
+
+    def __init__(self,
+                 embed: Embedder,
+                 shards: Mapping[str, _VectorDatabaseBase],
+                 partition: Partition = None,
+                 partition_field: str = None,
+                 timeout: float = None,
+                 result_cache: Cache = None,
+                 executor: Executor = None,
+                 ):
+        """
+        :param embed: object embedding function shared by all shards
+        :param shards: databases by shard name; they must not share a result
+                       cache, as its keys do not include the shard
+        :param partition: name of the shard of a partition key (hash of the
+                          key if not set)
+        :param partition_field: metadata field of the partition key of a
+                                point (ID of the point if not set, or if the
+                                point has no such field)
+        :param timeout: maximum time in seconds to wait for the results of a
+                        shard (no limit if not set)
+        :param result_cache: cache for complete search results, which is
+                             invalidated whenever objects are put into a
+                             shard
+        :param executor: executor for shard requests; a shard that does not
+                         answer in time keeps its worker busy (thread pool
+                         with four workers per shard if not set)
+        """
+        if not shards:
+            raise ValueError("Sharded database without shards")
+        self._embed = embed
+        self._shards = dict(shards)
+        self._partition = partition or hash_partition(list(self._shards))
+        self._partition_field = partition_field
+        self._timeout = timeout
+        self._result_cache = result_cache
+        self._executor = executor or ThreadPoolExecutor(
+            max_workers=4 * len(self._shards),
+            thread_name_prefix="shard",
+        )
+
+    @property
+    def shard_names(self) -> List[str]:
+        return list(self._shards)
+
+    def create_payload(self,
+                       obj: _OBJ_TYPE,
+                       metadata: dict[str, Any] = None,
+                       ) -> dict[str, Any]:
+        """
+        Create the payload of an object's point; all shards create the same
+        payloads
+        :param obj: text or image
+        :param metadata: fields to filter searches by (optional)
+        :return: payload
+        """
+        shard = next(iter(self._shards.values()))
+        return shard.create_payload(obj, metadata)
+
+    def put(self,
+            objs: _OBJ_TYPE | Iterable[_OBJ_TYPE],
+            ids: Sequence[str] = None,
+            partition_key: str = None,
+            ) -> None:
+        """
+        Put objects into the shard of their partition key
+        :param objs: object(s) to store
+        :param ids: IDs of the objects (derived from their contents if not
+                    set)
+        :param partition_key: partition key of all objects, e.g., a tenant
+                              (partition field or ID of each object if not
+                              set)
+        """
+        if isinstance(objs, str | Image):
+            objs = [objs]
+
+        objs = list(objs)
+        if ids is None:
+            ids = [object_id(obj) for obj in objs]
+        embeddings = self._embed(objs)
+        self.put_points([
+            PointStruct(id=str(point_id),
+                        vector=embedding,
+                        payload=self.create_payload(obj),
+                        )
+            for point_id, embedding, obj in zip(ids, embeddings, objs)
+        ], partition_key=partition_key)
+
+    def put_points(self,
+                   points: Sequence[PointStruct],
+                   partition_key: str = None,
+                   ) -> None:
+        """
+        Put points whose embeddings and payloads are already created into
+        the shard of their partition key
+        :param points: points
+        :param partition_key: partition key of all points (partition field or
+                              ID of each point if not set)
+        """
+        points_by_shard: Dict[str, List[PointStruct]] = {}
+        for point in points:
+            shard = self._partition(partition_key
+                                    or self._partition_key(point))
+            if shard not in self._shards:
+                raise KeyError(f"Unknown shard: '{shard}'")
+            points_by_shard.setdefault(shard, []).append(point)
+        for future in [self._submit(shard, "put_points", shard_points)
+                       for shard, shard_points in points_by_shard.items()]:
+            future.result()
+        if self._result_cache is not None:
+            self._result_cache.invalidate()
+
+    def existing_ids(self,
+                     ids: Iterable[str],
+                     ) -> set[str]:
+        """
+        Check which objects are already in any shard
+        :param ids: object IDs
+        :return: IDs of the objects in the database
+        """
+        ids = list(ids)
+        futures = [self._submit(shard, "existing_ids", ids)
+                   for shard in self._shards]
+        return set().union(*(future.result() for future in futures))
+
+    def find_by_metadata(self,
+                         field: str,
+                         value: Any,
+                         ) -> Optional[str]:
+        """
+        Find a point in any shard by the value of a metadata field
+        :param field: metadata field
+        :param value: value of the field
+        :return: ID of a point with the value, None if there is none
+        """
+        futures = [self._submit(shard, "find_by_metadata", field, value)
+                   for shard in self._shards]
+        return next((point_id for point_id in (future.result()
+                                               for future in futures)
+                     if point_id is not None), None)
+
+    def query_similar(self,
+                      objs: _OBJ_TYPE | Iterable[_OBJ_TYPE],
+                      n_similar: int = 5,
+                      shards: Sequence[str] = None,
+                      ) -> List[List[str]]:
+        """
+        Get similar texts or images from the shards
+        :param objs: reference text(s) or image(s)
+        :param n_similar: number of similar objects to return
+        :param shards: names of the shards to search (all if not set)
+        :return: similar objects from database
+        """
+        return _VectorDatabaseBase._hits_to_objects(
+            self.search(objs,
+                        n_similar=n_similar,
+                        with_thumbnails=True,
+                        shards=shards,
+                        )
+        )
+
+    def search(self,
+               objs: _OBJ_TYPE | Iterable[_OBJ_TYPE],
+               n_similar: int = 5,
+               offset: int = 0,
+               score_threshold: float = None,
+               with_thumbnails: bool = False,
+               query_filter: Filter = None,
+               shards: Sequence[str] = None,
+               ) -> List[List[SearchHit]]:
+        """
+        Get IDs and scores of similar texts or images from the shards
+        :param objs: reference text(s) or image(s)
+        :param n_similar: number of similar objects to return
+        :param offset: number of best candidates to skip, e.g., to page
+        :param score_threshold: minimum score of candidates (optional)
+        :param with_thumbnails: include thumbnails of images
+        :param query_filter: conditions on the payloads of candidates,
+                             applied during the search (optional)
+        :param shards: names of the shards to search (all if not set)
+        :return: hits per query, best first
+        """
+        if isinstance(objs, str | Image):
+            objs = [objs]
+
+        return self.search_vectors(self._embed(list(objs)),
+                                   n_similar=n_similar,
+                                   offset=offset,
+                                   score_threshold=score_threshold,
+                                   with_thumbnails=with_thumbnails,
+                                   query_filter=query_filter,
+                                   shards=shards,
+                                   )
+
+    def search_vectors(self,
+                       embeddings: Sequence[torch.Tensor],
+                       n_similar: int = 5,
+                       offset: int = 0,
+                       score_threshold: float = None,
+                       with_thumbnails: bool = False,
+                       query_filter: Filter = None,
+                       shards: Sequence[str] = None,
+                       ) -> List[List[SearchHit]]:
+        """
+        Search query embeddings in the shards concurrently and merge the
+        candidates by score; each shard returns its best `offset +
+        n_similar` candidates, so that the merged page is exact
+        :param embeddings: query embeddings
+        :param n_similar: number of similar objects to return
+        :param offset: number of best candidates to skip, e.g., to page
+        :param score_threshold: minimum score of candidates (optional)
+        :param with_thumbnails: include thumbnails of images
+        :param query_filter: conditions on the payloads of candidates,
+                             applied during the search (optional)
+        :param shards: names of the shards to search (all if not set)
+        :return: hits per query, best first
+        """
+        shards = tuple(self._shards if shards is None else shards)
+        unknown_shards = set(shards) - set(self._shards)
+        if not shards:
+            raise ValueError("No shards to search")
+        if unknown_shards:
+            raise KeyError(f"Unknown shards: {sorted(unknown_shards)}")
+        options = SearchOptions(n_similar=n_similar,
+                                offset=offset,
+                                score_threshold=score_threshold,
+                                with_thumbnails=with_thumbnails,
+                                query_filter=query_filter,
+                                )
+        keys = []
+        if self._result_cache is not None:
+            version = self._result_cache.version()
+            keys = [(tensor_key(embedding), options, shards, version)
+                    for embedding in embeddings]
+            results = [self._result_cache.get(key) for key in keys]
+            if all(result is not None for result in results):
+                return results
+
+        futures = {
+            shard: self._submit(shard, "search_vectors", embeddings,
+                                n_similar=options.limit,
+                                score_threshold=score_threshold,
+                                with_thumbnails=with_thumbnails,
+                                query_filter=query_filter,
+                                )
+            for shard in shards
+        }
+        shard_results = self._collect(futures)
+        results = [
+            list(itertools.islice(
+                heapq.merge(*candidates,
+                            key=lambda hit: hit.score,
+                            reverse=True,
+                            ),
+                offset, options.limit,
+            ))
+            for candidates in zip(*shard_results)
+        ]
+        if (self._result_cache is not None
+                and len(shard_results) == len(shards)):  # not partial
+            for key, result in zip(keys, results):
+                self._result_cache.set(key, result)
+        return results
+
+    def search_by_ids(self,
+                      point_ids: Sequence[str],
+                      n_similar: int = 5,
+                      offset: int = 0,
+                      score_threshold: float = None,
+                      with_thumbnails: bool = False,
+                      query_filter: Filter = None,
+                      shards: Sequence[str] = None,
+                      ) -> List[List[SearchHit]]:
+        """
+        Get IDs and scores of the texts or images most similar to points in
+        any shard, searching all (or selected) shards by the stored vectors;
+        the reference points are left out of their own results
+        :param point_ids: IDs of reference points
+        :param n_similar: number of similar objects to return
+        :param offset: number of best candidates to skip, e.g., to page
+        :param score_threshold: minimum score of candidates (optional)
+        :param with_thumbnails: include thumbnails of images
+        :param query_filter: conditions on the payloads of candidates,
+                             applied during the search (optional)
+        :param shards: names of the shards to search (all if not set)
+        :return: hits per reference point, best first
+        """
+        vectors = self.get_vectors(point_ids)
+        missing_ids = [point_id for point_id in point_ids
+                       if point_id not in vectors]
+        if missing_ids:
+            raise KeyError(f"Unknown points: {missing_ids}")
+        results = self.search_vectors([vectors[point_id]
+                                       for point_id in point_ids],
+                                      n_similar=offset + n_similar + 1,
+                                      score_threshold=score_threshold,
+                                      with_thumbnails=with_thumbnails,
+                                      query_filter=query_filter,
+                                      shards=shards,
+                                      )
+        return _exclude_references(results, point_ids, offset, n_similar)
+
+    def get_vectors(self,
+                    point_ids: Iterable[str],
+                    ) -> dict[str, torch.Tensor]:
+        """
+        Get the stored vectors of points from all shards
+        :param point_ids: point IDs
+        :return: vectors of the points in the database by ID
+        """
+        point_ids = list(point_ids)
+        futures = [self._submit(shard, "get_vectors", point_ids)
+                   for shard in self._shards]
+        return {point_id: vector
+                for future in futures
+                for point_id, vector in future.result().items()}
+
+    def get_thumbnail(self,
+                      point_id: str,
+                      ) -> Optional[Thumbnail]:
+        """
+        Get the thumbnail of an image from the shard that contains it
+        :param point_id: ID of the image's point
+        :return: thumbnail or None if there is none
+        """
+        futures = [self._submit(shard, "get_thumbnail", point_id)
+                   for shard in self._shards]
+        for future in futures:
+            thumbnail = future.result()
+            if thumbnail is not None:
+                return thumbnail
+        return None
+
+    @contextlib.contextmanager
+    def bulk_load(self) -> Iterator[None]:
+        """
+        Defer building the index of every shard that supports it while many
+        points are put, see `QdrantVectorDatabase.bulk_load`
+        """
+        with contextlib.ExitStack() as stack:
+            for shard in self._shards.values():
+                if hasattr(shard, "bulk_load"):
+                    stack.enter_context(shard.bulk_load())
+            yield
+
+    def _partition_key(self,
+                       point: PointStruct,
+                       ) -> str:
+        """
+        :param point: point
+        :return: value of the partition field of the point's metadata, or
+                 its ID if it has no such field
+        """
+        if self._partition_field is not None:
+            metadata = (point.payload or {}).get(METADATA_KEY) or {}
+            if metadata.get(self._partition_field) is not None:
+                return str(metadata[self._partition_field])
+        return str(point.id)
+
+    def _submit(self,
+                shard: str,
+                method: str,
+                *args,
+                **kwargs,
+                ) -> Future:
+        """
+        Call a method of a shard in the executor
+        :param shard: name of shard
+        :param method: name of method
+        :param args: positional arguments of method
+        :param kwargs: keyword arguments of method
+        :return: future of the method's result
+        """
+        func = getattr(self._shards[shard], method)
+
+        def run():
+            with telemetry.stage("shard", shard):
+                return func(*args, **kwargs)
+        return self._executor.submit(telemetry.propagate(run))
+
+    def _collect(self,
+                 futures: Mapping[str, Future],
+                 ) -> List[Any]:
+        """
+        Wait for the results of shards until the timeout; shards that fail
+        or do not answer in time are logged and left out
+        :param futures: futures of results by shard name
+        :return: results of the answering shards
+        """
+        done, _ = concurrent.futures.wait(futures.values(),
+                                          timeout=self._timeout)
+        results, errors = [], []
+        for shard, future in futures.items():
+            if future not in done:
+                future.cancel()
+                logger.warning("Shard '%s' did not answer within %s s",
+                               shard, self._timeout)
+            elif future.exception() is not None:
+                errors.append(future.exception())
+                logger.warning("Shard '%s' failed: %r",
+                               shard, future.exception())
+            else:
+                results.append(future.result())
+        if not results and errors:
+            raise errors[0]
+        if not results:
+            raise TimeoutError(f"No shard answered within {self._timeout} s")
+        return results
+
+
+def hash_partition(shards: Sequence[str],
+                   ) -> Partition:
+    """
+    Partition keys by a hash that is stable across processes
+    :param shards: names of shards
+    :return: function returning the shard name of a partition key
+    """
+    shards = list(shards)
+
+    def partition(key: str) -> str:
+        return shards[zlib.crc32(key.encode("utf-8")) % len(shards)]
+    return partition
+
+
+def named_partition(shards: Sequence[str],
+                    ) -> Partition:
+    """
+    Partition keys that name a shard into that shard, and all other keys,
+    e.g., point IDs, by their hash
+    :param shards: names of shards
+    :return: function returning the shard name of a partition key
+    """
+    names = set(shards)
+    hashed = hash_partition(shards)
+
+    def partition(key: str) -> str:
+        return key if key in names else hashed(key)
+    return partition
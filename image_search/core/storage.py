@@ -0,0 +1,220 @@
+"""Content-addressed storage of binary objects on the filesystem"""
+import contextlib
+import hashlib
+import io
+import mmap
+import os
+import shutil
+import tempfile
+import time
+from typing import BinaryIO, Iterable, Iterator
+
+
+class BlobStore:
+    """
+    Store blobs under their SHA-256 hash, so that identical contents are
+    stored only once. Every blob is referenced by one or more owners, e.g.,
+    jobs, through hard links; a blob is deleted once its last owner released
+    it.
+
+    Layout of the root directory:
+      - blobs/<hash[:2]>/<hash>: blob contents
+      - refs/<owner>/<hash>: hard links to the blobs of an owner
+      - tmp/: partially written blobs
+    """
+
+    def __init__(self,
+                 root: str,
+                 ):
+        """
+        :param root: root directory, which can be shared between processes
+                     and hosts
+        """
+        self._root = root
+        self._blob_dir = os.path.join(root, "blobs")
+        self._ref_dir = os.path.join(root, "refs")
+        self._tmp_dir = os.path.join(root, "tmp")
+        for directory in (self._blob_dir, self._ref_dir, self._tmp_dir):
+            os.makedirs(directory, exist_ok=True)
+
+    def put(self,
+            data: bytes,
+            owner: str,
+            ) -> str:
+        """
+        Store blob
+        :param data: contents
+        :param owner: owner of the reference to the blob
+        :return: hash of the blob
+        """
+        return self.put_stream([data], owner)
+
+    def put_stream(self,
+                   chunks: Iterable[bytes],
+                   owner: str,
+                   ) -> str:
+        """
+        Store blob from chunks without holding the contents in memory
+        :param chunks: chunks of contents
+        :param owner: owner of the reference to the blob
+        :return: hash of the blob
+        """
+        writer = self.writer(owner)
+        try:
+            for chunk in chunks:
+                writer.write(chunk)
+        except BaseException:
+            writer.abort()
+            raise
+        return writer.close()
+
+    def writer(self,
+               owner: str,
+               ) -> "BlobWriter":
+        """
+        Create a writer to store a blob incrementally, e.g., from callbacks
+        :param owner: owner of the reference to the blob
+        :return: blob writer
+        """
+        return BlobWriter(self, owner)
+
+    @contextlib.contextmanager
+    def open(self,
+             blob_hash: str,
+             owner: str,
+             ) -> Iterator[BinaryIO]:
+        """
+        Open a blob as memory-mapped, read-only file object
+        :param blob_hash: hash of the blob
+        :param owner: owner of the reference to the blob
+        :return: context manager yielding the file object
+        """
+        with open(self._ref_path(blob_hash, owner), "rb") as fh:
+            if os.fstat(fh.fileno()).st_size == 0:  # cannot map empty files
+                yield io.BytesIO()
+                return
+            with mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                yield mm
+
+    def release(self,
+                owner: str,
+                ) -> None:
+        """
+        Release all references of an owner and delete blobs that are no
+        longer referenced
+        :param owner: owner of the references
+        """
+        owner_dir = os.path.join(self._ref_dir, owner)
+        try:
+            blob_hashes = os.listdir(owner_dir)
+        except FileNotFoundError:
+            return
+
+        for blob_hash in blob_hashes:
+            os.unlink(os.path.join(owner_dir, blob_hash))
+            blob_path = self._blob_path(blob_hash)
+            try:
+                if os.stat(blob_path).st_nlink <= 1:
+                    os.unlink(blob_path)
+            except FileNotFoundError:
+                pass
+        shutil.rmtree(owner_dir, ignore_errors=True)
+
+    def release_expired(self,
+                        max_age: float,
+                        ) -> None:
+        """
+        Release the references of all owners that were created before the
+        maximum age, e.g., of jobs that never ran
+        :param max_age: maximum age in seconds
+        """
+        min_mtime = time.time() - max_age
+        with os.scandir(self._ref_dir) as entries:
+            for entry in entries:
+                if entry.stat().st_mtime < min_mtime:
+                    self.release(entry.name)
+
+    def _link(self,
+              path: str,
+              blob_hash: str,
+              owner: str,
+              ) -> None:
+        """
+        Store file as blob, unless it exists, and reference it for the owner
+        :param path: path to file with blob contents
+        :param blob_hash: hash of the blob
+        :param owner: owner of the reference to the blob
+        """
+        blob_path = self._blob_path(blob_hash)
+        ref_path = self._ref_path(blob_hash, owner)
+        os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+        os.makedirs(os.path.dirname(ref_path), exist_ok=True)
+        while True:
+            with contextlib.suppress(FileExistsError):
+                os.link(path, blob_path)
+            try:
+                os.link(blob_path, ref_path)
+                return
+            except FileExistsError:  # already referenced by owner
+                return
+            except FileNotFoundError:  # blob released concurrently
+                continue
+
+    def _blob_path(self,
+                   blob_hash: str,
+                   ) -> str:
+        return os.path.join(self._blob_dir, blob_hash[:2], blob_hash)
+
+    def _ref_path(self,
+                  blob_hash: str,
+                  owner: str,
+                  ) -> str:
+        return os.path.join(self._ref_dir, owner, blob_hash)
+
+
+class BlobWriter:
+    """Write a blob incrementally; it is stored once the writer is closed"""
+
+    def __init__(self,
+                 store: BlobStore,
+                 owner: str,
+                 ):
+        """
+        :param store: blob store
+        :param owner: owner of the reference to the blob
+        """
+        self._store = store
+        self._owner = owner
+        self._hasher = hashlib.sha256()
+        self._fh = tempfile.NamedTemporaryFile(dir=store._tmp_dir,
+                                               delete=False)
+
+    def write(self,
+              chunk: bytes,
+              ) -> None:
+        """
+        Append chunk to blob
+        :param chunk: chunk of contents
+        """
+        self._hasher.update(chunk)
+        self._fh.write(chunk)
+
+    def close(self,
+              ) -> str:
+        """
+        Store the blob
+        :return: hash of the blob
+        """
+        self._fh.close()
+        blob_hash = self._hasher.hexdigest()
+        try:
+            self._store._link(self._fh.name, blob_hash, self._owner)
+        finally:
+            os.unlink(self._fh.name)
+        return blob_hash
+
+    def abort(self,
+              ) -> None:
+        """Discard the written contents"""
+        self._fh.close()
+        os.unlink(self._fh.name)
@@ -0,0 +1,347 @@
+"""Prometheus metrics and OpenTelemetry spans of search and indexing"""
+import contextlib
+import contextvars
+import functools
+import os
+import time
+from typing import Any, Callable, Dict, Iterator, Optional, Tuple
+
+from prometheus_client import (CONTENT_TYPE_LATEST, CollectorRegistry, Gauge,
+                               Histogram, REGISTRY, generate_latest,
+                               start_http_server)
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+
+_STAGE_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                  0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+_BATCH_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256, 512)
+_NULL_CONTEXT = contextlib.nullcontext()
+_CACHE_METRICS = {
+    "hits": "Cache hits",
+    "misses": "Cache misses",
+    "entries": "Number of cached entries",
+    "size_bytes": "Total size of cached entries",
+}
+
+_tracking_id: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar(
+    "tracking_id", default=None,
+)
+_metrics: Optional["_Metrics"] = None
+_tracer: Any = None
+
+
+class _Metrics:
+    """Metrics of the process, created when telemetry is enabled"""
+
+    def __init__(self,
+                 registry: CollectorRegistry,
+                 ):
+        self.stage_seconds = Histogram(
+            "image_search_stage_seconds",
+            "Duration of processing stages",
+            ["component", "stage"],
+            buckets=_STAGE_BUCKETS,
+            registry=registry,
+        )
+        self.batch_size = Histogram(
+            "image_search_batch_size",
+            "Number of items per batch",
+            ["component"],
+            buckets=_BATCH_SIZE_BUCKETS,
+            registry=registry,
+        )
+        self.queue_depth = Gauge(
+            "image_search_queue_depth",
+            "Number of items waiting in a queue",
+            ["queue"],
+            multiprocess_mode="livesum",
+            registry=registry,
+        )
+        self.caches = _CacheCollector()
+        if is_multiprocess():  # custom collectors are not aggregated
+            self.cache_gauges = {
+                metric: Gauge(f"image_search_cache_{metric}",
+                              f"{description} of the live processes",
+                              ["cache", "tier"],
+                              multiprocess_mode="livesum",
+                              registry=None,
+                              )
+                for metric, description in _CACHE_METRICS.items()
+            }
+        else:
+            registry.register(self.caches)
+
+
+class _CacheCollector:
+    """
+    Export the statistics of caches when metrics are collected; with
+    multiple processes, they are published as gauges instead
+    """
+
+    def __init__(self):
+        self._caches: Dict[str, Any] = {}
+
+    def add(self,
+            name: str,
+            cache: Any,
+            ) -> None:
+        self._caches[name] = cache
+
+    def describe(self) -> list:
+        return []
+
+    def collect(self) -> Iterator[Any]:
+        families = {
+            metric: (CounterMetricFamily if metric in ("hits", "misses")
+                     else GaugeMetricFamily)(f"image_search_cache_{metric}",
+                                             description,
+                                             labels=["cache", "tier"])
+            for metric, description in _CACHE_METRICS.items()
+        }
+        for metric, labels, value in self.samples():
+            families[metric].add_metric(labels, value)
+        yield from families.values()
+
+    def publish(self,
+                gauges: Dict[str, Gauge],
+                ) -> None:
+        """
+        Set gauges to the current statistics of the caches
+        :param gauges: gauge of each metric
+        """
+        for metric, labels, value in self.samples():
+            gauges[metric].labels(*labels).set(value)
+
+    def samples(self) -> Iterator[Tuple[str, list, float]]:
+        """
+        :return: metric, labels (cache and tier) and value of each statistic
+        """
+        for name, cache in self._caches.items():
+            stats = cache.stats()
+            tiers = (stats.items() if "local" in stats
+                     else [("local", stats)])
+            for tier, tier_stats in tiers:
+                labels = [name, tier]
+                yield "hits", labels, tier_stats.get("hits", 0)
+                yield "misses", labels, tier_stats.get("misses", 0)
+                if "entries" in tier_stats:
+                    yield "entries", labels, tier_stats["entries"]
+                    yield "size_bytes", labels, tier_stats["size"]
+
+
+def enable(tracing: bool = False,
+           registry: CollectorRegistry = REGISTRY,
+           ) -> None:
+    """
+    Start recording metrics, and spans if tracing is enabled; until then,
+    all recording functions return immediately. Calling it again has no
+    effect.
+    :param tracing: create OpenTelemetry spans for stages (requires the
+                    opentelemetry-api package; spans are exported by the
+                    configured OpenTelemetry SDK)
+    :param registry: Prometheus registry of the metrics
+    """
+    global _metrics, _tracer
+    if _metrics is None:
+        _metrics = _Metrics(registry)
+    if tracing and _tracer is None:
+        try:
+            from opentelemetry import trace
+        except ImportError as exc:
+            raise ImportError("Tracing requires the opentelemetry-api "
+                              "package") from exc
+        _tracer = trace.get_tracer("image_search")
+
+
+def is_enabled() -> bool:
+    return _metrics is not None
+
+
+def start_exporter(port: int,
+                   ) -> None:
+    """
+    Serve the metrics via HTTP in a background thread, e.g., of a worker
+    process. If `PROMETHEUS_MULTIPROC_DIR` is set, the metrics of all
+    processes writing to that directory, e.g., of a prefork pool, are
+    aggregated; otherwise, only the metrics of this process are served.
+    :param port: port of the metrics endpoint
+    """
+    start_http_server(port, registry=_exported_registry())
+
+
+def export() -> Tuple[bytes, str]:
+    """
+    Export the metrics, e.g., for a /metrics endpoint; see `start_exporter`
+    for multiple processes
+    :return: metrics in text format and their media type
+    """
+    publish_caches()
+    return generate_latest(_exported_registry()), CONTENT_TYPE_LATEST
+
+
+def is_multiprocess() -> bool:
+    """
+    :return: True if the metrics of multiple processes are aggregated via
+             `PROMETHEUS_MULTIPROC_DIR`
+    """
+    return "PROMETHEUS_MULTIPROC_DIR" in os.environ
+
+
+def publish_caches() -> None:
+    """
+    Publish the statistics of this process's caches for aggregation with
+    other processes, e.g., after each task of a prefork pool process; has no
+    effect with a single process, whose caches are read when the metrics
+    are collected
+    """
+    if _metrics is not None and is_multiprocess():
+        _metrics.caches.publish(_metrics.cache_gauges)
+
+
+def mark_process_dead(pid: int,
+                      ) -> None:
+    """
+    Remove the live gauges of a terminated process from the aggregation
+    :param pid: process ID
+    """
+    if is_multiprocess():
+        from prometheus_client import multiprocess
+
+        multiprocess.mark_process_dead(pid)
+
+
+def stage(component: str,
+          name: str,
+          ) -> contextlib.AbstractContextManager:
+    """
+    Measure the duration of a stage, and trace it as a span
+    :param component: component, e.g., "embedder"
+    :param name: stage, e.g., "text_encoder"
+    :return: context manager around the stage
+    """
+    if _metrics is None:
+        return _NULL_CONTEXT
+    return _measure(component, name)
+
+
+def observe_stage(component: str,
+                  name: str,
+                  seconds: float,
+                  ) -> None:
+    """
+    Record the duration of a stage that was measured already
+    :param component: component, e.g., "index"
+    :param name: stage, e.g., "decode"
+    :param seconds: duration
+    """
+    if _metrics is not None:
+        _metrics.stage_seconds.labels(component, name).observe(seconds)
+
+
+def observe_batch_size(component: str,
+                       size: int,
+                       ) -> None:
+    """
+    :param component: component processing the batch
+    :param size: number of items of the batch
+    """
+    if _metrics is not None:
+        _metrics.batch_size.labels(component).observe(size)
+
+
+def set_queue_depth(queue: str,
+                    depth: int,
+                    ) -> None:
+    """
+    :param queue: name of queue
+    :param depth: number of waiting items
+    """
+    if _metrics is not None:
+        _metrics.queue_depth.labels(queue).set(depth)
+
+
+def register_cache(name: str,
+                   cache: Any,
+                   ) -> None:
+    """
+    Export the statistics of a cache
+    :param name: name of cache, e.g., "embeddings"
+    :param cache: cache with a `stats` method
+    """
+    if _metrics is not None and cache is not None:
+        _metrics.caches.add(name, cache)
+
+
+@contextlib.contextmanager
+def tracking(tracking_id: Optional[str],
+             operation: str,
+             ) -> Iterator[None]:
+    """
+    Trace an operation, e.g., a request, as the parent span of its stages;
+    all spans are tagged with the tracking ID, also across processes
+    :param tracking_id: tracking ID of the request (optional)
+    :param operation: name of operation, e.g., "search"
+    """
+    if _tracer is None:
+        yield
+        return
+    token = _tracking_id.set(tracking_id)
+    try:
+        with _tracer.start_as_current_span(operation,
+                                           attributes=_attributes()):
+            yield
+    finally:
+        _tracking_id.reset(token)
+
+
+def propagate(func: Callable,
+              ) -> Callable:
+    """
+    Bind a function to the current context, so that spans created when it
+    runs in other threads belong to the current operation
+    :param func: function
+    :return: function running in a copy of the current context; each call
+             gets its own copy, so calls may run concurrently
+    """
+    if _tracer is None:
+        return func
+    context = contextvars.copy_context()
+
+    @functools.wraps(func)
+    def run(*args, **kwargs):
+        return context.copy().run(func, *args, **kwargs)
+    return run
+
+
+@contextlib.contextmanager
+def _measure(component: str,
+             name: str,
+             ) -> Iterator[None]:
+    start = time.perf_counter()
+    try:
+        if _tracer is None:
+            yield
+        else:
+            with _tracer.start_as_current_span(f"{component}.{name}",
+                                               attributes=_attributes()):
+                yield
+    finally:
+        observe_stage(component, name, time.perf_counter() - start)
+
+
+def _exported_registry() -> CollectorRegistry:
+    """
+    :return: registry of the metrics of this process, or of all processes
+             writing to `PROMETHEUS_MULTIPROC_DIR`
+    """
+    if not is_multiprocess():
+        return REGISTRY
+    from prometheus_client import multiprocess
+
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    return registry
+
+
+def _attributes() -> Dict[str, str]:
+    tracking_id = _tracking_id.get()
+    return {} if tracking_id is None else {"tracking_id": tracking_id}
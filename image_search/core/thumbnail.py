@@ -0,0 +1,97 @@
+"""Compact thumbnail encoding of images"""
+from dataclasses import dataclass
+import io
+from typing import Literal, Tuple
+
+from PIL import Image
+
+from image_search.core.utils import scale_down
+
+ThumbnailFormat = Literal["webp", "jpeg", "png"]
+
+_SUPPORTED_MODES = {
+    "webp": {"RGB", "RGBA"},
+    "jpeg": {"RGB", "L"},
+    "png": {"RGB", "RGBA", "L", "LA"},
+}
+
+
+@dataclass(frozen=True)
+class Thumbnail:
+    """Encoded thumbnail and the information needed to decode it"""
+
+    data: bytes
+    format: ThumbnailFormat
+    width: int
+    height: int
+    mode: str
+
+    @property
+    def media_type(self) -> str:
+        return f"image/{self.format}"
+
+    def metadata(self) -> dict[str, str | int]:
+        """
+        :return: thumbnail information without the encoded data
+        """
+        return {
+            "format": self.format,
+            "width": self.width,
+            "height": self.height,
+            "mode": self.mode,
+        }
+
+
+class ThumbnailCodec:
+    """Downscale images and encode them in a compressed image format"""
+
+    def __init__(self,
+                 size: Tuple[int, int] = (128, 128),
+                 format: ThumbnailFormat = "webp",
+                 quality: int = 80,
+                 ):
+        """
+        :param size: maximum thumbnail size, the aspect ratio is kept
+        :param format: image format
+        :param quality: compression quality (1-100) of lossy formats
+        """
+        if format not in _SUPPORTED_MODES:
+            raise ValueError(f"Unsupported thumbnail format: '{format}'")
+        self._size = tuple(size)
+        self._format = format
+        self._quality = quality
+
+    def encode(self,
+               image: Image.Image,
+               ) -> Thumbnail:
+        """
+        Create thumbnail of image; the image itself is not modified
+        :param image: image
+        :return: encoded thumbnail
+        """
+        thumbnail = image.resize(scale_down(image.size, self._size),
+                                 reducing_gap=3.0)
+        if thumbnail.mode not in _SUPPORTED_MODES[self._format]:
+            has_alpha = "A" in thumbnail.getbands()
+            mode = "RGBA" if has_alpha and self._format != "jpeg" else "RGB"
+            thumbnail = thumbnail.convert(mode)
+
+        buffer = io.BytesIO()
+        thumbnail.save(buffer, format=self._format, quality=self._quality)
+        return Thumbnail(data=buffer.getvalue(),
+                         format=self._format,
+                         width=thumbnail.width,
+                         height=thumbnail.height,
+                         mode=thumbnail.mode,
+                         )
+
+    @staticmethod
+    def decode(thumbnail: Thumbnail,
+               ) -> Image.Image:
+        """
+        Decode thumbnail
+        :param thumbnail: encoded thumbnail
+        :return: thumbnail image
+        """
+        return Image.open(io.BytesIO(thumbnail.data),
+                          formats=[thumbnail.format.upper()])
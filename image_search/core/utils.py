@@ -53,28 +53,137 @@ def cosine_similarity(vectors: torch.Tensor,
                       eps: float = 1e-15,
                       ) -> torch.Tensor:
     """
-    Compute the cosine similarity of each vector with each other
+    Compute the cosine similarity of each vector with each other. The full
+    similarity matrix is returned, so this is meant for small sets only;
+    use `topk_similarity` to search.
     :param vectors: input vectors
     :param eps: small value to avoid division by zero
     :return: cosine similarities
     """
-    numerator = vectors @ vectors.T
-    l2 = torch.mul(vectors, vectors).sum(dim=-1)
-    denominator = torch.max(torch.sqrt(torch.outer(l2, l2)), torch.tensor(eps))
-    return torch.div(numerator, denominator)
+    normalized = torch.nn.functional.normalize(vectors, dim=-1, eps=eps)
+    return normalized @ normalized.T
+
+
+def topk_similarity(queries: torch.Tensor,
+                    corpus: torch.Tensor,
+                    k: int,
+                    block_size: int = 65536,
+                    query_block_size: int = 1024,
+                    normalize: bool = False,
+                    ) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    Find the k corpus vectors with the largest dot product for each query.
+    Queries and corpus are processed in blocks, so that only a
+    query_block_size × block_size score matrix exists at a time, and both
+    may be memory-mapped or in a lower precision; each block is converted
+    to the common data type of queries and corpus.
+    :param queries: query vectors (n_queries × dim)
+    :param corpus: corpus vectors (n_corpus × dim)
+    :param k: number of results per query
+    :param block_size: number of corpus vectors per block
+    :param query_block_size: number of query vectors per block
+    :param normalize: L2-normalize the vectors of each block, i.e., rank by
+                      cosine similarity; not needed if the vectors are
+                      normalized already
+    :return: scores and corpus indices of the results, both
+             n_queries × min(k, n_corpus), sorted by descending score
+    """
+    dtype = torch.promote_types(queries.dtype, corpus.dtype)
+    if queries.shape[0] <= query_block_size:
+        return _topk_similarity_block(queries.to(dtype), corpus, k,
+                                      block_size, normalize)
+
+    scores, ids = [], []
+    for start in range(0, queries.shape[0], query_block_size):
+        query_block = queries[start:start + query_block_size].to(dtype)
+        block_scores, block_ids = _topk_similarity_block(
+            query_block, corpus, k, block_size, normalize,
+        )
+        scores.append(block_scores)
+        ids.append(block_ids)
+    return torch.cat(scores), torch.cat(ids)
+
+
+def _topk_similarity_block(queries: torch.Tensor,
+                           corpus: torch.Tensor,
+                           k: int,
+                           block_size: int,
+                           normalize: bool,
+                           ) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    Find the top-k corpus vectors of a block of queries, streaming the
+    corpus in blocks and merging the results of each block
+    :param queries: query vectors in the data type of the scores
+    :param corpus: corpus vectors
+    :param k: number of results per query
+    :param block_size: number of corpus vectors per block
+    :param normalize: L2-normalize queries and corpus blocks
+    :return: scores and corpus indices of the results
+    """
+    if normalize:
+        queries = torch.nn.functional.normalize(queries, dim=-1)
+    n_queries = queries.shape[0]
+    best_scores = queries.new_empty((n_queries, 0))
+    best_ids = torch.empty((n_queries, 0), dtype=torch.long)
+    for start in range(0, corpus.shape[0], block_size):
+        block = corpus[start:start + block_size].to(queries.dtype)
+        if normalize:
+            block = torch.nn.functional.normalize(block, dim=-1)
+        scores = queries @ block.T
+        block_scores, block_ids = scores.topk(min(k, scores.shape[1]), dim=1)
+        candidate_scores = torch.cat((best_scores, block_scores), dim=1)
+        candidate_ids = torch.cat((best_ids, block_ids + start), dim=1)
+        best_scores, positions = candidate_scores.topk(
+            min(k, candidate_scores.shape[1]), dim=1,
+        )
+        best_ids = candidate_ids.gather(1, positions)
+    return best_scores, best_ids
 
 
 def create_batches(elements: Iterable[_T],
                    batch_size: int,
+                   max_weight: float = None,
+                   weight: Callable[[_T], float] = None,
                    ) -> Iterable[Sequence[_T]]:
     """
-    Create batches from iterable
+    Create batches from iterable. If a maximum weight is given, a batch is
+    also closed as soon as adding the next element would exceed that weight.
+    A single element heavier than the maximum weight forms its own batch.
+    :param elements: elements
+    :param batch_size: maximum number of elements per batch
+    :param max_weight: maximum total weight per batch (optional)
+    :param weight: weight function, required if max_weight is given
+    :return: batches
+    """
+    if max_weight is None:
+        yield from _batched(elements, batch_size)
+        return
+
+    batch, batch_weight = [], 0
+    for element in elements:
+        element_weight = weight(element)
+        if batch and (len(batch) >= batch_size
+                      or batch_weight + element_weight > max_weight):
+            yield tuple(batch)
+            batch, batch_weight = [], 0
+        batch.append(element)
+        batch_weight += element_weight
+
+    if batch:
+        yield tuple(batch)
+
+
+def _batched(elements: Iterable[_T],
+             batch_size: int,
+             ) -> Iterable[Sequence[_T]]:
+    """
+    Create batches of fixed size from iterable
     :param elements: elements
     :param batch_size: batch size
     :return: batches
     """
     try:
-        return itertools.batched(elements, batch_size)
+        yield from itertools.batched(elements, batch_size)
     except AttributeError:  # fallback for Python below 3.12
         elem_it = iter(elements)
         while batch := tuple(itertools.islice(elem_it, batch_size)):
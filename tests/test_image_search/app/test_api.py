@@ -0,0 +1,172 @@
+"""Test API component"""
+import asyncio
+import subprocess
+import sys
+import tempfile
+import types
+import unittest
+from unittest import mock
+import uuid
+
+from fastapi import HTTPException
+from fastapi.testclient import TestClient
+from qdrant_client import AsyncQdrantClient
+import torch
+
+from image_search.app.data import IndexingJob
+
+
+class TestApi(unittest.TestCase):
+
+    def test_import__lazy(self):
+        code = ("import sys; import image_search.app.api; "
+                "print('torch' in sys.modules, "
+                "'transformers' in sys.modules)")
+        output = subprocess.run([sys.executable, "-c", code],
+                                capture_output=True,
+                                check=True,
+                                text=True,
+                                ).stdout
+        self.assertEqual("False False", output.strip())
+
+    def test_query_readiness__cancelled(self):
+        from image_search.app import api
+
+        async def query_readiness():
+            cancelled = asyncio.get_running_loop().create_future()
+            cancelled.cancel()
+            with mock.patch.object(api, "_initialization", cancelled), \
+                    mock.patch.object(api, "_load_services"):
+                with self.assertRaises(HTTPException) as context:
+                    await api.query_readiness()
+                self.assertIsNot(cancelled, api._initialization)  # retried
+                await api._initialization
+            return context.exception
+
+        exception = asyncio.run(query_readiness())
+        self.assertEqual(503, exception.status_code)
+        self.assertEqual("Initialization failed: cancelled", exception.detail)
+
+
+class TestSearch(unittest.TestCase):
+
+    def setUp(self):
+        from image_search.app import api
+        from image_search.core.database import AsyncQdrantVectorDatabase
+
+        self._db_contents = {str(uuid.uuid4()): torch.rand(10,)
+                             for _ in range(10)}
+        embed = mock.MagicMock()
+        embed.embedding_dim = 10
+        embed.distance = "cosine"
+        embed.side_effect = lambda objs: [self._db_contents[obj]
+                                          for obj in objs]
+        self._database = AsyncQdrantVectorDatabase(
+            embed=embed,
+            client=AsyncQdrantClient(":memory:"),
+        )
+        services = types.SimpleNamespace(async_database=self._database)
+        patcher = mock.patch.object(api, "_services",
+                                    mock.AsyncMock(return_value=services))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self._client = TestClient(api.app)
+
+    def test_search(self):
+        texts = list(self._db_contents)
+        asyncio.run(self._database.put(texts))
+        response = self._client.post("/search", json={
+            "queries": texts[:2],
+            "n_similar": 3,
+            "tracking_id": "request",
+        })
+        self.assertEqual(200, response.status_code)
+        result = response.json()
+        self.assertEqual(texts[:2], result["queries"])
+        self.assertEqual(texts[:2], [hits[0]["text"]
+                                     for hits in result["results"]])
+        self.assertEqual([3, 3], result["next_offsets"])
+        self.assertEqual("request", result["tracking_id"])
+
+    def test_search__shards(self):
+        from image_search.app import api
+
+        with mock.patch.dict(api.settings.database, {"shards": ["a", "b"]}), \
+                mock.patch.object(self._database, "search",
+                                  mock.AsyncMock(return_value=[[]]),
+                                  ) as search:
+            response = self._client.post("/search", json={
+                "queries": ["query"],
+                "shards": ["b"],
+            })
+            unknown_response = self._client.post("/search", json={
+                "queries": ["query"],
+                "shards": ["c"],
+            })
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(["b"], search.call_args.kwargs["shards"])
+        self.assertEqual(400, unknown_response.status_code)
+        search.assert_called_once()
+
+    def test_get_image__invalid_id(self):
+        response = self._client.get("/images/not-an-id")
+        self.assertEqual(404, response.status_code)
+
+    def test_search__invalid_page(self):
+        response = self._client.post("/search", json={
+            "queries": ["query"],
+            "n_similar": 0,
+        })
+        self.assertEqual(400, response.status_code)
+
+
+class TestIndexStream(unittest.TestCase):
+
+    def setUp(self):
+        from image_search.app import api
+        from image_search.core.storage import BlobStore
+
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self._dispatch = mock.MagicMock()
+        self._save_group = mock.MagicMock(
+            side_effect=lambda job_id, task_ids: task_ids or None,
+        )
+        for name, value in (("blob_store", BlobStore(tmp_dir.name)),
+                            ("_dispatch_index_task", self._dispatch),
+                            ("_save_group", self._save_group),
+                            ("_group_to_job", mock.MagicMock(
+                                side_effect=lambda group_result, **kwargs:
+                                IndexingJob(job_id="job",
+                                            status="PENDING",
+                                            **kwargs),
+                            ))):
+            patcher = mock.patch.object(api, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(api.settings.api, "stream_chunk_size", 1)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self._client = TestClient(api.app)
+
+    def test_index_stream__malformed_after_dispatch(self):
+        body = b'{"image": "aW1hZ2U="}\n{"image": "not base64"}\n'
+        response = self._client.post(
+            "/index/stream",
+            content=body,
+            headers={"content-type": "application/x-ndjson"},
+        )
+        self.assertEqual(200, response.status_code)
+        self.assertIn("Malformed request body", response.json()["error"])
+        self._dispatch.assert_called_once()
+        job_id, task_ids = self._save_group.call_args.args
+        self.assertEqual([f"{job_id}.0"], task_ids)
+
+    def test_index_stream__malformed(self):
+        response = self._client.post(
+            "/index/stream",
+            content=b'{"no image": ""}\n',
+            headers={"content-type": "application/x-ndjson"},
+        )
+        self.assertEqual(400, response.status_code)
+        self._dispatch.assert_not_called()
@@ -0,0 +1,113 @@
+"""Test offline bulk indexing"""
+import hashlib
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from PIL import Image
+import torch
+
+from image_search.app.bulk_index import (Checkpoint, index_shard, list_images,
+                                         load_image, parse_metadata)
+from image_search.core.hashing import hash_to_id
+from image_search.core.local_database import LocalVectorDatabase
+from image_search.core.pipeline import IndexingPipeline
+
+
+class TestBulkIndex(unittest.TestCase):
+
+    def setUp(self):
+        self._tmp_dir = tempfile.TemporaryDirectory()
+        self._image_dir = os.path.join(self._tmp_dir.name, "images")
+        os.makedirs(os.path.join(self._image_dir, "b"))
+        self._paths = []
+        for color, name in enumerate(["b/1.png", "a.png", "c.jpg", "b/0.png",
+                                      "d.png"]):
+            path = os.path.join(self._image_dir, name)
+            Image.new("L", (8, 8), color=color * 10).save(path)
+            self._paths.append(path)
+        with open(os.path.join(self._image_dir, "notes.txt"), "w") as fh:
+            fh.write("not an image")
+
+    def tearDown(self):
+        self._tmp_dir.cleanup()
+
+    def _path(self, name):
+        return os.path.join(self._image_dir, name)
+
+    def test_list_images(self):
+        expected = [self._path(name)
+                    for name in ["a.png", "c.jpg", "d.png", "b/0.png",
+                                 "b/1.png"]]
+        self.assertEqual(expected, list_images(self._image_dir))
+
+    def test_list_images__manifest(self):
+        manifest = os.path.join(self._tmp_dir.name, "manifest.txt")
+        with open(manifest, "w") as fh:
+            fh.write(f"{self._path('d.png')}\n\n{self._path('a.png')}\n")
+        self.assertEqual([self._path("d.png"), self._path("a.png")],
+                         list_images(manifest=manifest))
+
+    def test_load_image(self):
+        with open(self._path("a.png"), "rb") as fh:
+            expected_id = hash_to_id(hashlib.sha256(fh.read()).hexdigest())
+        point_id, image = load_image(self._path("a.png"))
+        self.assertEqual(expected_id, point_id)
+        self.assertEqual((8, 8), image.size)
+
+    def test_checkpoint(self):
+        path = os.path.join(self._tmp_dir.name, "checkpoint.json")
+        checkpoint = Checkpoint(path, self._paths)
+        self.assertEqual(0, checkpoint.load())
+        checkpoint.save(3)
+        self.assertEqual(3, Checkpoint(path, self._paths).load())
+        self.assertEqual(0, Checkpoint(path, self._paths[1:]).load())
+
+    def test_parse_metadata(self):
+        self.assertEqual({"year": 2024, "source": "scans"},
+                         parse_metadata(["year=2024", "source=scans"]))
+        self.assertEqual({}, parse_metadata(None))
+        with self.assertRaises(ValueError):
+            parse_metadata(["year"])
+
+    def _create_database(self):
+        embed = mock.MagicMock()
+        embed.embedding_dim = 4
+        embed.distance = "cosine"
+        embed.preprocess.side_effect = lambda image: image.getpixel((0, 0))
+        embed.encode.side_effect = lambda inputs: [
+            torch.tensor([1.0, value, 0.0, 0.0]) for value in inputs
+        ]
+        return LocalVectorDatabase(
+            embed=embed,
+            path=os.path.join(self._tmp_dir.name, "index"),
+        )
+
+    def test_index_shard__resume(self):
+        database = self._create_database()
+        pipeline = IndexingPipeline(database._embed, database, batch_size=2)
+        checkpoint = Checkpoint(os.path.join(self._tmp_dir.name, "ckpt"),
+                                self._paths)
+        checkpoint.save(2)
+        progress = []
+        counts = index_shard(pipeline, self._paths, checkpoint, load_image,
+                             chunk_size=2,
+                             progress=lambda *counts: progress.append(counts),
+                             )
+        self.assertEqual({"resumed": 2, "images": 3, "new": 3, "failed": 0},
+                         counts)
+        self.assertEqual([(2, 2, 0), (1, 1, 0)], progress)
+        self.assertEqual(3, len(database))
+        self.assertEqual(5, checkpoint.load())
+
+    def test_index_shard__metadata(self):
+        database = self._create_database()
+        pipeline = IndexingPipeline(database._embed, database, batch_size=2)
+        checkpoint = Checkpoint(os.path.join(self._tmp_dir.name, "ckpt"),
+                                self._paths)
+        index_shard(pipeline, self._paths, checkpoint, load_image,
+                    metadata={"year": 2024})
+        point_ids = {load_image(path)[0] for path in self._paths}
+        self.assertIn(database.find_by_metadata("year", 2024), point_ids)
+        self.assertIsNone(database.find_by_metadata("year", 2023))
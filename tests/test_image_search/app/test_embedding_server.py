@@ -0,0 +1,95 @@
+"""Test embedding server component"""
+import base64
+import os
+import tempfile
+import threading
+import time
+import unittest
+
+from fastapi.testclient import TestClient
+from PIL import Image
+import torch
+import uvicorn
+
+from image_search.app import initialize
+from image_search.app.embedding_server import app
+from image_search.core.remote import RemoteEmbedder
+
+
+class _FakeEmbedder:
+    """Embeds a text by its length and an image by its size and color"""
+
+    distance = "dot"
+    embedding_dim = 3
+
+    def __call__(self, inputs):
+        return [torch.tensor([float(len(obj)), 0., 0.])
+                if isinstance(obj, str)
+                else torch.tensor([float(obj.width), float(obj.height),
+                                   float(obj.getpixel((0, 0))[0])])
+                for obj in inputs]
+
+
+class TestEmbeddingServer(unittest.TestCase):
+
+    def setUp(self):
+        self._tmp_dir = tempfile.TemporaryDirectory()
+        socket_path = os.path.join(self._tmp_dir.name, "embedding.sock")
+        initialize._instances["local_embedder"] = _FakeEmbedder()
+        self._server = uvicorn.Server(uvicorn.Config(app,
+                                                     uds=socket_path,
+                                                     log_level="warning",
+                                                     ))
+        self._thread = threading.Thread(target=self._server.run)
+        self._thread.start()
+        while not self._server.started:
+            time.sleep(0.01)
+        self._embed = RemoteEmbedder("http://localhost",
+                                     socket_path=socket_path,
+                                     image_size=32,
+                                     )
+
+    def tearDown(self):
+        self._embed.close()
+        self._server.should_exit = True
+        self._thread.join()
+        del initialize._instances["local_embedder"]
+        self._tmp_dir.cleanup()
+
+    def test_info(self):
+        self.assertEqual("dot", self._embed.distance)
+        self.assertEqual(3, self._embed.embedding_dim)
+
+    def test_call(self):
+        image = Image.new("RGB", (128, 64), color=(200, 0, 0))
+        output = self._embed(["dog", image, "cat food"])
+        expected = [torch.tensor([3., 0., 0.]),
+                    torch.tensor([64., 32., 200.]),
+                    torch.tensor([8., 0., 0.])]
+        for output_embedding, expected_embedding in zip(output, expected):
+            torch.testing.assert_close(output_embedding, expected_embedding)
+
+    def test_encode__preprocessed(self):
+        image = Image.new("L", (16, 16), color=50)
+        inputs = [self._embed.preprocess(image)]
+        output = self._embed.encode(inputs)
+        torch.testing.assert_close(output[0], torch.tensor([16., 16., 50.]))
+        self.assertEqual([], self._embed.encode([]))
+
+    def test_embed__invalid_inputs(self):
+        client = TestClient(app)
+        pixels = base64.b64encode(bytes(2 * 2 * 3)).decode()
+        response = client.post("/embed", json={"inputs": [
+            {"text": "dog"}, {"image": pixels, "width": 2, "height": 2},
+        ]})
+        self.assertEqual(200, response.status_code)
+        for item in ({},
+                     {"text": "dog", "image": pixels, "width": 2,
+                      "height": 2},
+                     {"image": pixels},
+                     {"image": pixels, "width": 2, "height": 3},
+                     {"image": pixels, "width": -2, "height": -2},
+                     {"image": "not base64!", "width": 2, "height": 2},
+                     ):
+            response = client.post("/embed", json={"inputs": [item]})
+            self.assertEqual(422, response.status_code, item)
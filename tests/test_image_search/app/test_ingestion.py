@@ -0,0 +1,110 @@
+"""Test streaming ingestion component"""
+import asyncio
+import base64
+import json
+import os
+import tempfile
+import unittest
+
+from image_search.app.ingestion import (ChunkDispatcher, ingest_multipart,
+                                        ingest_ndjson)
+from image_search.core.storage import BlobStore
+
+
+async def _stream(data: bytes,
+                  chunk_size: int = 7,
+                  ):
+    for start in range(0, len(data), chunk_size):
+        yield data[start:start + chunk_size]
+
+
+class TestIngestion(unittest.TestCase):
+
+    def setUp(self):
+        self._tmp_dir = tempfile.TemporaryDirectory()
+        self._store = BlobStore(self._tmp_dir.name)
+        self._dispatched = []
+        self._dispatcher = ChunkDispatcher(
+            "job",
+            chunk_size=2,
+            blob_store=self._store,
+            dispatch=lambda hashes, task_id: self._dispatched.append(
+                (task_id, list(hashes))),
+        )
+
+    def tearDown(self):
+        self._tmp_dir.cleanup()
+
+    def _read(self, task_id, image_hash):
+        with self._store.open(image_hash, owner=task_id) as fh:
+            return fh.read()
+
+    def test_ingest_ndjson(self):
+        images = [b"first image", b"second image", b"third image"]
+        body = b"\n".join(
+            json.dumps({"image": base64.b64encode(image).decode()}).encode()
+            for image in images
+        )
+        asyncio.run(ingest_ndjson(_stream(body), self._dispatcher))
+        task_ids = self._dispatcher.finish()
+
+        self.assertEqual(["job.0", "job.1"], task_ids)
+        (task0, hashes0), (task1, hashes1) = self._dispatched
+        self.assertEqual(images[:2], [self._read(task0, image_hash)
+                                      for image_hash in hashes0])
+        self.assertEqual(images[2:], [self._read(task1, image_hash)
+                                      for image_hash in hashes1])
+
+    def test_ingest_multipart(self):
+        body = (b"--boundary\r\n"
+                b'Content-Disposition: form-data; name="comment"\r\n\r\n'
+                b"not an image\r\n"
+                b"--boundary\r\n"
+                b'Content-Disposition: form-data; name="images"; '
+                b'filename="dog.jpg"\r\n'
+                b"Content-Type: image/jpeg\r\n\r\n"
+                b"dog image\r\n"
+                b"--boundary--\r\n")
+        asyncio.run(ingest_multipart(_stream(body),
+                                     "multipart/form-data; boundary=boundary",
+                                     self._dispatcher))
+        task_ids = self._dispatcher.finish()
+
+        self.assertEqual(["job.0"], task_ids)
+        task_id, image_hashes = self._dispatched[0]
+        self.assertEqual([b"dog image"], [self._read(task_id, image_hash)
+                                          for image_hash in image_hashes])
+
+    def test_finish__empty(self):
+        self.assertEqual([], self._dispatcher.finish())
+        self.assertEqual([], self._dispatched)
+
+    def test_ingest_multipart__malformed(self):
+        body = (b"--boundary\r\n"
+                b'Content-Disposition: form-data; name="images"; '
+                b'filename="dog.jpg"\r\n'
+                b"Content-Type: image/jpeg\r\n\r\n"
+                b"dog image\r\n"
+                b"--boundary\r\n"
+                b'Content-Disposition: form-data; name="images"; '
+                b'filename="cat.jpg"\r\n\r\n'
+                b"cat")
+
+        async def stream():
+            async for chunk in _stream(body):
+                yield chunk
+            raise ValueError("Malformed body")
+
+        with self.assertRaises(ValueError):
+            asyncio.run(ingest_multipart(
+                stream(),
+                "multipart/form-data; boundary=boundary",
+                self._dispatcher,
+            ))
+        self._dispatcher.abort()
+
+        self.assertEqual([], self._dispatched)
+        self.assertEqual([], os.listdir(os.path.join(self._tmp_dir.name,
+                                                     "tmp")))
+        self.assertEqual([], os.listdir(os.path.join(self._tmp_dir.name,
+                                                     "refs")))
@@ -0,0 +1,97 @@
+"""Test rebuilding collections from the embedding store"""
+from argparse import Namespace
+import os
+import tempfile
+import unittest
+from unittest import mock
+import uuid
+
+from PIL import Image
+from qdrant_client import QdrantClient
+import torch
+
+from image_search.app import initialize
+from image_search.app.config import settings
+from image_search.app.rebuild_index import create_database, rebuild
+from image_search.core.database import QdrantVectorDatabase
+from image_search.core.embedding_store import EmbeddingStore, StoredEmbedder
+from image_search.core.local_database import LocalVectorDatabase
+
+_EMBEDDING_DIM = 4
+
+
+class TestRebuildIndex(unittest.TestCase):
+
+    def setUp(self):
+        self._tmp_dir = tempfile.TemporaryDirectory()
+        self._store = EmbeddingStore(os.path.join(self._tmp_dir.name, "store"),
+                                     "model",
+                                     embedding_dim=_EMBEDDING_DIM,
+                                     )
+        embed = mock.MagicMock()
+        embed.embedding_dim = _EMBEDDING_DIM
+        embed.distance = "cosine"
+        embed.side_effect = lambda objs: [torch.rand(_EMBEDDING_DIM,)
+                                          for _ in objs]
+        self._texts = [str(uuid.uuid4()) for _ in range(5)]
+        source = LocalVectorDatabase(embed=embed,
+                                     path=os.path.join(self._tmp_dir.name,
+                                                       "source"),
+                                     embedding_store=self._store,
+                                     )
+        source.put(self._texts)
+        source.put(Image.new("RGB", (16, 16)))
+        self._source = source
+
+    def tearDown(self):
+        self._tmp_dir.cleanup()
+
+    def _assert_same_results(self, database):
+        queries = [self._source._vectors[0], self._source._vectors[5]]
+        embed = mock.MagicMock(side_effect=lambda objs: queries)
+        database._embed = embed
+        self._source._embed = embed
+        self.assertEqual(self._source.query_similar(["a", "b"], n_similar=6),
+                         database.query_similar(["a", "b"], n_similar=6))
+
+    def test_rebuild__local(self):
+        database = LocalVectorDatabase(
+            embed=StoredEmbedder(self._store),
+            path=os.path.join(self._tmp_dir.name, "rebuilt"),
+        )
+        self.assertEqual(6, rebuild(self._store, database, batch_size=4))
+        self.assertEqual(6, len(database))
+        self._assert_same_results(database)
+
+    def test_rebuild__qdrant(self):
+        database = QdrantVectorDatabase(embed=StoredEmbedder(self._store),
+                                        client=QdrantClient(":memory:"),
+                                        )
+        self.assertEqual(6, rebuild(self._store, database, batch_size=4))
+        self._assert_same_results(database)
+
+    def test_rebuild__sharded(self):
+        local_path = os.path.join(self._tmp_dir.name, "rebuilt")
+        args = Namespace(backend="local", local_path=local_path,
+                         recreate=True, collection="default",
+                         database_url="localhost:6333")
+        with mock.patch.dict(settings.database, {"shards": ["a", "b"]}):
+            database = create_database(args, self._store)
+            self.assertEqual(6, rebuild(self._store, database, batch_size=4))
+        self.assertEqual(["a", "b"], database.shard_names)
+        self.assertEqual(6, sum(len(LocalVectorDatabase(
+            embed=StoredEmbedder(self._store),
+            path=os.path.join(local_path, shard),
+        )) for shard in ("a", "b")))
+        self._assert_same_results(database)
+
+    def test_create_database__indexed_fields(self):
+        args = Namespace(backend="qdrant", local_path="", recreate=False,
+                         collection="images", database_url="localhost:6333")
+        indexed_fields = {"source": "keyword"}
+        with mock.patch.dict(settings.database,
+                             {"indexed_fields": indexed_fields}), \
+                mock.patch.object(initialize, "create_database") as create:
+            create_database(args, self._store)
+        self.assertEqual(indexed_fields,
+                         create.call_args.kwargs["indexed_fields"])
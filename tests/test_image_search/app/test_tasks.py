@@ -0,0 +1,110 @@
+"""Test indexing task"""
+import io
+import os
+import tempfile
+import types
+import unittest
+from unittest import mock
+
+from PIL import Image
+
+from image_search.app import initialize, tasks
+from image_search.core.pipeline import IndexingReport
+from image_search.core.storage import BlobStore
+
+
+class TestIndex(unittest.TestCase):
+
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self._blob_store = BlobStore(tmp_dir.name)
+        image = io.BytesIO()
+        Image.new("RGB", (8, 8)).save(image, format="PNG")
+        self._image_hash = self._blob_store.put(image.getvalue(),
+                                                owner="job")
+        self._n_runs = 0
+        database = mock.MagicMock()
+        database.existing_ids.return_value = set()
+        patcher = mock.patch.dict(vars(initialize), {  # not created lazily
+            "database": database,
+            "embedder": mock.MagicMock(),
+        })
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(tasks, "blob_store", self._blob_store)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _run_pipeline(self, image_hashes, load, metadata=None):
+        self._n_runs += 1
+        if self._n_runs == 1:
+            raise ConnectionError("Database unavailable")
+        for image_hash in image_hashes:
+            load(image_hash)  # raises if the image is no longer staged
+        return IndexingReport(n_new=len(image_hashes))
+
+    def test_index__retry_keeps_staged_images(self):
+        with mock.patch("image_search.core.pipeline.IndexingPipeline",
+                        ) as pipeline:
+            pipeline.return_value.run.side_effect = self._run_pipeline
+            result = tasks.index.apply(([self._image_hash],), task_id="job")
+        self.assertEqual(1, result.get()["new"])
+        self.assertEqual(2, pipeline.return_value.run.call_count)
+        with self.assertRaises(FileNotFoundError):
+            with self._blob_store.open(self._image_hash, "job"):
+                pass
+
+    def test_index__final_failure_releases_staged_images(self):
+        with mock.patch("image_search.core.pipeline.IndexingPipeline",
+                        ) as pipeline, \
+                mock.patch.object(tasks.index, "max_retries", 0):
+            pipeline.return_value.run.side_effect = ConnectionError
+            result = tasks.index.apply(([self._image_hash],), task_id="job")
+        self.assertIsInstance(result.result, ConnectionError)
+        with self.assertRaises(FileNotFoundError):
+            with self._blob_store.open(self._image_hash, "job"):
+                pass
+
+
+    def test_index__skips_failed_images(self):
+        with mock.patch("image_search.core.pipeline.IndexingPipeline",
+                        ) as pipeline:
+            pipeline.return_value.run.return_value = IndexingReport(n_new=0,
+                                                                    n_failed=1)
+            result = tasks.index.apply(([self._image_hash],), task_id="job")
+        self.assertEqual({"new": 0, "skipped": 0, "failed": 1},
+                         {key: value for key, value in result.get().items()
+                          if key != "timings"})
+        self.assertIs(tasks._log_error, pipeline.call_args.kwargs["on_error"])
+
+    def test_index__permanent_failure_is_not_retried(self):
+        with mock.patch("image_search.core.pipeline.IndexingPipeline",
+                        ) as pipeline:
+            pipeline.return_value.run.side_effect = ValueError("Bad input")
+            result = tasks.index.apply(([self._image_hash],), task_id="job")
+        self.assertIsInstance(result.result, ValueError)
+        self.assertEqual(1, pipeline.return_value.run.call_count)
+        with self.assertRaises(FileNotFoundError):
+            with self._blob_store.open(self._image_hash, "job"):
+                pass
+
+
+class TestMetricsExporter(unittest.TestCase):
+
+    @mock.patch.object(tasks.telemetry, "start_exporter")
+    @mock.patch.dict(tasks.settings.metrics, {"enabled": True})
+    def test_start_metrics_exporter__prefork(self, start_exporter):
+        worker = types.SimpleNamespace(pool_cls="prefork")
+        with mock.patch.dict(os.environ, clear=True), \
+                self.assertLogs(tasks.logger, level="WARNING"):
+            tasks.start_metrics_exporter(worker)
+        start_exporter.assert_called_once()
+
+        solo_worker = types.SimpleNamespace(pool_cls="solo")
+        with mock.patch.dict(os.environ, clear=True), \
+                self.assertNoLogs(tasks.logger, level="WARNING"):
+            tasks.start_metrics_exporter(solo_worker)
+        with mock.patch.dict(os.environ, {"PROMETHEUS_MULTIPROC_DIR": "."}), \
+                self.assertNoLogs(tasks.logger, level="WARNING"):
+            tasks.start_metrics_exporter(worker)
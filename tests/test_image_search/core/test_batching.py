@@ -0,0 +1,67 @@
+"""Test dynamic batching component"""
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import unittest
+from unittest import mock
+
+import torch
+
+from image_search.core.batching import BatchingEmbedder
+
+
+class _RecordingEmbedder:
+    """Embeds a number n as the vector [n, n] and records batch sizes"""
+
+    distance = "cosine"
+    embedding_dim = 2
+
+    def __init__(self):
+        self.batch_sizes = []
+        self._lock = threading.Lock()
+
+    def __call__(self, inputs):
+        with self._lock:
+            self.batch_sizes.append(len(inputs))
+        return [torch.tensor([float(x), float(x)]) for x in inputs]
+
+
+class TestBatchingEmbedder(unittest.TestCase):
+
+    def test_call__single(self):
+        embed = _RecordingEmbedder()
+        batching_embed = BatchingEmbedder(embed, max_wait=0.)
+        output = batching_embed([1, 2, 3])
+        expected = [torch.tensor([1., 1.]),
+                    torch.tensor([2., 2.]),
+                    torch.tensor([3., 3.])]
+        for output_embedding, expected_embedding in zip(output, expected):
+            torch.testing.assert_close(output_embedding, expected_embedding)
+        self.assertEqual([3], embed.batch_sizes)
+
+    def test_call__concurrent(self):
+        embed = _RecordingEmbedder()
+        batching_embed = BatchingEmbedder(embed,
+                                          max_wait=0.5,
+                                          max_batch_size=8)
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            outputs = list(executor.map(lambda x: batching_embed([x]),
+                                        range(8)))
+
+        for x, output in enumerate(outputs):
+            expected = torch.tensor([x, x], dtype=torch.float)
+            self.assertEqual(1, len(output))
+            torch.testing.assert_close(output[0], expected)
+        self.assertEqual(8, sum(embed.batch_sizes))
+        self.assertLess(len(embed.batch_sizes), 8)
+
+    def test_call__exception(self):
+        embed = mock.MagicMock(side_effect=ValueError("failed"))
+        batching_embed = BatchingEmbedder(embed, max_wait=0.)
+        with self.assertRaises(ValueError):
+            batching_embed(["text"])
+
+    def test_call__empty(self):
+        embed = _RecordingEmbedder()
+        batching_embed = BatchingEmbedder(embed)
+        self.assertEqual([], batching_embed([]))
+        self.assertEqual([], embed.batch_sizes)
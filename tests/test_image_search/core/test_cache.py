@@ -0,0 +1,152 @@
+"""Test cache component"""
+import fractions
+import os
+import pickle
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+import torch
+
+from image_search.core.cache import (CachingEmbedder, FileVersion, LRUCache,
+                                     RedisCache, TieredCache, dump_value,
+                                     load_value, normalize_text)
+
+
+class TestLRUCache(unittest.TestCase):
+
+    def test_get__miss(self):
+        cache = LRUCache(max_size=10)
+        self.assertIsNone(cache.get("key"))
+        self.assertEqual(1, cache.stats()["misses"])
+
+    def test_set_and_get(self):
+        cache = LRUCache(max_size=10)
+        cache.set("key", "value")
+        self.assertEqual("value", cache.get("key"))
+        self.assertEqual(1, cache.stats()["hits"])
+
+    def test_set__evicts_least_recently_used(self):
+        cache = LRUCache(max_size=3, sizeof=lambda key, value: 1)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        cache.set("c", 3)
+        cache.get("a")
+        cache.set("d", 4)
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(1, cache.get("a"))
+        self.assertEqual(3, cache.get("c"))
+        self.assertEqual(4, cache.get("d"))
+
+    def test_set__too_large(self):
+        cache = LRUCache(max_size=4)
+        cache.set("key", torch.zeros(10))
+        self.assertIsNone(cache.get("key"))
+        self.assertEqual(0, cache.stats()["size"])
+
+    def test_get__expired(self):
+        cache = LRUCache(max_size=10, ttl=0.01)
+        cache.set("key", "value")
+        time.sleep(0.02)
+        self.assertIsNone(cache.get("key"))
+
+    def test_invalidate(self):
+        cache = LRUCache(max_size=10)
+        cache.set("key", "value")
+        cache.invalidate()
+        self.assertIsNone(cache.get("key"))
+        self.assertEqual(1, cache.version())
+
+    def test_version__shared_file(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, "results.version")
+            cache = LRUCache(max_size=100, version=FileVersion(path))
+            other_cache = LRUCache(max_size=100, version=FileVersion(path))
+            self.assertEqual(0, cache.version())
+            cache.set(("key", cache.version()), "value")
+            other_cache.invalidate()
+            self.assertNotEqual(0, cache.version())
+            self.assertEqual(other_cache.version(), cache.version())
+            self.assertIsNone(cache.get(("key", cache.version())))
+
+
+class TestTieredCache(unittest.TestCase):
+
+    def test_get__fills_local(self):
+        local_cache = LRUCache(max_size=100)
+        shared_cache = LRUCache(max_size=100)
+        shared_cache.set("key", "value")
+        cache = TieredCache(local_cache, shared_cache)
+        self.assertEqual("value", cache.get("key"))
+        self.assertEqual("value", local_cache.get("key"))
+
+    def test_invalidate(self):
+        local_cache = LRUCache(max_size=100)
+        shared_cache = LRUCache(max_size=100)
+        cache = TieredCache(local_cache, shared_cache)
+        cache.set("key", "value")
+        cache.invalidate()
+        self.assertIsNone(local_cache.get("key"))
+        self.assertIsNone(shared_cache.get("key"))
+        self.assertEqual(shared_cache.version(), cache.version())
+
+
+class TestRedisCache(unittest.TestCase):
+
+    def setUp(self):
+        self._data = {}
+        self._client = mock.MagicMock()
+        self._client.get.side_effect = self._data.get
+        self._client.set.side_effect = (
+            lambda key, value, ex=None: self._data.__setitem__(key, value)
+        )
+        self._client.incr.side_effect = (
+            lambda key: self._data.__setitem__(key, self._data.get(key, 0)
+                                               + 1)
+        )
+
+    def test_set_and_get(self):
+        cache = RedisCache(self._client, prefix="test")
+        cache.set(("key", cache.version()), torch.ones(3))
+        self._client.get.reset_mock()
+        torch.testing.assert_close(torch.ones(3),
+                                   cache.get(("key", 0)))
+        self._client.get.assert_called_once()
+
+    def test_invalidate(self):
+        cache = RedisCache(self._client, prefix="test")
+        other_cache = RedisCache(self._client, prefix="test")
+        other_cache.invalidate()
+        self.assertEqual(1, cache.version())
+
+    def test_load_value__no_arbitrary_objects(self):
+        torch.testing.assert_close({"a": [torch.zeros(2)]},
+                                   load_value(dump_value({"a": [
+                                       torch.zeros(2)
+                                   ]})))
+        data = dump_value(fractions.Fraction(1, 3))
+        with self.assertRaises(pickle.UnpicklingError):
+            load_value(data)
+
+
+class TestCachingEmbedder(unittest.TestCase):
+
+    def test_call__embeds_only_misses(self):
+        embed = mock.MagicMock(side_effect=lambda inputs: [
+            torch.full((2,), float(len(obj))) for obj in inputs
+        ])
+        caching_embed = CachingEmbedder(embed, LRUCache(max_size=1000))
+        caching_embed(["dog", "cat"])
+        output = caching_embed(["  Dog ", "horse", "cat"])
+        embed.assert_called_with(["horse"])
+        torch.testing.assert_close(output[0], torch.full((2,), 3.))
+        torch.testing.assert_close(output[1], torch.full((2,), 5.))
+        torch.testing.assert_close(output[2], torch.full((2,), 3.))
+
+
+class TestNormalizeText(unittest.TestCase):
+
+    def test_normalize_text(self):
+        output = normalize_text("  A  photo of\ta DOG ")
+        self.assertEqual("a photo of a dog", output)
@@ -1,15 +1,95 @@
 """Test database component"""
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
 import os
+import tempfile
+import threading
 import unittest
 from unittest import mock
 import uuid
 
-from qdrant_client import QdrantClient
+from PIL import Image
+from qdrant_client import AsyncQdrantClient, QdrantClient
+from qdrant_client.models import (BinaryQuantization, FieldCondition,
+                                  Filter, MatchAny, MatchValue, Range,
+                                  PointStruct, ScalarQuantization)
 import torch
 
-from image_search.core.database import QdrantVectorDatabase
+from image_search.core.cache import FileVersion, LRUCache
+from image_search.core.database import (DEFAULT_INDEXING_THRESHOLD,
+                                        AsyncQdrantVectorDatabase,
+                                        QdrantVectorDatabase, SearchHit,
+                                        VectorStorage, dump_hits, load_hits)
+from image_search.core.local_database import LocalVectorDatabase
+from image_search.core.storage import BlobStore
 
 _DEFAULT_QDRANT_URL = "localhost:6333"
+_EMBEDDING_DIM = 10
+_FILTERS = {
+    # filter: indices of the matching texts, see `_put_with_metadata`
+    "value": Filter(must=[FieldCondition(key="metadata.source",
+                                         match=MatchValue(value="a"))]),
+    "any": Filter(must=[FieldCondition(key="metadata.tags",
+                                       match=MatchAny(any=["odd"]))]),
+    "range": Filter(must=[FieldCondition(key="metadata.created",
+                                         range=Range(gte=3, lt=7))]),
+    "must_not": Filter(must_not=[FieldCondition(
+        key="metadata.source", match=MatchValue(value="a"),
+    )]),
+}
+_FILTERED_TEXTS = {
+    "value": [0, 2, 4, 6, 8],
+    "any": [1, 3, 5, 7, 9],
+    "range": [3, 4, 5, 6],
+    "must_not": [1, 3, 5, 7, 9],
+}
+
+
+def _create_embed(db_contents: dict[str, torch.Tensor],
+                  ) -> mock.MagicMock:
+    """
+    Create embedding function mapping texts to predefined vectors
+    :param db_contents: vector of every text
+    :return: mocked embedding function
+    """
+    embed = mock.MagicMock()
+    embed.embedding_dim = _EMBEDDING_DIM
+    embed.distance = "cosine"
+    embed.side_effect = lambda objs: [db_contents[obj] for obj in objs]
+    return embed
+
+
+def _put_with_metadata(database,
+                       texts: list[str],
+                       ) -> None:
+    """
+    Put texts with metadata: the source "a" or "b" alternates, odd texts
+    are tagged "odd", and the creation time is the text's index
+    """
+    database.put_points([
+        PointStruct(id=str(uuid.uuid4()),
+                    vector=database._embed([text])[0],
+                    payload=database.create_payload(text, {
+                        "source": "ab"[i % 2],
+                        "tags": ["odd"] if i % 2 else [],
+                        "created": i,
+                    }),
+                    )
+        for i, text in enumerate(texts)
+    ])
+
+
+def _assert_filtered(test_case: unittest.TestCase,
+                     database,
+                     texts: list[str],
+                     ) -> None:
+    for name, query_filter in _FILTERS.items():
+        hits, = database.search(texts[0],
+                                n_similar=len(texts),
+                                query_filter=query_filter,
+                                )
+        test_case.assertEqual(sorted(texts[i] for i in _FILTERED_TEXTS[name]),
+                              sorted(hit.text for hit in hits), name)
 
 
 class TestQdrantVectorDatabase(unittest.TestCase):
@@ -18,14 +98,433 @@ class TestQdrantVectorDatabase(unittest.TestCase):
         url = os.getenv("QDRANT_URL", _DEFAULT_QDRANT_URL)
         self._client = QdrantClient(url=url)
         self._collection = str(uuid.uuid4())
-        self._embed = mock.MagicMock()
+        self._db_contents = {
+            str(uuid.uuid4()): torch.rand(_EMBEDDING_DIM,)
+            for _ in range(10)
+        }
+        self._embed = _create_embed(self._db_contents)
         self._database = QdrantVectorDatabase(embed=self._embed,
                                               client=self._client,
                                               collection=self._collection)
 
     def test_put_and_get(self):
+        texts = list(self._db_contents)
+        self._database.put(texts)
+        output = self._database.query_similar(texts, n_similar=1)
+        self.assertEqual([[text] for text in texts], output)
+
+
+class TestVectorStorage(unittest.TestCase):
+
+    def test_quantization_config(self):
+        self.assertIsNone(VectorStorage().quantization_config())
+        self.assertIsInstance(
+            VectorStorage(quantization="scalar").quantization_config(),
+            ScalarQuantization,
+        )
+        self.assertIsInstance(
+            VectorStorage(quantization="binary").quantization_config(),
+            BinaryQuantization,
+        )
+        with self.assertRaises(ValueError):
+            VectorStorage(quantization="pq").quantization_config()
+
+    def test_search_params(self):
+        self.assertIsNone(VectorStorage().search_params())
+        storage = VectorStorage(quantization="binary", oversampling=3.0)
+        params = storage.search_params().quantization
+        self.assertTrue(params.rescore)
+        self.assertEqual(3.0, params.oversampling)
+
+    def test_put_and_get__quantized(self):
+        db_contents = {
+            str(uuid.uuid4()): torch.rand(_EMBEDDING_DIM,)
+            for _ in range(10)
+        }
+        storage = VectorStorage(quantization="scalar", on_disk=True)
+        database = QdrantVectorDatabase(embed=_create_embed(db_contents),
+                                        client=QdrantClient(":memory:"),
+                                        storage=storage,
+                                        )
+        texts = list(db_contents)
+        database.put(texts)
+        output = database.query_similar(texts, n_similar=1)
+        self.assertEqual([[text] for text in texts], output)
+
+    def test_search__offset(self):
         db_contents = {
-            str(uuid.uuid4()): torch.rand(10,)
+            str(uuid.uuid4()): torch.rand(_EMBEDDING_DIM,)
+            for _ in range(10)
+        }
+        database = QdrantVectorDatabase(embed=_create_embed(db_contents),
+                                        client=QdrantClient(":memory:"),
+                                        )
+        texts = list(db_contents)
+        database.put(texts)
+        first_page = database.search(texts[0], n_similar=4)[0]
+        second_page = database.search(texts[0], n_similar=4, offset=4)[0]
+        self.assertEqual(texts[0], first_page[0].text)
+        self.assertEqual(8, len({hit.id for hit in first_page + second_page}))
+        self.assertGreaterEqual(first_page[-1].score, second_page[0].score)
+
+
+def _assert_search_by_ids(test_case: unittest.TestCase,
+                          database,
+                          texts: list[str],
+                          ) -> None:
+    all_hits, = database.search(texts[0], n_similar=len(texts))
+    point_id = all_hits[0].id  # point of the text itself
+    hits, = database.search_by_ids([point_id], n_similar=3, offset=2)
+    expected = all_hits[1:][2:5]
+    test_case.assertEqual([hit.id for hit in expected],
+                          [hit.id for hit in hits])
+    torch.testing.assert_close([hit.score for hit in expected],
+                               [hit.score for hit in hits])
+
+
+class TestQdrantVectorDatabaseInMemory(unittest.TestCase):
+
+    def setUp(self):
+        self._db_contents = {str(uuid.uuid4()): torch.rand(_EMBEDDING_DIM,)
+                             for _ in range(10)}
+        self._database = QdrantVectorDatabase(
+            embed=_create_embed(self._db_contents),
+            client=QdrantClient(":memory:"),
+            indexed_fields={"source": "keyword", "created": "integer"},
+        )
+
+    def test_search__filter(self):
+        texts = list(self._db_contents)
+        _put_with_metadata(self._database, texts)
+        _assert_filtered(self, self._database, texts)
+
+    def test_search_by_ids(self):
+        texts = list(self._db_contents)
+        self._database.put(texts)
+        _assert_search_by_ids(self, self._database, texts)
+
+    def test_search__result_cache_invalidated_by_other_process(self):
+        client = QdrantClient(":memory:")
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            version_path = os.path.join(tmp_dir, "results.version")
+            api_database, worker_database = (
+                QdrantVectorDatabase(
+                    embed=_create_embed(self._db_contents),
+                    client=client,
+                    collection="images",
+                    result_cache=LRUCache(max_size=2 ** 20,
+                                          version=FileVersion(version_path),
+                                          ),
+                )
+                for _ in range(2)
+            )
+            texts = list(self._db_contents)
+            worker_database.put(texts[1:])
+            self.assertNotEqual(texts[0],
+                                api_database.search(texts[0])[0][0].text)
+            worker_database.put(texts[:1])
+            self.assertEqual(texts[0],
+                             api_database.search(texts[0])[0][0].text)
+
+    def test_search__missing_thumbnail(self):
+        client = QdrantClient(":memory:")
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            database = QdrantVectorDatabase(
+                embed=_create_embed(self._db_contents),
+                client=client,
+                collection="images",
+                thumbnail_store=BlobStore(tmp_dir),
+            )
+            database._embed.side_effect = lambda objs: [
+                torch.rand(_EMBEDDING_DIM,) for _ in objs
+            ]
+            database.put(Image.new("RGB", (64, 64)))
+            hit, = database.search("query", with_thumbnails=True)[0]
+            self.assertIsNotNone(hit.thumbnail)
+        self.assertIsNone(database.get_thumbnail(hit.id))
+        hit, = database.search("query", with_thumbnails=True)[0]
+        self.assertIsNone(hit.thumbnail)
+        without_store = QdrantVectorDatabase(embed=database._embed,
+                                             client=client,
+                                             collection="images",
+                                             )
+        self.assertIsNone(without_store.search(
+            "query", with_thumbnails=True,
+        )[0][0].thumbnail)
+
+    def test_bulk_load(self):
+        self.assertEqual([0, 5000], self._bulk_load_thresholds(5000))
+
+    def test_bulk_load__resumed_after_interrupted_bulk_load(self):
+        self.assertEqual([0, DEFAULT_INDEXING_THRESHOLD],
+                         self._bulk_load_thresholds(0))
+
+    def _bulk_load_thresholds(self, indexing_threshold):
+        client = self._database._client
+        info = client.get_collection(self._database._collection)
+        info.config.optimizer_config.indexing_threshold = indexing_threshold
+        with mock.patch.object(client, "get_collection", return_value=info), \
+                mock.patch.object(client, "update_collection") as update:
+            with self._database.bulk_load():
+                pass
+        return [call.kwargs["optimizers_config"].indexing_threshold
+                for call in update.call_args_list]
+
+    def test_dump_hits_and_load_hits(self):
+        hits = [SearchHit(id=str(uuid.uuid4()), score=0.5, text="text"),
+                SearchHit(id=str(uuid.uuid4()), score=0.25, thumbnail="x")]
+        self.assertEqual(hits, load_hits(dump_hits(hits)))
+
+
+class TestAsyncQdrantVectorDatabase(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self._db_contents = {str(uuid.uuid4()): torch.rand(_EMBEDDING_DIM,)
+                             for _ in range(10)}
+        self._embed = _create_embed(self._db_contents)
+        self._client = AsyncQdrantClient(":memory:")
+        self._executor = ThreadPoolExecutor(max_workers=1,
+                                            thread_name_prefix="inference",
+                                            )
+        self.addCleanup(self._executor.shutdown)
+
+    def _create_database(self, **kwargs) -> AsyncQdrantVectorDatabase:
+        return AsyncQdrantVectorDatabase(embed=self._embed,
+                                         client=self._client,
+                                         collection="images",
+                                         executor=self._executor,
+                                         **kwargs,
+                                         )
+
+    async def test_put_and_get(self):
+        database = self._create_database()
+        texts = list(self._db_contents)
+        await database.put(texts)
+        output = await database.query_similar(texts, n_similar=1)
+        self.assertEqual([[text] for text in texts], output)
+        all_hits, = await database.search(texts[0], n_similar=10)
+        second_page, = await database.search(texts[0], n_similar=4, offset=4)
+        self.assertEqual([hit.id for hit in all_hits[4:8]],
+                         [hit.id for hit in second_page])
+        hits, = await database.search_by_ids([all_hits[0].id], n_similar=3)
+        self.assertEqual([hit.id for hit in all_hits[1:4]],
+                         [hit.id for hit in hits])
+
+    async def test_search__initializes_collection_once(self):
+        self._db_contents["query"] = torch.rand(_EMBEDDING_DIM,)
+        database = self._create_database(
+            indexed_fields={"source": "keyword"},
+        )
+        with mock.patch.object(self._client, "recreate_collection",
+                               wraps=self._client.recreate_collection,
+                               ) as recreate_collection, \
+                mock.patch.object(self._client, "create_payload_index",
+                                  ) as create_payload_index:
+            output = await asyncio.gather(*(database.search("query")
+                                            for _ in range(5)))
+            recreate_collection.assert_called_once()
+            create_payload_index.assert_called_once()
+            self.assertEqual("metadata.source",
+                             create_payload_index.call_args.kwargs[
+                                 "field_name"])
+        self.assertEqual([[[]]] * 5, output)
+
+        with mock.patch.object(self._client, "recreate_collection",
+                               ) as recreate_collection:
+            await self._create_database().existing_ids([str(uuid.uuid4())])
+            recreate_collection.assert_not_called()
+
+    async def test_search__blocking_work_in_executor(self):
+        threads = []
+        self._embed.side_effect = lambda objs: (
+            threads.append(threading.current_thread().name)
+            or [self._db_contents[obj] for obj in objs]
+        )
+        database = self._create_database(
+            result_cache=LRUCache(max_size=2 ** 20),
+        )
+        texts = list(self._db_contents)
+        await database.put(texts)
+        first = await database.search(texts[0])
+        self.assertEqual(first, await database.search(texts[0]))
+        self.assertEqual(1, database._result_cache.stats()["hits"])
+        self.assertTrue(all(name.startswith("inference")
+                            for name in threads))
+
+    async def test_close(self):
+        database = self._create_database()
+        with mock.patch.object(self._client, "close") as close:
+            await database.close()
+            close.assert_awaited_once()
+
+
+class TestLocalVectorDatabase(unittest.TestCase):
+
+    def setUp(self):
+        self._tmp_dir = tempfile.TemporaryDirectory()
+        self._db_contents = {
+            str(uuid.uuid4()): torch.rand(_EMBEDDING_DIM,)
             for _ in range(10)
         }
-        # TODO
+        self._embed = _create_embed(self._db_contents)
+
+    def tearDown(self):
+        self._tmp_dir.cleanup()
+
+    def _create_database(self, **kwargs) -> LocalVectorDatabase:
+        return LocalVectorDatabase(embed=self._embed,
+                                   path=self._tmp_dir.name,
+                                   **kwargs,
+                                   )
+
+    def test_put_and_get(self):
+        database = self._create_database()
+        texts = list(self._db_contents)
+        database.put(texts)
+        output = database.query_similar(texts, n_similar=1)
+        self.assertEqual([[text] for text in texts], output)
+
+    def test_put__existing(self):
+        database = self._create_database()
+        texts = list(self._db_contents)
+        database.put(texts[:5])
+        database.put(texts + texts[:2])
+        self.assertEqual(10, len(database))
+        self.assertEqual(set(database._ids),
+                         database.existing_ids(database._ids + ["missing"]))
+
+    def test_query_similar__empty(self):
+        database = self._create_database()
+        output = database.query_similar(next(iter(self._db_contents)))
+        self.assertEqual([[]], output)
+
+    def test_query_similar__float16(self):
+        database = self._create_database(dtype="float16")
+        texts = list(self._db_contents)
+        database.put(texts)
+        output = database.query_similar(texts, n_similar=1)
+        self.assertEqual([[text] for text in texts], output)
+
+    def test_query_similar__ivf(self):
+        self._db_contents.update({
+            str(uuid.uuid4()): torch.rand(_EMBEDDING_DIM,)
+            for _ in range(200)
+        })
+        database = self._create_database(ivf_lists=4, ivf_probes=4)
+        texts = list(self._db_contents)
+        database.put(texts)
+        output = database.query_similar(texts[:10], n_similar=1)
+        self.assertEqual([[text] for text in texts[:10]], output)
+
+    def test_search__ivf_probes(self):
+        self._db_contents.update({
+            str(uuid.uuid4()): torch.rand(_EMBEDDING_DIM,)
+            for _ in range(200)
+        })
+        texts = list(self._db_contents)
+        exact = self._create_database()
+        exact.put(texts)
+        database = LocalVectorDatabase(embed=self._embed,
+                                       path=os.path.join(self._tmp_dir.name,
+                                                         "ivf"),
+                                       ivf_lists=4,
+                                       ivf_probes=4,
+                                       )
+        database.put(texts)
+        expected = exact.search(texts[:70], n_similar=5)
+        self.assertEqual(expected, database.search(texts[:70], n_similar=5))
+
+    def test_search__offset(self):
+        database = self._create_database()
+        texts = list(self._db_contents)
+        database.put(texts)
+        all_hits = database.search(texts[0], n_similar=10)[0]
+        second_page = database.search(texts[0], n_similar=4, offset=4)[0]
+        self.assertEqual(texts[0], all_hits[0].text)
+        self.assertEqual(all_hits[4:8], second_page)
+        self.assertEqual(all_hits[8:], database.search(texts[0],
+                                                       n_similar=4,
+                                                       offset=8)[0])
+
+    def test_search__score_threshold(self):
+        database = self._create_database()
+        texts = list(self._db_contents)
+        database.put(texts)
+        all_hits = database.search(texts[0], n_similar=10)[0]
+        threshold = all_hits[2].score
+        output = database.search(texts[0],
+                                 n_similar=10,
+                                 score_threshold=threshold,
+                                 )[0]
+        self.assertEqual([hit for hit in all_hits if hit.score >= threshold],
+                         output)
+
+    def test_search__filter(self):
+        database = self._create_database()
+        texts = list(self._db_contents)
+        _put_with_metadata(database, texts)
+        _assert_filtered(self, database, texts)
+        query_filter = Filter(must=[FieldCondition(
+            key="metadata.source", match=MatchValue(value="c"),
+        )])
+        self.assertEqual([[]], database.search(texts[0],
+                                               query_filter=query_filter))
+
+    def test_search_by_ids(self):
+        database = self._create_database()
+        texts = list(self._db_contents)
+        database.put(texts)
+        _assert_search_by_ids(self, database, texts)
+        with self.assertRaises(KeyError):
+            database.search_by_ids([str(uuid.uuid4())])
+
+    def test_search__with_thumbnails(self):
+        self._embed.side_effect = lambda objs: [
+            torch.rand(_EMBEDDING_DIM,) for _ in objs
+        ]
+        database = self._create_database()
+        database.put(Image.new("RGB", (64, 64)))
+        lean_hit, = database.search("query")[0]
+        self.assertEqual(database._ids[0], lean_hit.id)
+        self.assertIsNone(lean_hit.thumbnail)
+        inline_hit, = database.search("query", with_thumbnails=True)[0]
+        self.assertIsNotNone(inline_hit.thumbnail)
+
+    def test_reload(self):
+        texts = list(self._db_contents)
+        self._create_database().put(texts[:5])
+        database = self._create_database()
+        self.assertEqual(5, len(database))
+
+        self._create_database().put(texts[5:])  # concurrent writer
+        output = database.query_similar(texts, n_similar=1)
+        self.assertEqual(10, len(database))
+        self.assertEqual([[text] for text in texts], output)
+
+    def test_put__crashed_writer(self):
+        texts = list(self._db_contents)
+        self._create_database().put(texts[:5])
+        # a writer crashed after appending its vectors, or within its lines
+        with open(os.path.join(self._tmp_dir.name, "vectors.bin"), "ab") as fh:
+            fh.write(torch.rand(3, _EMBEDDING_DIM).numpy().tobytes())
+        with open(os.path.join(self._tmp_dir.name, "points.jsonl"), "a") as fh:
+            fh.write('{"id": "partial"')
+
+        database = self._create_database()
+        database.put(texts[5:])
+        output = database.query_similar(texts, n_similar=1)
+        self.assertEqual(10, len(database))
+        self.assertEqual([[text] for text in texts], output)
+        self.assertEqual(10, len(self._create_database()))
+
+    def test_get_thumbnail(self):
+        image = Image.new("RGB", (256, 128))
+        self._embed.side_effect = lambda objs: [
+            torch.rand(_EMBEDDING_DIM,) for _ in objs
+        ]
+        database = self._create_database()
+        database.put(image)
+        point_id = database._ids[0]
+        thumbnail = database.get_thumbnail(point_id)
+        self.assertEqual((128, 64), (thumbnail.width, thumbnail.height))
+        self.assertIsNone(database.get_thumbnail(str(uuid.uuid4())))
@@ -1,13 +1,19 @@
 """Test embedding component"""
+import importlib.util
 import io
 import os
+import tempfile
 import unittest
+from unittest import mock
+import warnings
 
 from PIL import Image
 import torch
+from transformers import CLIPConfig, CLIPModel
 
 import image_search
-from image_search.core.embedding import CLIPEmbedder
+from image_search.core.embedding import (CLIPEmbedder, _load_model,
+                                         _model_key, embedding_key)
 from image_search.core.utils import cosine_similarity
 
 _DEFAULT_MODEL_PATH = "openai/clip-vit-base-patch32"
@@ -52,3 +58,202 @@ class TestCLIPEmbedder(unittest.TestCase):
         image = Image.open(io.BytesIO(image_bytes))
         embeddings = self._embed([image])
         self.assertIsNotNone(embeddings)
+
+    def test_call__traced(self):
+        model_path = os.getenv("CLIP_MODEL_PATH", _DEFAULT_MODEL_PATH)
+        traced_embed = CLIPEmbedder(model_path, compile_mode="trace")
+        dog_image = Image.open(os.path.join(_FIXTURES_PATH, "dog.jpg"))
+        inputs = ["Cute dog standing on two legs", dog_image]
+        expected = torch.stack(tuple(self._embed(inputs)))
+        output = torch.stack(tuple(traced_embed(inputs)))
+        torch.testing.assert_close(output, expected, atol=1e-4, rtol=1e-4)
+
+    def test_encode__preprocessed(self):
+        dog_image = Image.open(os.path.join(_FIXTURES_PATH, "dog.jpg"))
+        cat_image = Image.open(os.path.join(_FIXTURES_PATH, "cat.jpg"))
+        inputs = [dog_image, "Cute dog standing on two legs", cat_image]
+        expected = torch.stack(tuple(self._embed(inputs)))
+        preprocessed = [self._embed.preprocess(obj) for obj in inputs]
+        self.assertIsInstance(preprocessed[0], torch.Tensor)
+        output = torch.stack(tuple(self._embed.encode(preprocessed)))
+        torch.testing.assert_close(output, expected)
+
+    def test_call__batched_preprocessing(self):
+        dog_image = Image.open(os.path.join(_FIXTURES_PATH, "dog.jpg"))
+        cat_image = Image.open(os.path.join(_FIXTURES_PATH, "cat.jpg"))
+        with mock.patch.object(self._embed, "_process_image",
+                               wraps=self._embed._process_image,
+                               ) as process_image:
+            self._embed([dog_image, "Cute dog", cat_image])
+        process_image.assert_called_once()
+
+    def test_call__fast_preprocessing(self):
+        model_path = os.getenv("CLIP_MODEL_PATH", _DEFAULT_MODEL_PATH)
+        fast_embed = CLIPEmbedder(model_path, fast_preprocessing=True)
+        dog_image = Image.open(os.path.join(_FIXTURES_PATH, "dog.jpg"))
+        inputs = ["Cute dog standing on two legs", dog_image]
+        expected = torch.stack(tuple(self._embed(inputs)))
+        output = torch.stack(tuple(fast_embed(inputs)))
+        torch.testing.assert_close(output, expected, atol=1e-4, rtol=1e-4)
+
+    def _assert_close_to_fp32(self, embed, tolerance):
+        dog_image = Image.open(os.path.join(_FIXTURES_PATH, "dog.jpg"))
+        inputs = ["Cute dog standing on two legs", dog_image]
+        expected = torch.stack(tuple(self._embed(inputs)))
+        output = torch.stack(tuple(embed(inputs)))
+        self.assertEqual(torch.float32, output.dtype)
+        similarities = torch.nn.functional.cosine_similarity(output, expected)
+        self.assertGreater(similarities.min().item(), 1 - tolerance)
+
+    def test_call__int8(self):
+        model_path = os.getenv("CLIP_MODEL_PATH", _DEFAULT_MODEL_PATH)
+        self._assert_close_to_fp32(CLIPEmbedder(model_path, precision="int8"),
+                                   tolerance=0.02)
+
+    def test_call__bf16(self):
+        model_path = os.getenv("CLIP_MODEL_PATH", _DEFAULT_MODEL_PATH)
+        self._assert_close_to_fp32(CLIPEmbedder(model_path, precision="bf16"),
+                                   tolerance=0.01)
+
+    @unittest.skipUnless(importlib.util.find_spec("onnxruntime"),
+                         "onnxruntime is not installed")
+    def test_call__onnx(self):
+        model_path = os.getenv("CLIP_MODEL_PATH", _DEFAULT_MODEL_PATH)
+        with tempfile.TemporaryDirectory() as onnx_path:
+            embed = CLIPEmbedder(model_path,
+                                 backend="onnx",
+                                 onnx_path=onnx_path,
+                                 )
+            self._assert_close_to_fp32(embed, tolerance=1e-4)
+
+    def test_call__normalize(self):
+        model_path = os.getenv("CLIP_MODEL_PATH", _DEFAULT_MODEL_PATH)
+        normalized_embed = CLIPEmbedder(model_path, normalize=True)
+        self.assertEqual("cosine", self._embed.distance)
+        self.assertEqual("dot", normalized_embed.distance)
+        dog_image = Image.open(os.path.join(_FIXTURES_PATH, "dog.jpg"))
+        inputs = ["Cute dog standing on two legs", dog_image]
+        expected = torch.nn.functional.normalize(
+            torch.stack(tuple(self._embed(inputs))), dim=-1,
+        )
+        output = torch.stack(tuple(normalized_embed(inputs)))
+        torch.testing.assert_close(output, expected)
+
+    def test_call__snapshot(self):
+        model_path = os.getenv("CLIP_MODEL_PATH", _DEFAULT_MODEL_PATH)
+        dog_image = Image.open(os.path.join(_FIXTURES_PATH, "dog.jpg"))
+        inputs = ["Cute dog standing on two legs", dog_image]
+        expected = torch.stack(tuple(self._embed(inputs)))
+        with tempfile.TemporaryDirectory() as path:
+            snapshot_path = os.path.join(path, "model.pt")
+            CLIPEmbedder(model_path, snapshot_path=snapshot_path)
+            self.assertTrue(os.path.exists(snapshot_path))
+            embed = CLIPEmbedder(model_path, snapshot_path=snapshot_path)
+            output = torch.stack(tuple(embed(inputs)))
+        torch.testing.assert_close(output, expected)
+
+
+class TestModelKey(unittest.TestCase):
+
+    def test_model_key(self):
+        config = CLIPConfig()
+        key = _model_key("openai/clip-vit-base-patch32", config, "fp32")
+        self.assertTrue(key.startswith("openai--clip-vit-base-patch32-fp32-"))
+        self.assertEqual(key, _model_key("openai/clip-vit-base-patch32",
+                                         CLIPConfig(),
+                                         "fp32"))
+        self.assertNotEqual(key, _model_key("openai/clip-vit-base-patch32",
+                                            config,
+                                            "int8"))
+        self.assertNotEqual(key, _model_key("openai/clip-vit-large-patch14",
+                                            config,
+                                            "fp32"))
+        config.projection_dim = 256
+        self.assertNotEqual(key, _model_key("openai/clip-vit-base-patch32",
+                                            config,
+                                            "fp32"))
+
+    def test_model_key__local_model(self):
+        config = CLIPConfig()
+        with tempfile.TemporaryDirectory() as model_path:
+            weights_path = os.path.join(model_path, "model.safetensors")
+            with open(weights_path, "wb") as fh:
+                fh.write(b"weights")
+            key = _model_key(model_path, config, "fp32")
+            self.assertEqual(key, _model_key(model_path, config, "fp32"))
+            with open(weights_path, "wb") as fh:
+                fh.write(b"fine-tuned weights")
+            self.assertNotEqual(key, _model_key(model_path, config, "fp32"))
+
+    @mock.patch("image_search.core.embedding.CLIPConfig.from_pretrained",
+                side_effect=lambda _: CLIPConfig())
+    def test_embedding_key(self, _):
+        model_path = "openai/clip-vit-base-patch32"
+        key = embedding_key(model_path)
+        self.assertEqual(_model_key(model_path, CLIPConfig(), "fp32"), key)
+        self.assertNotEqual(key, embedding_key(model_path, normalize=True))
+        self.assertNotEqual(key, embedding_key(model_path, "int8"))
+
+
+class TestLoadModel(unittest.TestCase):
+
+    def setUp(self):
+        self._configs = {}
+        for name, projection_dim in (("model-a", 8), ("model-b", 4)):
+            self._configs[name] = CLIPConfig(
+                text_config={"hidden_size": 8, "intermediate_size": 8,
+                             "num_hidden_layers": 1, "num_attention_heads": 1,
+                             "vocab_size": 16, "max_position_embeddings": 4},
+                vision_config={"hidden_size": 8, "intermediate_size": 8,
+                               "num_hidden_layers": 1,
+                               "num_attention_heads": 1,
+                               "image_size": 4, "patch_size": 2},
+                projection_dim=projection_dim,
+            )
+        for target, side_effect in (
+                ("CLIPConfig.from_pretrained", self._configs.get),
+                ("CLIPModel.from_pretrained",
+                 lambda name: CLIPModel(self._configs[name])),
+        ):
+            patcher = mock.patch(f"image_search.core.embedding.{target}",
+                                 side_effect=side_effect)
+            setattr(self, target.split(".")[0].lower(), patcher.start())
+            self.addCleanup(patcher.stop)
+
+    def test_load_model__snapshot(self):
+        with tempfile.TemporaryDirectory() as path:
+            snapshot_path = os.path.join(path, "model.pt")
+            model = _load_model("model-a", snapshot_path)
+            snapshot = _load_model("model-a", snapshot_path)
+            self.assertEqual(1, self.clipmodel.call_count)
+            self._assert_same_model(model, snapshot)
+
+            with warnings.catch_warnings(record=True) as caught:
+                warnings.simplefilter("always")
+                other_model = _load_model("model-b", snapshot_path)
+            self.assertEqual(1, len(caught))
+            self.assertEqual(2, self.clipmodel.call_count)
+            snapshot = _load_model("model-b", snapshot_path)
+            self.assertEqual(2, self.clipmodel.call_count)
+            self._assert_same_model(other_model, snapshot)
+
+    def test_load_model__pickled_snapshot(self):
+        with tempfile.TemporaryDirectory() as path:
+            snapshot_path = os.path.join(path, "model.pt")
+            torch.save({"model_path": "model-a",
+                        "model": torch.nn.Linear(2, 2)}, snapshot_path)
+            with warnings.catch_warnings(record=True) as caught:
+                warnings.simplefilter("always")
+                model = _load_model("model-a", snapshot_path)
+            self.assertEqual(1, len(caught))
+            self.assertIsInstance(model, CLIPModel)
+            snapshot = _load_model("model-a", snapshot_path)
+            self.assertEqual(1, self.clipmodel.call_count)
+            self._assert_same_model(model, snapshot)
+
+    def _assert_same_model(self, model, other_model):
+        buffers = dict(other_model.named_buffers())
+        for name, buffer in model.named_buffers():
+            torch.testing.assert_close(buffer, buffers[name])
+        torch.testing.assert_close(model.state_dict(),
+                                   other_model.state_dict())
@@ -0,0 +1,101 @@
+"""Test embedding store component"""
+import os
+import tempfile
+import unittest
+import uuid
+
+from qdrant_client.models import PointStruct
+import torch
+
+from image_search.core.embedding_store import EmbeddingStore
+
+_EMBEDDING_DIM = 4
+
+
+def _create_points(n_points: int,
+                   ) -> list[PointStruct]:
+    return [
+        PointStruct(id=str(uuid.uuid4()),
+                    vector=torch.rand(_EMBEDDING_DIM,).tolist(),
+                    payload={"text": f"text {i}"},
+                    )
+        for i in range(n_points)
+    ]
+
+
+class TestEmbeddingStore(unittest.TestCase):
+
+    def setUp(self):
+        self._tmp_dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self._tmp_dir.cleanup()
+
+    def _create_store(self, **kwargs) -> EmbeddingStore:
+        return EmbeddingStore(self._tmp_dir.name, "org/model", **kwargs)
+
+    def _assert_contents(self, store, points):
+        self.assertEqual([point.id for point in points], store.ids())
+        torch.testing.assert_close(
+            torch.tensor([point.vector for point in points]),
+            torch.from_numpy(store.vectors().copy()),
+        )
+        self.assertEqual([point.payload for point in points],
+                         list(store.payloads()))
+
+    def test_append(self):
+        store = self._create_store(embedding_dim=_EMBEDDING_DIM,
+                                   distance="dot")
+        points = _create_points(5)
+        self.assertEqual(3, store.append(points[:3]))
+        self.assertEqual(2, store.append(points + points[:1]))
+        self.assertEqual(5, len(store))
+        self._assert_contents(store, points)
+        self.assertEqual({points[0].id},
+                         store.existing_ids([points[0].id,
+                                             str(uuid.uuid4())]))
+
+        store = self._create_store()  # reader of existing store
+        self.assertEqual("dot", store.distance)
+        self.assertEqual(_EMBEDDING_DIM, store.embedding_dim)
+        self._assert_contents(store, points)
+
+    def test_append__crashed_writer(self):
+        store = self._create_store(embedding_dim=_EMBEDDING_DIM)
+        points = _create_points(4)
+        store.append(points[:2])
+        path = os.path.join(self._tmp_dir.name, "org--model")
+        for name in ("vectors.bin", "payloads.jsonl"):  # uncommitted rows
+            with open(os.path.join(path, name), "ab") as fh:
+                fh.write(b"partial")
+
+        store = self._create_store()
+        self._assert_contents(store, points[:2])
+        store.append(points[2:])
+        self._assert_contents(self._create_store(), points)
+
+    def test_points(self):
+        store = self._create_store(embedding_dim=_EMBEDDING_DIM)
+        points = _create_points(5)
+        store.append(points)
+        batches = list(store.points(batch_size=2))
+        self.assertEqual([2, 2, 1], [len(batch) for batch in batches])
+        self.assertEqual([point.id for point in points],
+                         [point.id for batch in batches for point in batch])
+        self.assertEqual(points[4].payload, batches[2][0].payload)
+
+    def test_missing_store(self):
+        with self.assertRaises(FileNotFoundError):
+            self._create_store()
+        self._create_store(embedding_dim=_EMBEDDING_DIM)
+        with self.assertRaises(ValueError):
+            self._create_store(embedding_dim=_EMBEDDING_DIM + 1)
+
+    def test_other_distance(self):
+        store = self._create_store(embedding_dim=_EMBEDDING_DIM,
+                                   distance="dot")
+        store.append(_create_points(2))
+        with self.assertRaises(ValueError):
+            self._create_store(embedding_dim=_EMBEDDING_DIM,
+                               distance="cosine")
+        self.assertEqual(2, len(self._create_store(distance="dot")))
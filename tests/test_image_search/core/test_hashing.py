@@ -0,0 +1,60 @@
+"""Test content hashes and point IDs"""
+import hashlib
+import os
+import tempfile
+import unittest
+import uuid
+
+from PIL import Image
+
+from image_search.core.hashing import (content_id, has_gradients, hash_to_id,
+                                       object_id, perceptual_hash)
+
+
+class TestHashing(unittest.TestCase):
+
+    def test_hash_to_id(self):
+        content_hash = hashlib.sha256(b"image").hexdigest()
+        point_id = hash_to_id(content_hash)
+        self.assertEqual(content_hash[:32], uuid.UUID(point_id).hex)
+
+    def test_hash_to_id__short_hash(self):
+        point_id = hash_to_id("0123456789abcdef")
+        self.assertEqual("0" * 16 + "0123456789abcdef",
+                         uuid.UUID(point_id).hex)
+
+    def test_object_id(self):
+        image = Image.new("RGB", (4, 4), color=(255, 0, 0))
+        self.assertEqual(object_id("text"), object_id("text"))
+        self.assertNotEqual(object_id("text"), object_id("other text"))
+        self.assertEqual(object_id(image), object_id(image.copy()))
+        self.assertNotEqual(object_id(image), object_id(image.convert("L")))
+
+    def test_perceptual_hash(self):
+        image = Image.linear_gradient("L").rotate(90).convert("RGB")
+        resized = image.resize((64, 64))
+        mirrored = image.transpose(Image.Transpose.FLIP_LEFT_RIGHT)
+        self.assertEqual(16, len(perceptual_hash(image)))
+        self.assertEqual(64, len(perceptual_hash(image, hash_size=16)))
+        self.assertEqual(perceptual_hash(image), perceptual_hash(resized))
+        self.assertNotEqual(perceptual_hash(image),
+                            perceptual_hash(mirrored))
+
+    def test_object_id__image_file(self):
+        image = Image.new("RGB", (4, 4), color=(255, 0, 0))
+        with tempfile.TemporaryDirectory() as path:
+            image_path = os.path.join(path, "image.png")
+            image.save(image_path)
+            with open(image_path, "rb") as fh:
+                expected_id = content_id(fh.read())
+            with Image.open(image_path) as opened_image:
+                self.assertEqual(expected_id, object_id(opened_image))
+        self.assertNotEqual(expected_id, object_id(image))
+
+    def test_has_gradients(self):
+        image = Image.radial_gradient("L").convert("RGB")
+        blank = Image.new("RGB", (32, 32), color=(255, 255, 255))
+        solid = Image.new("RGB", (64, 16), color=(0, 0, 255))
+        self.assertTrue(has_gradients(perceptual_hash(image)))
+        self.assertFalse(has_gradients(perceptual_hash(blank)))
+        self.assertFalse(has_gradients(perceptual_hash(solid)))
@@ -0,0 +1,143 @@
+"""Test indexing pipeline"""
+import tempfile
+import unittest
+from unittest import mock
+
+from PIL import Image
+from qdrant_client.models import FieldCondition, Filter, MatchValue
+import torch
+
+from image_search.core.hashing import perceptual_hash
+from image_search.core.local_database import LocalVectorDatabase
+from image_search.core.pipeline import IndexingPipeline
+
+_EMBEDDING_DIM = 4
+
+
+def _load(color: int) -> tuple[str, Image.Image]:
+    point_id = f"00000000-0000-0000-0000-{color:012d}"
+    return point_id, Image.new("L", (8, 8), color=color)
+
+
+class TestIndexingPipeline(unittest.TestCase):
+
+    def setUp(self):
+        self._tmp_dir = tempfile.TemporaryDirectory()
+        self._embed = mock.MagicMock()
+        self._embed.embedding_dim = _EMBEDDING_DIM
+        self._embed.distance = "cosine"
+        self._embed.preprocess.side_effect = lambda image: image.getpixel(
+            (0, 0))
+        self._embed.encode.side_effect = lambda inputs: [
+            torch.tensor([1.0, value, 0.0, 0.0]) for value in inputs
+        ]
+        self._database = LocalVectorDatabase(embed=self._embed,
+                                             path=self._tmp_dir.name,
+                                             )
+
+    def tearDown(self):
+        self._tmp_dir.cleanup()
+
+    def test_run(self):
+        pipeline = IndexingPipeline(self._embed,
+                                    self._database,
+                                    load_workers=2,
+                                    batch_size=3,
+                                    queue_size=1,
+                                    )
+        report = pipeline.run(range(10), _load)
+        self.assertEqual(10, report.n_new)
+        self.assertEqual(10, len(self._database))
+        batch_sizes = [len(call.args[0])
+                       for call in self._embed.encode.call_args_list]
+        self.assertEqual([3, 3, 3, 1], batch_sizes)
+        self.assertLessEqual({"decode", "thumbnail", "preprocess", "encode",
+                              "upsert", "total"}, set(report.timings))
+
+    def test_run__metadata(self):
+        pipeline = IndexingPipeline(self._embed, self._database, batch_size=2)
+        pipeline.run(range(4), _load, {1: {"source": "a"}, 3: {"source": "b"}})
+        query_filter = Filter(must=[FieldCondition(
+            key="metadata.source", match=MatchValue(value="b"),
+        )])
+        hits, = self._database.search_vectors([torch.ones(_EMBEDDING_DIM)],
+                                              n_similar=4,
+                                              query_filter=query_filter,
+                                              )
+        self.assertEqual([_load(3)[0]], [hit.id for hit in hits])
+
+    def test_run__deduplicate(self):
+        pipeline = IndexingPipeline(self._embed, self._database, batch_size=4)
+        pipeline.run(range(3), _load)
+        report = pipeline.run([0, 1, 3, 3, 4, 5, 4], _load)
+        self.assertEqual(3, report.n_new)
+        self.assertEqual(6, len(self._database))
+        encoded = [value for call in self._embed.encode.call_args_list[1:]
+                   for value in call.args[0]]
+        self.assertEqual([3, 4, 5], encoded)
+
+    def test_run__near_duplicates(self):
+        gradient = Image.radial_gradient("L")
+        images = {
+            0: gradient,
+            1: gradient.resize((64, 64)),  # near-duplicate of 0
+            2: Image.new("L", (8, 8), color=0),  # blank images are distinct
+            3: Image.new("L", (8, 8), color=255),
+            4: gradient.resize((32, 32)),  # near-duplicate of an indexed one
+        }
+
+        def load(source: int) -> tuple[str, Image.Image]:
+            return _load(source)[0], images[source]
+
+        # one loader, so that the first of the near-duplicates is kept
+        pipeline = IndexingPipeline(self._embed,
+                                    self._database,
+                                    load_workers=1,
+                                    batch_size=2,
+                                    near_duplicates=True,
+                                    )
+        report = pipeline.run(range(4), load)
+        self.assertEqual(3, report.n_new)
+        self.assertEqual({_load(0)[0], _load(2)[0], _load(3)[0]},
+                         set(self._database._ids))
+        report = pipeline.run([4], load)
+        self.assertEqual(0, report.n_new)
+        self.assertEqual(_load(0)[0], self._database.find_by_metadata(
+            "perceptual_hash", perceptual_hash(gradient),
+        ))
+
+    def test_run__load_error(self):
+        def load(color: int) -> tuple[str, Image.Image]:
+            if color == 5:
+                raise OSError("Truncated image")
+            return _load(color)
+
+        pipeline = IndexingPipeline(self._embed, self._database, batch_size=2)
+        with self.assertRaises(OSError):
+            pipeline.run(range(10), load)
+
+    def test_run__upsert_error(self):
+        self._database.put_points = mock.MagicMock(
+            side_effect=RuntimeError("Connection lost"),
+        )
+        pipeline = IndexingPipeline(self._embed, self._database, batch_size=2)
+        with self.assertRaises(RuntimeError):
+            pipeline.run(range(10), _load)
+
+    def test_run__skip_load_errors(self):
+        def load(color: int) -> tuple[str, Image.Image]:
+            if color in (2, 5):
+                raise OSError("Truncated image")
+            return _load(color)
+
+        errors = []
+        pipeline = IndexingPipeline(self._embed,
+                                    self._database,
+                                    batch_size=2,
+                                    on_error=lambda source, exc: errors.append(
+                                        source),
+                                    )
+        report = pipeline.run(range(10), load)
+        self.assertEqual(8, report.n_new)
+        self.assertEqual(2, report.n_failed)
+        self.assertEqual([2, 5], errors)
@@ -0,0 +1,50 @@
+"""Test fast image preprocessing"""
+import os
+import unittest
+
+from PIL import Image
+import torch
+from transformers import CLIPImageProcessor
+
+import image_search
+from image_search.core.preprocessing import FastImageProcessor
+
+_ROOT = os.path.dirname(os.path.dirname(image_search.__file__))
+_FIXTURES_PATH = os.path.join(_ROOT, "tests", "fixtures")
+
+
+class TestFastImageProcessor(unittest.TestCase):
+
+    def setUp(self):
+        self._processor = CLIPImageProcessor()  # CLIP defaults
+        self._fast_processor = FastImageProcessor(self._processor)
+
+    def _assert_parity(self, images):
+        expected = self._processor(images=images,
+                                   return_tensors="pt")["pixel_values"]
+        pixels = [self._fast_processor(image) for image in images]
+        self.assertTrue(all(pixel.dtype == torch.uint8 for pixel in pixels))
+        output = self._fast_processor.normalize(pixels)
+        self.assertEqual(torch.float32, output.dtype)
+        torch.testing.assert_close(output, expected, atol=1e-5, rtol=0)
+
+    def test_call__parity(self):
+        images = [Image.open(os.path.join(_FIXTURES_PATH, name))
+                  for name in ("dog.jpg", "cat.jpg")]
+        self._assert_parity(images)
+
+    def test_call__parity_sizes_and_modes(self):
+        images = [
+            Image.effect_noise((640, 480), 64).convert("RGB"),
+            Image.effect_noise((150, 900), 64).convert("RGBA"),
+            Image.effect_noise((100, 80), 64),  # grayscale, upscaled
+        ]
+        self._assert_parity(images)
+
+    def test_normalize__stacked(self):
+        image = Image.open(os.path.join(_FIXTURES_PATH, "dog.jpg"))
+        pixels = self._fast_processor(image)
+        torch.testing.assert_close(
+            self._fast_processor.normalize(pixels.unsqueeze(0)),
+            self._fast_processor.normalize([pixels]),
+        )
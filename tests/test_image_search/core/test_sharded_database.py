@@ -0,0 +1,194 @@
+"""Test sharded database component"""
+import os
+import tempfile
+import threading
+import unittest
+from unittest import mock
+import uuid
+
+from PIL import Image
+from qdrant_client.models import PointStruct
+import torch
+
+from image_search.core.cache import LRUCache
+from image_search.core.local_database import LocalVectorDatabase
+from image_search.core.sharded_database import (ShardedDatabase,
+                                                hash_partition,
+                                                named_partition)
+
+_EMBEDDING_DIM = 10
+_SHARDS = ("a", "b", "c")
+
+
+class TestShardedDatabase(unittest.TestCase):
+
+    def setUp(self):
+        self._tmp_dir = tempfile.TemporaryDirectory()
+        self._db_contents = {
+            str(uuid.uuid4()): torch.rand(_EMBEDDING_DIM,)
+            for _ in range(30)
+        }
+        self._embed = mock.MagicMock()
+        self._embed.embedding_dim = _EMBEDDING_DIM
+        self._embed.distance = "cosine"
+        self._embed.side_effect = lambda objs: [
+            self._db_contents[obj] if isinstance(obj, str)
+            else torch.rand(_EMBEDDING_DIM,)
+            for obj in objs
+        ]
+        self._shards = {shard: self._create_database(shard)
+                        for shard in _SHARDS}
+
+    def tearDown(self):
+        self._tmp_dir.cleanup()
+
+    def _create_database(self,
+                         name: str,
+                         ) -> LocalVectorDatabase:
+        return LocalVectorDatabase(embed=self._embed,
+                                   path=os.path.join(self._tmp_dir.name,
+                                                     name),
+                                   )
+
+    def test_put_and_search(self):
+        database = ShardedDatabase(self._embed, self._shards)
+        texts = list(self._db_contents)
+        database.put(texts)
+        self.assertEqual(len(texts),
+                         sum(len(shard) for shard in self._shards.values()))
+        self.assertTrue(all(len(shard) for shard in self._shards.values()))
+        self.assertEqual([[text] for text in texts],
+                         database.query_similar(texts, n_similar=1))
+
+        unsharded = self._create_database("unsharded")
+        unsharded.put(texts)
+        expected = unsharded.search(texts[:2], n_similar=7, offset=3)
+        self._embed.reset_mock()
+        output = database.search(texts[:2], n_similar=7, offset=3)
+        self._embed.assert_called_once()
+        for expected_hits, hits in zip(expected, output):
+            self.assertEqual([hit.id for hit in expected_hits],
+                             [hit.id for hit in hits])
+            torch.testing.assert_close([hit.score for hit in expected_hits],
+                                       [hit.score for hit in hits])
+
+    def test_search_by_ids(self):
+        database = ShardedDatabase(self._embed, self._shards)
+        texts = list(self._db_contents)
+        database.put(texts)
+        unsharded = self._create_database("unsharded")
+        unsharded.put(texts)
+        point_ids = unsharded._ids[:3]
+        self.assertEqual(
+            [[hit.id for hit in hits]
+             for hits in unsharded.search_by_ids(point_ids, n_similar=4)],
+            [[hit.id for hit in hits]
+             for hits in database.search_by_ids(point_ids, n_similar=4)],
+        )
+        with self.assertRaises(KeyError):
+            database.search_by_ids([str(uuid.uuid4())])
+
+    def test_put__partition_key(self):
+        database = ShardedDatabase(self._embed,
+                                   self._shards,
+                                   partition=lambda key: key,
+                                   )
+        texts = list(self._db_contents)
+        database.put(texts[:5], partition_key="b")
+        self.assertEqual([0, 5, 0], [len(self._shards[shard])
+                                     for shard in _SHARDS])
+        hits = database.search(texts[0], n_similar=10, shards=["a"])
+        self.assertEqual([[]], hits)
+        with self.assertRaises(KeyError):
+            database.put(texts[5], partition_key="d")
+
+    def test_put_points__partition_field(self):
+        database = ShardedDatabase(self._embed,
+                                   self._shards,
+                                   partition=named_partition(_SHARDS),
+                                   partition_field="source",
+                                   )
+        texts = list(self._db_contents)
+        embeddings = self._embed(texts)
+        database.put_points([
+            PointStruct(id=text,
+                        vector=embedding,
+                        payload=database.create_payload(text,
+                                                        {"source": "c"}),
+                        )
+            for text, embedding in zip(texts[:5], embeddings)
+        ] + [
+            PointStruct(id=text,
+                        vector=embedding,
+                        payload=database.create_payload(text),
+                        )
+            for text, embedding in zip(texts[5:], embeddings[5:])
+        ])
+        self.assertEqual(5 + sum(named_partition(_SHARDS)(text) == "c"
+                                 for text in texts[5:]),
+                         len(self._shards["c"]))
+        hits = database.search(texts[0], n_similar=10, shards=["c"])[0]
+        self.assertEqual(texts[0], hits[0].id)
+
+    def test_named_partition(self):
+        partition = named_partition(_SHARDS)
+        self.assertEqual("b", partition("b"))
+        self.assertEqual(hash_partition(_SHARDS)("key"), partition("key"))
+
+    def test_existing_ids_and_get_thumbnail(self):
+        database = ShardedDatabase(self._embed, self._shards)
+        database.put(Image.new("RGB", (64, 32)))
+        point_id, = [shard._ids[0] for shard in self._shards.values()
+                     if len(shard)]
+        self.assertEqual({point_id},
+                         database.existing_ids([point_id, "missing"]))
+        self.assertEqual(64, database.get_thumbnail(point_id).width)
+        self.assertIsNone(database.get_thumbnail(str(uuid.uuid4())))
+
+    def test_search__slow_shard(self):
+        release = threading.Event()
+        self.addCleanup(release.set)
+        slow_shard = mock.MagicMock()
+        slow_shard.search_vectors.side_effect = lambda *args, **kwargs: (
+            release.wait()
+        )
+        failing_shard = mock.MagicMock()
+        failing_shard.search_vectors.side_effect = ConnectionError
+        database = ShardedDatabase(self._embed,
+                                   {**self._shards,
+                                    "slow": slow_shard,
+                                    "failing": failing_shard},
+                                   partition=lambda key: "a",
+                                   timeout=0.1,
+                                   result_cache=LRUCache(max_size=2 ** 20),
+                                   )
+        texts = list(self._db_contents)
+        database.put(texts)
+        self.assertEqual([[texts[0]]],
+                         database.query_similar(texts[0], n_similar=1))
+        self.assertEqual(0, database._result_cache.stats()["entries"])
+        with self.assertRaises(TimeoutError):
+            database.search(texts[0], shards=["slow"])
+        with self.assertRaises(ConnectionError):
+            database.search(texts[0], shards=["failing"])
+
+    def test_search__result_cache(self):
+        database = ShardedDatabase(self._embed,
+                                   self._shards,
+                                   result_cache=LRUCache(max_size=2 ** 20),
+                                   )
+        texts = list(self._db_contents)
+        database.put(texts[:10])
+        first = database.search(texts[0], n_similar=3)
+        with mock.patch.object(self._shards["a"], "search_vectors") as search:
+            self.assertEqual(first, database.search(texts[0], n_similar=3))
+            search.assert_not_called()
+        database.put(texts[10:])
+        self.assertEqual(texts[0],
+                         database.search(texts[0], n_similar=1)[0][0].text)
+
+    def test_hash_partition(self):
+        partition = hash_partition(_SHARDS)
+        shards = {partition(str(uuid.uuid4())) for _ in range(100)}
+        self.assertEqual(set(_SHARDS), shards)
+        self.assertEqual(partition("key"), hash_partition(_SHARDS)("key"))
@@ -0,0 +1,57 @@
+"""Test blob storage component"""
+import hashlib
+import os
+import tempfile
+import unittest
+
+from image_search.core.storage import BlobStore
+
+
+class TestBlobStore(unittest.TestCase):
+
+    def setUp(self):
+        self._tmp_dir = tempfile.TemporaryDirectory()
+        self._store = BlobStore(self._tmp_dir.name)
+
+    def tearDown(self):
+        self._tmp_dir.cleanup()
+
+    def test_put_and_open(self):
+        blob_hash = self._store.put(b"image data", owner="job")
+        self.assertEqual(hashlib.sha256(b"image data").hexdigest(), blob_hash)
+        with self._store.open(blob_hash, owner="job") as fh:
+            self.assertEqual(b"image data", fh.read())
+
+    def test_put_stream(self):
+        blob_hash = self._store.put_stream([b"image", b" ", b"data"],
+                                           owner="job")
+        with self._store.open(blob_hash, owner="job") as fh:
+            self.assertEqual(b"image data", fh.read())
+
+    def test_open__empty(self):
+        blob_hash = self._store.put(b"", owner="job")
+        with self._store.open(blob_hash, owner="job") as fh:
+            self.assertEqual(b"", fh.read())
+
+    def test_release(self):
+        blob_hash = self._store.put(b"image data", owner="job")
+        self._store.release("job")
+        with self.assertRaises(FileNotFoundError):
+            with self._store.open(blob_hash, owner="job"):
+                pass
+        blob_dir = os.path.join(self._tmp_dir.name, "blobs", blob_hash[:2])
+        self.assertEqual([], os.listdir(blob_dir))
+
+    def test_release__shared_blob(self):
+        blob_hash = self._store.put(b"image data", owner="job1")
+        self._store.put(b"image data", owner="job2")
+        self._store.release("job1")
+        with self._store.open(blob_hash, owner="job2") as fh:
+            self.assertEqual(b"image data", fh.read())
+
+    def test_release_expired(self):
+        self._store.put(b"image data", owner="job")
+        owner_dir = os.path.join(self._tmp_dir.name, "refs", "job")
+        os.utime(owner_dir, (0, 0))
+        self._store.release_expired(max_age=60)
+        self.assertFalse(os.path.exists(owner_dir))
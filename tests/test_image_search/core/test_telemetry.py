@@ -0,0 +1,100 @@
+"""Test telemetry component"""
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+from prometheus_client import CollectorRegistry
+
+from image_search.core import telemetry
+from image_search.core.cache import LRUCache
+
+
+class TestTelemetry(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = CollectorRegistry()
+        patcher = mock.patch.object(telemetry, "_metrics",
+                                    telemetry._Metrics(self.registry))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _sample(self, name, **labels):
+        return self.registry.get_sample_value(name, labels)
+
+    def test_stage(self):
+        with telemetry.stage("embedder", "text_encoder"):
+            pass
+        self.assertEqual(1, self._sample("image_search_stage_seconds_count",
+                                         component="embedder",
+                                         stage="text_encoder"))
+
+    def test_stage__exception(self):
+        with self.assertRaises(ValueError):
+            with telemetry.stage("embedder", "text_encoder"):
+                raise ValueError
+        self.assertEqual(1, self._sample("image_search_stage_seconds_count",
+                                         component="embedder",
+                                         stage="text_encoder"))
+
+    def test_observe_batch_size(self):
+        telemetry.observe_batch_size("batcher", 3)
+        telemetry.observe_batch_size("batcher", 5)
+        self.assertEqual(8, self._sample("image_search_batch_size_sum",
+                                         component="batcher"))
+
+    def test_set_queue_depth(self):
+        telemetry.set_queue_depth("upsert", 4)
+        self.assertEqual(4, self._sample("image_search_queue_depth",
+                                         queue="upsert"))
+
+    def test_register_cache(self):
+        cache = LRUCache(max_size=10)
+        telemetry.register_cache("results", cache)
+        cache.set("key", "value")
+        cache.get("key")
+        cache.get("missing")
+        self.assertEqual(1, self._sample("image_search_cache_hits_total",
+                                         cache="results", tier="local"))
+        self.assertEqual(1, self._sample("image_search_cache_misses_total",
+                                         cache="results", tier="local"))
+        self.assertEqual(1, self._sample("image_search_cache_entries",
+                                         cache="results", tier="local"))
+
+    def test_register_cache__multiprocess(self):
+        code = ("from image_search.core import telemetry; "
+                "from image_search.core.cache import LRUCache; "
+                "telemetry.enable(); "
+                "cache = LRUCache(max_size=10); "
+                "telemetry.register_cache('results', cache); "
+                "cache.get('missing'); "
+                "print(telemetry.export()[0].decode())")
+        with tempfile.TemporaryDirectory() as path:
+            output = subprocess.run([sys.executable, "-c", code],
+                                    capture_output=True,
+                                    check=True,
+                                    env={**os.environ,
+                                         "PROMETHEUS_MULTIPROC_DIR": path},
+                                    text=True,
+                                    ).stdout
+        self.assertIn('image_search_cache_misses{cache="results",'
+                      'tier="local"} 1.0', output)
+
+    def test_tracking__without_tracing(self):
+        func = object()
+        with telemetry.tracking("id", "search"):
+            self.assertIs(func, telemetry.propagate(func))
+
+
+class TestTelemetryDisabled(unittest.TestCase):
+
+    def test_stage(self):
+        with mock.patch.object(telemetry, "_metrics", None):
+            self.assertFalse(telemetry.is_enabled())
+            with telemetry.stage("embedder", "text_encoder"):
+                pass
+            telemetry.observe_batch_size("batcher", 3)
+            telemetry.set_queue_depth("upsert", 4)
+
@@ -0,0 +1,46 @@
+"""Test thumbnail component"""
+import os
+import unittest
+
+from PIL import Image
+
+import image_search
+from image_search.core.thumbnail import ThumbnailCodec
+
+_ROOT = os.path.dirname(os.path.dirname(image_search.__file__))
+_FIXTURES_PATH = os.path.join(_ROOT, "tests", "fixtures")
+
+
+class TestThumbnailCodec(unittest.TestCase):
+
+    def setUp(self):
+        self._image = Image.open(os.path.join(_FIXTURES_PATH, "dog.jpg"))
+
+    def test_encode_and_decode(self):
+        codec = ThumbnailCodec(size=(100, 50), format="webp", quality=75)
+        thumbnail = codec.encode(self._image)
+        self.assertEqual("webp", thumbnail.format)
+        self.assertEqual((50, 50), (thumbnail.width, thumbnail.height))
+        decoded = codec.decode(thumbnail)
+        self.assertEqual((thumbnail.width, thumbnail.height), decoded.size)
+        self.assertEqual(thumbnail.mode, decoded.mode)
+
+    def test_encode__keeps_image(self):
+        size = self._image.size
+        ThumbnailCodec(size=(16, 16)).encode(self._image)
+        self.assertEqual(size, self._image.size)
+
+    def test_encode__converts_mode(self):
+        image = Image.new("RGBA", (64, 32))
+        thumbnail = ThumbnailCodec(format="jpeg").encode(image)
+        self.assertEqual("RGB", thumbnail.mode)
+        self.assertEqual("image/jpeg", thumbnail.media_type)
+
+    def test_encode__smaller_than_pixels(self):
+        thumbnail = ThumbnailCodec(size=(128, 128)).encode(self._image)
+        n_pixel_bytes = thumbnail.width * thumbnail.height * 3
+        self.assertLess(len(thumbnail.data), n_pixel_bytes)
+
+    def test_init__unsupported_format(self):
+        with self.assertRaises(ValueError):
+            ThumbnailCodec(format="bmp")
@@ -4,7 +4,7 @@ import unittest
 import torch
 
 from image_search.core.utils import cosine_similarity, create_batches, \
-    group_by_type, scale_down
+    group_by_type, scale_down, topk_similarity
 
 
 class TestGroupByType(unittest.TestCase):
@@ -60,6 +60,52 @@ class TestCosineSimilarity(unittest.TestCase):
         torch.testing.assert_allclose(output, expected)
 
 
+class TestTopkSimilarity(unittest.TestCase):
+
+    def test_topk_similarity(self):
+        queries = torch.rand(3, 8)
+        corpus = torch.rand(100, 8)
+        expected_scores, expected_ids = (queries @ corpus.T).topk(5, dim=1)
+        scores, ids = topk_similarity(queries, corpus, 5, block_size=16)
+        torch.testing.assert_close(expected_scores, scores)
+        self.assertTrue(torch.equal(expected_ids, ids))
+
+    def test_topk_similarity__small_corpus(self):
+        scores, ids = topk_similarity(torch.rand(2, 8), torch.rand(3, 8), 5)
+        self.assertEqual((2, 3), tuple(scores.shape))
+        self.assertEqual((2, 3), tuple(ids.shape))
+
+    def test_topk_similarity__query_blocks(self):
+        queries = torch.rand(10, 8)
+        corpus = torch.rand(50, 8)
+        expected_scores, expected_ids = (queries @ corpus.T).topk(3, dim=1)
+        scores, ids = topk_similarity(queries, corpus, 3,
+                                      block_size=2,
+                                      query_block_size=4,
+                                      )
+        torch.testing.assert_close(expected_scores, scores)
+        self.assertTrue(torch.equal(expected_ids, ids))
+
+    def test_topk_similarity__normalize(self):
+        queries = torch.rand(3, 8)
+        corpus = torch.rand(100, 8)
+        expected_scores, expected_ids = torch.nn.functional.cosine_similarity(
+            queries[:, None], corpus[None], dim=-1,
+        ).topk(5, dim=1)
+        scores, ids = topk_similarity(queries, corpus, 5,
+                                      block_size=16,
+                                      normalize=True,
+                                      )
+        torch.testing.assert_close(expected_scores, scores)
+        self.assertTrue(torch.equal(expected_ids, ids))
+
+    def test_topk_similarity__mixed_precision(self):
+        queries = torch.rand(3, 8, dtype=torch.float16)
+        corpus = torch.rand(20, 8)
+        scores, _ = topk_similarity(queries, corpus, 5)
+        self.assertEqual(torch.float32, scores.dtype)
+
+
 class TestCreateBatches(unittest.TestCase):
 
     def test_create_batches__empty(self):
@@ -94,6 +140,24 @@ class TestCreateBatches(unittest.TestCase):
                     40, 41, 42, 43, 44, 45, 46, 47), (48, 49)]
         self.assertEquals(expected, batches)
 
+    def test_create_batches__max_weight(self):
+        elements = [3, 1, 4, 1, 5, 9, 2, 6]
+        batches = list(create_batches(elements,
+                                      batch_size=3,
+                                      max_weight=6,
+                                      weight=lambda x: x))
+        expected = [(3, 1), (4, 1), (5,), (9,), (2,), (6,)]
+        self.assertEquals(expected, batches)
+
+    def test_create_batches__max_weight_and_size(self):
+        elements = [1, 1, 1, 1, 1, 1, 1]
+        batches = list(create_batches(elements,
+                                      batch_size=3,
+                                      max_weight=100,
+                                      weight=lambda x: x))
+        expected = [(1, 1, 1), (1, 1, 1), (1,)]
+        self.assertEquals(expected, batches)
+
 
 class TestScaleDown(unittest.TestCase):
 